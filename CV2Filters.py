@@ -1,83 +1,204 @@
-import PIL
+import copy
+import math
+
 import cv2
-import numpy
 
 import Filter
+import instrumentation
+import pipeline
 
+# cv2.detailEnhance returns base + DETAIL_GAIN * (L - base) in the L channel of Lab, base being an edge-preserving
+# smoothing of L, and leaves the a and b channels alone
+DETAIL_GAIN = 3.0
 
-class DetailEnhanceFilter(Filter.Filter):
-    name = "Detail Enhance"
 
-    def apply_filter(self, image, *args):
-        img = numpy.array(image)
-        # convert the image into grayscale image
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+def gray_plane(img, context):
+    """
+    Grayscale plane of img, computed once per buffer in a pipeline. A grayscale img is its own plane.
+    """
+    if img.ndim == 2:
+        return img
+    return context.derive(img, 'gray', lambda: cv2.cvtColor(img, cv2.COLOR_BGR2GRAY))
+
 
-        # Blur the grayscale image with median blur
-        gray_blur = cv2.medianBlur(gray, 3)
+def median_gray(img, context, size):
+    """
+    Median-blurred grayscale plane of img, computed once per buffer and kernel size in a pipeline
+    """
+    return context.derive(img, ('median gray', size), lambda: cv2.medianBlur(gray_plane(img, context), size))
+
+
+def adaptive_edges(img, context, median_size, block_size):
+    """
+    Edge mask from adaptive thresholding of the median-blurred grayscale plane
+    """
+    return context.derive(img, ('edges', median_size, block_size), lambda: cv2.adaptiveThreshold(
+        median_gray(img, context, median_size), 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, block_size, 9))
 
-        # Apply adaptive thresholding to detect edges
-        edges = cv2.adaptiveThreshold(gray_blur, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 9, 9)
 
-        # Sharpen the image
-        color = cv2.detailEnhance(img, sigma_s=5, sigma_r=0.5)
+def working_scale(img, megapixels):
+    """
+    Factor by which the approximate mode shrinks img so that it is processed at about megapixels, 1 for the exact
+    mode, when megapixels is 0 or None, and for images that are small enough already
+    """
+    if not megapixels:
+        return 1.0
+    return min(1.0, math.sqrt(megapixels * 1e6 / (img.shape[0] * img.shape[1])))
+
+
+def shrink(img, scale):
+    return cv2.resize(img, (max(1, int(round(img.shape[1] * scale))), max(1, int(round(img.shape[0] * scale)))),
+                      interpolation=cv2.INTER_AREA)
+
+
+def enlarge(img, shape):
+    return cv2.resize(img, (shape[1], shape[0]), interpolation=cv2.INTER_LINEAR)
+
+
+def shrunk_filter(f, scale):
+    """
+    A copy of filter f whose kernel sizes suit an image shrunk by scale
+    """
+    shrunk = copy.copy(f)
+    shrunk.footprint_scale = f.footprint_scale * scale
+    return shrunk
+
+
+def to_lab(img):
+    # The same conversion as cv2.detailEnhance does internally
+    return cv2.cvtColor(cv2.multiply(img, (1 / 255.0,) * 4, dtype=cv2.CV_32F), cv2.COLOR_BGR2Lab)
+
+
+def gray_to_rgb(gray, context):
+    """
+    Expands a grayscale result to RGB and records the grayscale plane, so the next stage does not recompute it
+    """
+    result = cv2.cvtColor(gray, cv2.COLOR_GRAY2RGB)
+    context.publish(result, 'gray', gray)
+    return result
+
+
+class DetailEnhanceFilter(Filter.Filter):
+    """
+    The optional argument is the working resolution of the approximate mode in megapixels: the edge-preserving
+    smoothing is computed on a copy shrunk to that size and enlarged again, while the detail it enhances keeps the
+    full resolution
+    """
+    name = "Detail Enhance"
+    input_type = pipeline.ARRAY_INPUT
+    supports_approximation = True
+    # cv2.detailEnhance is a recursive edge-aware filter, so every output pixel depends on the whole image
+    halo = None
+    median_size = 3
+    threshold_block_size = 9
+    sigma_s = 5
+
+    def enhance(self, img, scale):
+        sigma_s = self.scale_length(self.sigma_s)
+        if scale >= 1:
+            return cv2.detailEnhance(img, sigma_s=sigma_s, sigma_r=0.5)
+        small = shrink(img, scale)
+        small_lightness = to_lab(small)[..., 0]
+        enhanced_lightness = to_lab(cv2.detailEnhance(small, sigma_s=sigma_s * scale, sigma_r=0.5))[..., 0]
+        base = (small_lightness * DETAIL_GAIN - enhanced_lightness) / (DETAIL_GAIN - 1)
+        lab = to_lab(img)
+        lightness = lab[..., 0]
+        lightness *= DETAIL_GAIN
+        lightness -= enlarge(base, img.shape) * (DETAIL_GAIN - 1)
+        return cv2.multiply(cv2.cvtColor(lab, cv2.COLOR_Lab2BGR), (255.0,) * 4, dtype=cv2.CV_8U)
+
+    def apply_array(self, img, context, *args):
+        # Blur the grayscale image with median blur and apply adaptive thresholding to detect edges
+        edges = adaptive_edges(img, context, self.scale_kernel_size(self.median_size),
+                               self.scale_kernel_size(self.threshold_block_size, minimum=3))
+
+        # Sharpen the image, cv2.detailEnhance only takes colour images
+        if img.ndim == 2:
+            img = cv2.cvtColor(img, cv2.COLOR_GRAY2RGB)
+        color = self.enhance(img, working_scale(img, args[0] if args else None))
 
         # Merge the colors of same images using "edges" as a mask
-        cartoon = cv2.bitwise_and(color, color, mask=edges)
-        result = PIL.Image.fromarray(cartoon, 'RGB')
-        return result
+        color[edges == 0] = 0
+        return color
 
 
 class PencilSketchFilter(Filter.Filter):
     name = "Pencil Sketch"
+    input_type = pipeline.ARRAY_INPUT
+    blur_size = 25
 
-    def apply_filter(self, image, *args):
-        img = numpy.array(image)
+    def footprint(self, *args):
+        return self.scale_kernel_size(self.blur_size) // 2
+
+    def apply_array(self, img, context, *args):
         # Convert the image into grayscale image
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        gray = gray_plane(img, context)
 
         # Blur the image using Gaussian Blur
-        gray_blur = cv2.GaussianBlur(gray, (25, 25), 0)
+        blur_size = self.scale_kernel_size(self.blur_size)
+        gray_blur = cv2.GaussianBlur(gray, (blur_size, blur_size), 0)
 
         # Convert the image into pencil sketch
         cartoon = cv2.divide(gray, gray_blur, scale=250.0)
-        result = PIL.Image.fromarray(cartoon, 'RGB')
-        return result
+        return gray_to_rgb(cartoon, context)
 
 
 class BilateralFilter(Filter.Filter):
     name = "Bilateral"
-
-    def apply_filter(self, image, *args):
-        img = numpy.array(image)
-        # Convert image to grayscale
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-
-        # Apply median blur
-        gray = cv2.medianBlur(gray, 3)
-
-        # Detect edges with adaptive threshold
-        edges = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 9, 9)
-
-        # Apply bilateral filter
-        color = cv2.bilateralFilter(img, 5, 50, 5)
+    input_type = pipeline.ARRAY_INPUT
+    median_size = 3
+    threshold_block_size = 9
+    diameter = 5
+    sigma_space = 5
+
+    def footprint(self, *args):
+        # The median blur followed by the adaptive threshold block, or the bilateral filter diameter
+        edges_halo = (self.scale_kernel_size(self.median_size) // 2 +
+                      self.scale_kernel_size(self.threshold_block_size, minimum=3) // 2)
+        return max(edges_halo, self.scale_kernel_size(self.diameter) // 2)
+
+    def apply_array(self, img, context, *args):
+        # Apply median blur to the grayscale image and detect edges with adaptive threshold
+        edges = adaptive_edges(img, context, self.scale_kernel_size(self.median_size),
+                               self.scale_kernel_size(self.threshold_block_size, minimum=3))
+
+        # Apply bilateral filter, which only takes grayscale and RGB images, to the colour channels
+        color = cv2.bilateralFilter(img[..., :3] if img.ndim == 3 else img, self.scale_kernel_size(self.diameter), 50,
+                                    self.scale_length(self.sigma_space))
 
         # Merge the colors of same image using "edges" as a mask
-        cartoon = cv2.bitwise_and(color, color, mask=edges)
-        result = PIL.Image.fromarray(cartoon, 'RGB')
-        return result
+        color[edges == 0] = 0
+        if img.ndim == 3 and img.shape[2] == 4:
+            color = cv2.merge([color, img[..., 3]])
+        return color
 
 
 class PencilEdgesFilter(Filter.Filter):
+    """
+    The optional argument is the working resolution of the approximate mode in megapixels: the median blur runs on
+    a copy shrunk to that size and is enlarged again before the edges are detected at full resolution
+    """
     name = "Pencil Edges"
-
-    def apply_filter(self, image, *args):
-        img = numpy.array(image)
-        # Convert the image into grayscale image
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-
+    input_type = pipeline.ARRAY_INPUT
+    supports_approximation = True
+    median_size = 25
+
+    def footprint(self, *args):
+        if args and args[0]:
+            # The working resolution depends on the size of the whole image
+            return None
+        # The median blur followed by the 3 x 3 Laplacian
+        return self.scale_kernel_size(self.median_size) // 2 + 1
+
+    def apply_array(self, img, context, *args):
         # Blur the grayscale image using median blur
-        gray = cv2.medianBlur(gray, 25)
+        scale = working_scale(img, args[0] if args else None)
+        if scale < 1:
+            small_gray = shrink(gray_plane(img, context), scale)
+            gray = enlarge(cv2.medianBlur(small_gray, shrunk_filter(self, scale).scale_kernel_size(self.median_size)),
+                           img.shape)
+        else:
+            gray = median_gray(img, context, self.scale_kernel_size(self.median_size))
 
         # Detect edges with Laplacian
         edges = cv2.Laplacian(gray, -1, ksize=3)
@@ -87,23 +208,38 @@ class PencilEdgesFilter(Filter.Filter):
 
         # Create a pencil edge sketch
         dummy, cartoon = cv2.threshold(edges_inv, 150, 255, cv2.THRESH_BINARY)
-        result = PIL.Image.fromarray(cartoon, 'RGB')
-        return result
+        return gray_to_rgb(cartoon, context)
 
 
 class CartoonFilter(Filter.Filter):
     """
     Based on https://towardsdatascience.com/building-an-image-cartoonization-web-app-with-python-382c7c143b0d
+    The optional argument is passed on to the Detail Enhance and Pencil Edges steps.
     """
     name = "Cartoon"
-
-    def apply_filter(self, img, *args):
-        pencil_sketch_filter = PencilSketchFilter()
-        step1 = pencil_sketch_filter.apply_filter(img)
-        detail_filter = DetailEnhanceFilter()
-        step2 = detail_filter.apply_filter(step1)
-        bilateral_filter = BilateralFilter()
-        step3 = bilateral_filter.apply_filter(step2)
-        pencil_edges_filter = PencilEdgesFilter()
-        step4 = pencil_edges_filter.apply_filter(step3)
+    input_type = pipeline.ARRAY_INPUT
+    supports_approximation = True
+
+    def sub_filter(self, filter_class):
+        f = filter_class()
+        f.footprint_scale = self.footprint_scale
+        return f
+
+    def apply_sub_filter(self, filter_class, img, context, *args):
+        with instrumentation.span(filter_class.name, 'filter', parent=self.name):
+            return self.sub_filter(filter_class).apply_array(img, context, *args)
+
+    def footprint(self, *args):
+        halos = [self.sub_filter(f).footprint(*args) for f in (PencilSketchFilter, DetailEnhanceFilter,
+                                                                BilateralFilter, PencilEdgesFilter)]
+        return None if None in halos else sum(halos)
+
+    def apply_array(self, img, context, *args):
+        step1 = self.apply_sub_filter(PencilSketchFilter, img, context)
+        self.report_progress(0.25)
+        step2 = self.apply_sub_filter(DetailEnhanceFilter, step1, context, *args)
+        self.report_progress(0.5)
+        step3 = self.apply_sub_filter(BilateralFilter, step2, context)
+        self.report_progress(0.75)
+        step4 = self.apply_sub_filter(PencilEdgesFilter, step3, context, *args)
         return step4
@@ -1,10 +1,21 @@
+import collections
+import functools
+import math
 from tkinter import simpledialog
 
 import PIL
-import PIL.ImageDraw
+import PIL.Image
 import PIL.ImageFilter
 import numpy as np
 
+import convolution
+import jobs
+import lut
+import parallel
+import pipeline
+import registry
+import utils
+
 
 class Filter:
     """
@@ -12,111 +23,335 @@ class Filter:
     """
     name = "base filter"
     kernel = None
+    # One of PIL's built-in kernels, such as PIL.ImageFilter.BLUR, applied with PIL's own filter implementation
+    pil_filter = None
+    # How many pixels beyond its own position an output pixel depends on, None when it may depend on the whole image
+    halo = None
+    # Resolution of the image being filtered relative to the full-size image, used to scale radii and kernel sizes
+    # so that a preview at reduced size looks like the full-size result
+    footprint_scale = 1.0
+    # Whether the filter takes a working resolution in megapixels as its argument, to trade accuracy for speed on
+    # large images, see CV2Filters.working_scale
+    supports_approximation = False
+    # 'pil' filters implement apply_filter on PIL images, 'array' filters implement apply_array on numpy arrays and
+    # can be chained in a pipeline.Pipeline without converting back to PIL between stages
+    input_type = pipeline.PIL_INPUT
 
     def channel_adjust(self, channel, values):
         """
-        Changes the channel with respect to given value
+        Changes the channel with respect to given value.
+        uint8 and uint16 channels are mapped in place through a cached lookup table of the curve,
+        while float channels in [0, 1] are interpolated into a new array.
         """
+        bits = lut.table_bits(channel.dtype)
+        if bits:
+            return lut.apply_channel_table(channel, lut.curve_table(values, bits))
+
         orig_size = channel.shape
         flat_channel = channel.flatten()
         adjusted = np.interp(flat_channel, np.linspace(0, 1, len(values)), values)
 
         return adjusted.reshape(orig_size)
 
+    def channel_offset(self, channel, amount):
+        """
+        Adds amount, as a fraction of the full range, to a uint8 or uint16 channel in place, clamping the result
+        """
+        return lut.apply_channel_table(channel, lut.offset_table(amount, lut.table_bits(channel.dtype)))
+
     def apply_kernel(self, original_image):
-        input_pixels = original_image.load()
-
-        # Middle of the kernel
-        offset = len(self.kernel) // 2
-
-        # Create output image
-        output_image = PIL.Image.new("RGB", original_image.size)
-        draw = PIL.ImageDraw.Draw(output_image)
-
-        # Compute convolution between intensity and kernels
-        for x in range(offset, original_image.width - offset):
-            for y in range(offset, original_image.height - offset):
-                acc = [0, 0, 0]
-                for a in range(len(self.kernel)):
-                    for b in range(len(self.kernel)):
-                        xn = x + a - offset
-                        yn = y + b - offset
-                        pixel = input_pixels[xn, yn]
-                        acc[0] += pixel[0] * self.kernel[a][b]
-                        acc[1] += pixel[1] * self.kernel[a][b]
-                        acc[2] += pixel[2] * self.kernel[a][b]
-
-                draw.point((x, y), (int(acc[0]), int(acc[1]), int(acc[2])))
-        return output_image
+        """
+        Correlates the image with self.kernel, which is indexed kernel[x][y] around the middle tap.
+        Borders are reflected, and the result is rounded and clamped to uint8. An alpha channel is kept as is.
+        """
+        return pipeline.to_image(self.apply_kernel_to_array(pipeline.to_array(original_image)))
+
+    def apply_kernel_to_array(self, pixels):
+        # The kernel is indexed [x][y], while numpy arrays are indexed [row][column]
+        weights = np.transpose(np.asarray(self.kernel, dtype=np.float64))
+
+        if pixels.ndim == 3 and pixels.shape[2] == 4:
+            filtered = convolution.correlate_uint8(pixels[..., :3], weights)
+            return np.dstack([filtered, pixels[..., 3]])
+        return convolution.correlate_uint8(pixels, weights)
 
     def apply_filter(self, img, *args):
         """
             function applies the the according filter
         """
+        if self.input_type == pipeline.ARRAY_INPUT:
+            return pipeline.to_image(self.apply_array(pipeline.to_array(img), pipeline.PipelineContext(), *args))
+        if self.pil_filter is not None:
+            return img.filter(self.pil_filter)
+        if self.kernel is not None:
+            return self.apply_kernel(img)
+        table = self.lookup_table(*args)
+        if table is not None:
+            pixels = pipeline.to_array(img)
+            return pipeline.to_image(lut.apply_table(pixels, table, out=pixels))
+        raise NotImplementedError
+
+    def apply_array(self, img, context, *args):
+        """
+        Applies the filter to an (H, W) or (H, W, C) uint8 array and returns a new array, for filters whose
+        input_type is 'array'. context is the pipeline.PipelineContext shared by the stages of a pipeline.
+        """
+        if self.kernel is not None:
+            return self.apply_kernel_to_array(img)
         raise NotImplementedError
 
+    def apply_batch(self, images, *args):
+        """
+        Applies the filter to an (N, H, W) or (N, H, W, C) uint8 stack of same-sized images and returns the filtered
+        stack. Kernel filters, PIL's built-in kernels and point operations filter the whole stack in one vectorized
+        pass, with the numpy or OpenCV implementation of the kernel. Other filters are applied to one image at a
+        time, also those with a linear_kernel that only approximates their reference implementation, such as
+        gaussian, whose PIL reference is a series of box blurs.
+        """
+        images = np.asarray(images)
+        linear = self.linear_kernel(*args)
+        if linear is not None and (self.kernel is not None or hasattr(self.pil_filter, 'filterargs')):
+            weights, offset = linear
+            if self.kernel is not None and images.ndim == 4 and images.shape[3] == 4:
+                # Kernel filters keep the alpha channel as is, see apply_kernel_to_array
+                filtered = convolution.correlate_uint8_batch(images[..., :3], weights, offset=offset)
+                return np.concatenate([filtered, images[..., 3:]], axis=3)
+            filtered = convolution.correlate_uint8_batch(images, weights, offset=offset)
+            halo = self.footprint(*args)
+            if hasattr(self.pil_filter, 'filterargs') and halo:
+                # PIL leaves the pixels closer to the edge than the kernel reaches as they are
+                for edge in (np.s_[:, :halo], np.s_[:, -halo:], np.s_[:, :, :halo], np.s_[:, :, -halo:]):
+                    filtered[edge] = images[edge]
+            return filtered
+        table = self.lookup_table(*args)
+        if table is not None:
+            return lut.apply_table_batch(images, table)
+        if self.input_type == pipeline.ARRAY_INPUT:
+            return np.stack([self.apply_array(image, pipeline.PipelineContext(), *args) for image in images])
+        return np.stack([pipeline.to_array(self.apply_filter(pipeline.to_image(image), *args)) for image in images])
+
+    def linear_kernel(self, *args):
+        """
+        Returns (weights, offset) when the filter is a linear convolution, with weights indexed [dy][dx],
+        or None otherwise. A pipeline.Pipeline fuses consecutive linear filters into one pass.
+        """
+        if self.kernel is not None:
+            return np.transpose(np.asarray(self.kernel, dtype=np.float64)), 0.0
+        if hasattr(self.pil_filter, 'filterargs'):
+            (width, height), scale, offset, values = self.pil_filter.filterargs
+            # PIL applies the first row of the kernel to the row below the pixel
+            weights = np.asarray(values, dtype=np.float64).reshape(height, width)[::-1] / scale
+            return weights, float(offset)
+        return None
+
+    def implementations(self):
+        """
+        Returns an ordered map from backend name to a function(img, *args) returning the filtered PIL image, for
+        filters that more than one library can compute, otherwise an empty map. The first one is the reference the
+        tuner checks the others against, see tuning.py. Built-in PIL kernels can also be applied by OpenCV or numpy.
+        """
+        implementations = collections.OrderedDict()
+        if hasattr(self.pil_filter, 'filterargs'):
+            implementations[registry.PIL_BACKEND] = self.apply_filter
+            implementations.update(self.linear_kernel_implementations())
+        return implementations
+
+    def linear_kernel_implementations(self):
+        implementations = collections.OrderedDict()
+        if convolution.has_opencv():
+            implementations[registry.OPENCV_BACKEND] = functools.partial(self.apply_linear_kernel, method='opencv')
+        implementations[registry.NUMPY_BACKEND] = functools.partial(self.apply_linear_kernel, method='numpy')
+        return implementations
+
+    def apply_linear_kernel(self, img, *args, method='auto'):
+        """
+        Applies linear_kernel to every band of img, alpha included like PIL's filters, using the given
+        convolution.correlate_uint8 method, or 'numpy' for the fastest one that does not need OpenCV. Filters that are
+        only linear for some arguments are applied with apply_filter otherwise.
+        """
+        linear = self.linear_kernel(*args)
+        if linear is None:
+            return self.apply_filter(img, *args)
+        weights, offset = linear
+        if method == 'numpy':
+            method = convolution.choose_method(weights)
+        pixels = pipeline.to_array(img)
+        filtered = convolution.correlate_uint8(pixels, weights, offset=offset, method=method)
+        halo = self.footprint(*args)
+        if hasattr(self.pil_filter, 'filterargs') and halo:
+            # PIL leaves the pixels closer to the edge than the kernel reaches as they are
+            for edge in (np.s_[:halo], np.s_[-halo:], np.s_[:, :halo], np.s_[:, -halo:]):
+                filtered[edge] = pixels[edge]
+        return pipeline.to_image(filtered)
+
+    def dispatch_bucket(self, *args):
+        """
+        Returns the range of parameters args fall in, for filters whose fastest implementation depends on them.
+        The dispatch table picks a backend per range, see tuning.py.
+        """
+        return 'any'
+
+    def dispatch_arguments(self):
+        """
+        Returns the parameters the tuner times the implementations with, one list of them for each range that
+        dispatch_bucket tells apart
+        """
+        return [self.default_parameters()]
+
+    def lookup_table(self, *args):
+        """
+        Returns a uint8 lookup table, (256,) for all colour channels or (C, 256) per channel, when the filter is a
+        per-pixel point operation, or None otherwise. A pipeline.Pipeline fuses consecutive point operations.
+        """
+        return None
+
     def request_additional_parameters(self):
         return []
 
+    def default_parameters(self):
+        """
+        Parameters to use when the filter is applied without asking, e.g. from the command line
+        """
+        return []
+
+    def scale_length(self, length):
+        """
+        Scales a length in full-size pixels, such as a blur radius, to the resolution being filtered
+        """
+        return length * self.footprint_scale
 
-# class GothamFilter(Filter):
-#     """
-#     Implementation of an Instagram Filter named Gotham filter
-#         -> Channels down the r-channel
-#             and increases the b-channel
-#         -> Blurs the given Image to an appropriate Proportion
-#     """
-#     name = 'gotham'
-#
-#     def apply_filter(self, original_image, *args):
-#         """
-#         Applies the default filter
-#         """
-#         r = original_image[:, :, 0]
-#         b = original_image[:, :, 2]
-#         r_boost_lower = self.channel_adjust(r, [
-#             0, 0.05, 0.1, 0.2, 0.3,
-#             0.5, 0.7, 0.8, 0.9,
-#             0.95, 1.0])
-#         b_more = np.clip(b + 0.03, 0, 1.0)
-#         merged = np.stack([r_boost_lower, original_image[:, :, 1], b_more], axis=2)
-#
-#         '''
-#             Blurs the image. FFT is used here.
-#         '''
-#         blurred = gaussian_filter(merged, 0.001)
-#
-#         final = np.clip(merged * 1.3 - blurred * 0.3, 0, 1.0)
-#         b = final[:, :, 2]
-#         b_adjusted = self.channel_adjust(b, [
-#             0, 0.047, 0.198, 0.251, 0.318,
-#             0.392, 0.42, 0.439, 0.475,
-#             0.561, 0.58, 0.627, 0.671,
-#             0.733, 0.847, 0.925, 1])
-#
-#         final[:, :, 2] = b_adjusted
-#         return final
+    def scale_kernel_size(self, size, minimum=1):
+        """
+        Scales an odd kernel size to the resolution being filtered, keeping it odd and at least minimum
+        """
+        scaled = int(round((size - 1) / 2.0 * self.footprint_scale)) * 2 + 1
+        return max(scaled, minimum)
 
+    def report_progress(self, fraction):
+        """
+        Reports how far along a long-running filter is to the job running it, if any.
+        Raises jobs.JobCancelled when that job has been cancelled, so it also serves as a cancellation point.
+        """
+        jobs.report_progress(fraction)
 
-# class RiverdaleFilter(Filter):
-#     name = 'riverdale'
-#
-#     def apply_filter(self, original_image, *args):
-#         r = original_image[:, :, 0]
-#         b = original_image[:, :, 2]
-#         r_boost_lower = self.channel_adjust(r, [
-#             0, 0.05, 0.1, 0.2, 0.3,
-#             0.5, 0.7, 0.8, 0.9,
-#             0.95, 1.0])
-#         b_more = np.clip(b + 0.2, 0, 1.0)
-#         merged = np.stack([r_boost_lower, original_image[:, :, 1], b_more], axis=2)
-#
-#         # Note: This has been changed to use the custom-defined Gaussian filter using FFT
-#         blurred = gaussian_filter(merged, 0.1)
-#
-#         final = np.clip(merged + blurred*0.3, 0, 1.0)
-#         # b = final[:, :,1]
-#         return final
+    def footprint(self, *args):
+        """
+        Returns the halo in pixels that tiled processing needs around a tile for the given parameters,
+        or None when the filter can not be applied in tiles
+        """
+        if self.kernel is not None:
+            return max(len(self.kernel), len(self.kernel[0])) // 2
+        if hasattr(self.pil_filter, 'filterargs'):
+            return max(self.pil_filter.filterargs[0]) // 2
+        return self.halo
+
+    def alignment(self, *args):
+        """
+        Returns the number of pixels that the origins of the bands or tiles the filter is applied to must be a
+        multiple of, for filters that work on a coarser grid of the image
+        """
+        return 1
+
+
+def iter_filter_classes(base=Filter):
+    """
+    Yields every subclass of base, including subclasses of subclasses, in definition order
+    """
+    for subclass in base.__subclasses__():
+        yield subclass
+        for nested in iter_filter_classes(subclass):
+            yield nested
+
+
+def get_filter_map():
+    """
+    Returns a dictionary of filter name to filter class for every filter defined so far
+    """
+    return {x.name: x for x in iter_filter_classes()}
+
+
+def apply_chain(image, chain, scale=1.0, fuse=False, workers=1):
+    """
+    Applies a list of (filter class, arguments) steps in order. scale is the resolution of image relative to the
+    full-size image the chain was designed for, see Filter.footprint_scale. fuse combines runs of linear filters
+    and of point operations into single passes, see pipeline.fuse_steps. With several workers, large images are
+    filtered in bands on that many cores, see parallel.run.
+    """
+    filter_pipeline = pipeline.Pipeline.from_chain(chain, scale, fuse=fuse)
+    if workers > 1:
+        return parallel.run(filter_pipeline, image, workers)
+    return filter_pipeline.run(image)
+
+
+# Tone curve that lowers the mid tones, used on the red channel by the Instagram-style filters
+RED_BOOST_LOWER_CURVE = [
+    0, 0.05, 0.1, 0.2, 0.3,
+    0.5, 0.7, 0.8, 0.9,
+    0.95, 1.0]
+
+
+def rgb_stack(images):
+    """
+    Returns a float-ready copy of the colour channels of an (N, H, W, C) stack, with grayscale (N, H, W) stacks
+    repeated into RGB, for the filters that adjust the red and blue channels
+    """
+    images = np.asarray(images)
+    if images.ndim == 3:
+        return np.repeat(images[..., np.newaxis], 3, axis=3)
+    return np.array(images[:, :, :, :3])
+
+
+class GothamFilter(Filter):
+    """
+    Implementation of an Instagram Filter named Gotham filter
+        -> Channels down the r-channel
+            and increases the b-channel
+        -> Blurs the given Image to an appropriate Proportion
+    """
+    name = 'gotham'
+    input_type = pipeline.ARRAY_INPUT
+    blue_curve = [
+        0, 0.047, 0.198, 0.251, 0.318,
+        0.392, 0.42, 0.439, 0.475,
+        0.561, 0.58, 0.627, 0.671,
+        0.733, 0.847, 0.925, 1]
+
+    def apply_array(self, original_image, context, *args):
+        """
+        Applies the default filter
+        """
+        return self.apply_batch(original_image[np.newaxis], *args)[0]
+
+    def apply_batch(self, images, *args):
+        merged = rgb_stack(images)
+        self.channel_adjust(merged[:, :, :, 0], RED_BOOST_LOWER_CURVE)
+        self.channel_offset(merged[:, :, :, 2], 0.03)
+
+        # Blurs the images. FFT is used here.
+        blurred = utils.gaussian_filter_batch(merged, 0.001)
+
+        final = convolution.to_uint8(merged * 1.3 - blurred * 0.3)
+        self.channel_adjust(final[:, :, :, 2], self.blue_curve)
+        return final
+
+
+class RiverdaleFilter(Filter):
+    name = 'riverdale'
+    input_type = pipeline.ARRAY_INPUT
+
+    def apply_array(self, original_image, context, *args):
+        return self.apply_batch(original_image[np.newaxis], *args)[0]
+
+    def apply_batch(self, images, *args):
+        merged = rgb_stack(images)
+        self.channel_adjust(merged[:, :, :, 0], RED_BOOST_LOWER_CURVE)
+        self.channel_offset(merged[:, :, :, 2], 0.2)
+
+        # Note: This has been changed to use the custom-defined Gaussian filter using FFT
+        blurred = utils.gaussian_filter_batch(merged, 0.1)
+
+        final = convolution.to_uint8(merged + blurred*0.3)
+        return final
 
 
 # class RandomFilter(Filter):
@@ -160,9 +395,7 @@ class Filter:
 
 class BlurFilter(Filter):
     name = 'blur'
-
-    def apply_filter(self, original_image, *args):
-        return original_image.filter(PIL.ImageFilter.BLUR)
+    pil_filter = PIL.ImageFilter.BLUR
 
     # def request_additional_parameters(self):
     #     amount = simpledialog.askfloat("Blur amount", "Blur percentage", minvalue=0.0, maxvalue=100.0)
@@ -171,84 +404,143 @@ class BlurFilter(Filter):
 
 class GaussianFilter(Filter):
     name = 'gaussian'
+    # Largest radius the dialog accepts, in full-size pixels. Radii from convolution.PYRAMID_MIN_SIGMA up are blurred
+    # on a reduced image, which takes about the same time whatever the radius.
+    max_radius = 500
+    # Radii, at the resolution being filtered, from which the tuner picks the implementation again. The box blurs
+    # of PIL take the same time whatever the radius, while the cost of a Gaussian kernel grows with it.
+    dispatch_radii = (2, 4, convolution.PYRAMID_MIN_SIGMA)
 
     def apply_filter(self, original_image, *args):
-        radius = args[0]
+        if self.is_large_blur(*args):
+            return self.apply_large_blur(original_image, *args)
+        radius = self.scale_length(args[0])
         return original_image.filter(PIL.ImageFilter.GaussianBlur(radius))
 
     def request_additional_parameters(self):
-        radius = simpledialog.askinteger("Radius", "Radius", minvalue=1, maxvalue=10)
+        radius = simpledialog.askinteger("Radius", "Radius (1-{})".format(self.max_radius), minvalue=1,
+                                         maxvalue=self.max_radius)
         return [radius]
 
+    def default_parameters(self):
+        return [2]
+
+    def dispatch_bucket(self, *args):
+        radius = self.scale_length(args[0])
+        return 'radius>={:g}'.format(max([0] + [lower for lower in self.dispatch_radii if radius >= lower]))
+
+    def dispatch_arguments(self):
+        bounds = (0,) + self.dispatch_radii
+        # The middle of each range, and twice the radius the last one starts from
+        return [[(lower + upper) / 2.0] for lower, upper in zip(bounds, bounds[1:])] + [[bounds[-1] * 2]]
+
+    def is_large_blur(self, *args):
+        """
+        Whether the radius is large enough to blur on a reduced image, see convolution.pyramid_gaussian_blur
+        """
+        return self.scale_length(args[0]) >= convolution.PYRAMID_MIN_SIGMA
+
+    def uses_pyramid(self, *args):
+        return self.is_large_blur(*args) and convolution.has_opencv()
+
+    def apply_large_blur(self, original_image, *args):
+        if not convolution.has_opencv():
+            # PIL's box blurs also take the same time whatever the radius
+            return original_image.filter(PIL.ImageFilter.GaussianBlur(self.scale_length(args[0])))
+        pixels = pipeline.to_array(original_image)
+        return pipeline.to_image(convolution.pyramid_gaussian_blur(pixels, self.scale_length(args[0])))
+
+    def linear_kernel(self, *args):
+        if self.is_large_blur(*args):
+            # A kernel this wide costs more than the other filters it could be fused with
+            return None
+        return convolution.gaussian_kernel(self.scale_length(args[0])), 0.0
+
+    def implementations(self):
+        implementations = collections.OrderedDict([(registry.PIL_BACKEND, self.apply_filter)])
+        if convolution.has_opencv():
+            implementations[registry.OPENCV_BACKEND] = self.apply_opencv_blur
+        implementations[registry.NUMPY_BACKEND] = functools.partial(self.apply_linear_kernel, method='numpy')
+        return implementations
+
+    def apply_opencv_blur(self, original_image, *args):
+        import cv2
+
+        if self.is_large_blur(*args):
+            return self.apply_large_blur(original_image, *args)
+        pixels = pipeline.to_array(original_image)
+        return pipeline.to_image(cv2.GaussianBlur(pixels, (0, 0), self.scale_length(args[0]),
+                                                  borderType=cv2.BORDER_REFLECT_101))
+
+    def footprint(self, *args):
+        if self.uses_pyramid(*args):
+            return convolution.pyramid_footprint(self.scale_length(args[0]))
+        # PIL approximates the blur with three box blurs, each reaching at most radius + 1 pixels
+        return 3 * (int(math.ceil(self.scale_length(args[0]))) + 1)
+
+    def alignment(self, *args):
+        if self.uses_pyramid(*args):
+            # The reduced image is aligned with the top left corner of the piece it is computed from
+            return convolution.pyramid_factor(self.scale_length(args[0]))
+        return 1
+
 
 class SharpenFilter(Filter):
     name = 'sharpen'
-
-    def apply_filter(self, original_image, *args):
-        return original_image.filter(PIL.ImageFilter.SHARPEN)
+    pil_filter = PIL.ImageFilter.SHARPEN
 
 
 class SmoothFilter(Filter):
     name = 'smooth'
-
-    def apply_filter(self, original_image, *args):
-        return original_image.filter(PIL.ImageFilter.SMOOTH)
+    pil_filter = PIL.ImageFilter.SMOOTH
 
 
 class SmoothMoreFilter(Filter):
     name = 'smooth more'
-
-    def apply_filter(self, original_image, *args):
-        return original_image.filter(PIL.ImageFilter.SMOOTH_MORE)
+    pil_filter = PIL.ImageFilter.SMOOTH_MORE
 
 
 class ContourMoreFilter(Filter):
     name = 'contour'
-
-    def apply_filter(self, original_image, *args):
-        return original_image.filter(PIL.ImageFilter.CONTOUR)
+    pil_filter = PIL.ImageFilter.CONTOUR
 
 
 class ContourFilter(Filter):
     name = 'contour'
-
-    def apply_filter(self, original_image, *args):
-        return original_image.filter(PIL.ImageFilter.CONTOUR)
+    pil_filter = PIL.ImageFilter.CONTOUR
 
 
 class DetailFilter(Filter):
     name = 'detail'
-
-    def apply_filter(self, original_image, *args):
-        return original_image.filter(PIL.ImageFilter.DETAIL)
+    pil_filter = PIL.ImageFilter.DETAIL
 
 
 class EdgeEnhanceFilter(Filter):
     name = 'edge enhance'
-
-    def apply_filter(self, original_image, *args):
-        return original_image.filter(PIL.ImageFilter.EDGE_ENHANCE)
+    pil_filter = PIL.ImageFilter.EDGE_ENHANCE
 
 
 class EdgeEnhanceMoreFilter(Filter):
     name = 'edge enhance more'
-
-    def apply_filter(self, original_image, *args):
-        return original_image.filter(PIL.ImageFilter.EDGE_ENHANCE_MORE)
+    pil_filter = PIL.ImageFilter.EDGE_ENHANCE_MORE
 
 
 class EmbossFilter(Filter):
     name = 'emboss'
-
-    def apply_filter(self, original_image, *args):
-        return original_image.filter(PIL.ImageFilter.EMBOSS)
+    pil_filter = PIL.ImageFilter.EMBOSS
 
 
 class FindEdgesFilter(Filter):
     name = 'find edges'
+    pil_filter = PIL.ImageFilter.FIND_EDGES
 
-    def apply_filter(self, original_image, *args):
-        return original_image.filter(PIL.ImageFilter.FIND_EDGES)
+
+class InvertFilter(Filter):
+    name = 'invert'
+    halo = 0
+
+    def lookup_table(self, *args):
+        return 255 - lut.identity_table()
 
 
 # class MultipleFilter(Filter):
@@ -0,0 +1,391 @@
+import argparse
+import ast
+import collections
+import concurrent.futures
+import functools
+import glob
+import logging
+import os
+import sys
+import time
+
+import PIL.Image
+import numpy as np
+
+import utils
+import cache
+import image_io
+import pipeline
+import registry
+import tiling
+
+logger = logging.getLogger(__name__)
+
+STAGES = ('decode', 'filter', 'encode')
+# Each worker keeps only a few results in memory, the shared cache directory is what makes later runs fast
+WORKER_CACHE_MEMORY_BYTES = 128 * 1024 * 1024
+
+_worker_caches = {}
+
+
+def parse_filter_spec(spec):
+    """
+    Parses a "name[:arg,arg...]" filter specification into the filter name and a list of arguments
+    """
+    name, _, arguments = spec.partition(':')
+    args = []
+    for argument in arguments.split(','):
+        argument = argument.strip()
+        if not argument:
+            continue
+        try:
+            args.append(ast.literal_eval(argument))
+        except (ValueError, SyntaxError):
+            args.append(argument)
+    return name.strip(), args
+
+
+def resolve_filter(name):
+    """
+    Finds the filter class with the given name, ignoring case
+    """
+    return registry.load(name)
+
+
+def build_chain(specs):
+    """
+    Turns the filter specifications from the command line into a list of (filter name, arguments) tuples
+    """
+    chain = []
+    for spec in specs:
+        name, args = parse_filter_spec(spec)
+        filter_class = resolve_filter(name)
+        if not args:
+            args = filter_class().default_parameters()
+        chain.append((filter_class.name, args))
+    return chain
+
+
+def expand_inputs(patterns):
+    """
+    Expands the input glob patterns into a sorted list of unique file paths
+    """
+    paths = set()
+    for pattern in patterns:
+        paths.update(path for path in glob.glob(pattern, recursive=True) if os.path.isfile(path))
+    return sorted(paths)
+
+
+def input_root(patterns):
+    """
+    Returns the directory the input patterns share before their first wildcard, such as photos for
+    "photos/**/*.jpg", which the output paths keep the input paths relative to
+    """
+    roots = []
+    for pattern in patterns:
+        parts = []
+        for part in os.path.normpath(pattern).split(os.sep)[:-1]:
+            if glob.has_magic(part):
+                break
+            parts.append(part)
+        root = os.sep if parts == [''] else os.sep.join(parts)
+        roots.append(os.path.abspath(root or os.curdir))
+    return os.path.commonpath(roots)
+
+
+def output_path_for(path, output_dir, output_format=None, root=None):
+    """
+    Returns where the result for the input path is written: its path relative to root, or its file name without a
+    root, under output_dir, with the extension of output_format if given
+    """
+    relative = os.path.relpath(os.path.abspath(path), root) if root else os.path.basename(path)
+    if relative.startswith(os.pardir + os.sep):
+        relative = os.path.basename(path)
+    stem, extension = os.path.splitext(relative)
+    if output_format:
+        extension = '.' + output_format.lstrip('.')
+    return os.path.join(output_dir, stem + extension)
+
+
+def output_collisions(paths, output_dir, output_format=None, root=None):
+    """
+    Returns the output paths that more than one input would be written to, each with those inputs
+    """
+    inputs = collections.defaultdict(list)
+    for path in paths:
+        inputs[output_path_for(path, output_dir, output_format, root)].append(path)
+    return {output_path: sources for output_path, sources in inputs.items() if len(sources) > 1}
+
+
+def save_output(image, output_path, save_options):
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    return image_io.save_image(image, output_path, **(save_options or {}))
+
+
+def whole_image_filters(chain):
+    """
+    Returns the names of the filters of chain that depend on the whole image, which can not be applied in tiles
+    """
+    return [name for name, args in chain if registry.load(name)().footprint(*args) is None]
+
+
+def worker_cache(directory, max_disk_bytes):
+    """
+    Returns the result cache of this worker process for the given cache directory
+    """
+    key = (directory, max_disk_bytes)
+    if key not in _worker_caches:
+        _worker_caches[key] = cache.ResultCache(WORKER_CACHE_MEMORY_BYTES, directory, max_disk_bytes)
+    return _worker_caches[key]
+
+
+def process_file(path, chain, output_dir, output_format=None, memory_budget=None, fuse=False,
+                 cache_directory=None, cache_bytes=cache.DEFAULT_DISK_BYTES, save_options=None, root=None):
+    """
+    Decodes, filters and encodes one file in a worker process, returning the time spent in each stage, whether
+    the result came from the result cache in cache_directory and the size of the output file. save_options are
+    passed on to image_io.save_image, and root to output_path_for.
+    """
+    timings = {}
+    filter_chain = [(registry.load(name), args) for name, args in chain]
+    result_cache = worker_cache(cache_directory, cache_bytes) if cache_directory else None
+
+    start = time.perf_counter()
+    cached = None
+    if result_cache is not None:
+        # The file contents identify the source, so a cached result does not even need the file decoded
+        source_key = cache.file_digest(path)
+        cached = result_cache.get(cache.chain_keys(source_key, filter_chain, fuse=fuse)[-1])
+    if cached is None:
+        image = image_io.read_image(path)
+    timings['decode'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    filter_pipeline = pipeline.Pipeline.from_chain(filter_chain, fuse=fuse)
+    halo = filter_pipeline.footprint()
+    if cached is not None:
+        image = PIL.Image.fromarray(cached)
+    elif memory_budget and halo is not None:
+        pixels = pipeline.to_array(image)
+        # Every tile runs the filter backends the whole image would
+        pixels = tiling.process_tiles(pixels, functools.partial(filter_pipeline.run, report_progress=False,
+                                                                pixel_count=pixels.shape[0] * pixels.shape[1]),
+                                      halo, memory_budget=memory_budget, alignment=filter_pipeline.alignment())
+        if result_cache is not None:
+            result_cache.put(cache.chain_keys(source_key, filter_chain, fuse=fuse)[-1], pixels, persist=True,
+                             copy=False)
+        image = PIL.Image.fromarray(pixels)
+    elif result_cache is not None:
+        image = result_cache.run_chain(image, source_key, filter_chain, fuse=fuse, persist=True)
+    else:
+        image = filter_pipeline.run(image)
+    timings['filter'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    output_path = output_path_for(path, output_dir, output_format, root)
+    saved = save_output(image, output_path, save_options)
+    timings['encode'] = time.perf_counter() - start
+
+    return output_path, image.width * image.height, timings, cached is not None, saved.size_bytes
+
+
+def process_stack(paths, chain, output_dir, output_format=None, fuse=False, save_options=None, root=None):
+    """
+    Decodes, filters and encodes several files in a worker process. Images of the same size and mode are stacked
+    and filtered together with pipeline.Pipeline.run_batch, so small images such as thumbnails or sprites share the
+    per-call overhead of each filter. Returns the output paths, the pixel count, the time spent in each stage and
+    the size of the output files.
+    """
+    timings = collections.defaultdict(float)
+    filter_pipeline = pipeline.Pipeline.from_chain([(registry.load(name), args) for name, args in chain], fuse=fuse)
+
+    start = time.perf_counter()
+    groups = collections.OrderedDict()
+    for path in paths:
+        image = image_io.read_image(path)
+        groups.setdefault((image.mode, image.size), []).append((path, pipeline.to_array(image)))
+    timings['decode'] += time.perf_counter() - start
+
+    output_paths = []
+    pixel_count = 0
+    output_bytes = 0
+    for group in groups.values():
+        start = time.perf_counter()
+        filtered = filter_pipeline.run_batch(np.stack([pixels for _, pixels in group]))
+        timings['filter'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        for (path, _), pixels in zip(group, filtered):
+            output_path = output_path_for(path, output_dir, output_format, root)
+            output_bytes += save_output(pixels, output_path, save_options).size_bytes
+            output_paths.append(output_path)
+            pixel_count += pixels.shape[0] * pixels.shape[1]
+        timings['encode'] += time.perf_counter() - start
+    return output_paths, pixel_count, timings, output_bytes
+
+
+def run_batch(paths, chain, output_dir, workers=None, queue_depth=2, output_format=None, memory_budget=None,
+              fuse=False, cache_directory=None, cache_bytes=cache.DEFAULT_DISK_BYTES, stack_size=1, save_options=None,
+              root=None):
+    """
+    Runs the filter chain over every path in a process pool. At most workers * queue_depth tasks are in flight at
+    once, so memory stays bounded however many files there are. With a cache_directory, results are looked up in
+    and written to a result cache shared by the workers. With a stack_size above 1, each task filters that many
+    files at once with process_stack instead. save_options are the encoder settings, see image_io.save_image. The
+    outputs keep their paths relative to root, see output_path_for. Raises ValueError before filtering anything
+    when two inputs would be written to the same output. Returns the per-stage totals and the failures.
+    """
+    paths = list(paths)
+    collisions = output_collisions(paths, output_dir, output_format, root)
+    if collisions:
+        raise ValueError('Several inputs would be written to the same output: {}'.format('; '.join(
+            '{} from {}'.format(output_path, ', '.join(sources))
+            for output_path, sources in sorted(collisions.items()))))
+    workers = workers or os.cpu_count() or 1
+    if memory_budget and stack_size == 1 and whole_image_filters(chain):
+        logger.warning('The memory budget can not be kept: {} need the whole image, so every image is filtered in '
+                       'one piece'.format(', '.join(whole_image_filters(chain))))
+    max_in_flight = max(1, workers * queue_depth)
+    totals = collections.defaultdict(float)
+    pixels = 0
+    output_bytes = 0
+    completed = 0
+    cache_hits = 0
+    failures = []
+    pending = {}
+    remaining = iter([paths[index:index + stack_size] for index in range(0, len(paths), stack_size)])
+
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        while True:
+            for task_paths in remaining:
+                if stack_size > 1:
+                    future = executor.submit(process_stack, task_paths, chain, output_dir, output_format, fuse,
+                                             save_options, root)
+                else:
+                    future = executor.submit(process_file, task_paths[0], chain, output_dir, output_format,
+                                             memory_budget, fuse, cache_directory, cache_bytes, save_options, root)
+                pending[future] = task_paths
+                if len(pending) >= max_in_flight:
+                    break
+            if not pending:
+                break
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                task_paths = pending.pop(future)
+                try:
+                    if stack_size > 1:
+                        output_paths, pixel_count, timings, size_bytes = future.result()
+                        cache_hit = 0
+                    else:
+                        output_path, pixel_count, timings, cache_hit, size_bytes = future.result()
+                        output_paths = [output_path]
+                except Exception as e:
+                    logger.error('Failed to process {}: {}'.format(', '.join(task_paths), e))
+                    failures.extend(task_paths)
+                    continue
+                for output_path in output_paths:
+                    logger.debug('Wrote {}'.format(output_path))
+                completed += len(output_paths)
+                cache_hits += cache_hit
+                pixels += pixel_count
+                output_bytes += size_bytes
+                for stage, seconds in timings.items():
+                    totals[stage] += seconds
+    elapsed = time.perf_counter() - start
+
+    report_throughput(completed, pixels, totals, elapsed, workers, output_bytes)
+    if cache_directory:
+        logger.info('  {} of {} files were served from the result cache'.format(cache_hits, completed))
+    return totals, failures
+
+
+def report_throughput(completed, pixels, totals, elapsed, workers, output_bytes=0):
+    megapixels = pixels / 1e6
+    logger.info('Processed {} files ({:.1f} MP) in {:.2f} s with {} workers: {:.2f} files/s, {:.2f} MP/s'.format(
+        completed, megapixels, elapsed, workers, completed / elapsed if elapsed else 0,
+        megapixels / elapsed if elapsed else 0))
+    for stage in STAGES:
+        seconds = totals.get(stage, 0.0)
+        if seconds:
+            logger.info('  {:<6} {:8.2f} worker-s  {:8.2f} files/s  {:8.2f} MP/s per worker'.format(
+                stage, seconds, completed / seconds, megapixels / seconds))
+    if completed and output_bytes:
+        logger.info('  wrote {:.1f} MB, {:.1f} KB per file'.format(output_bytes / 1e6,
+                                                                   output_bytes / 1024.0 / completed))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Applies a chain of filters to many image files')
+    parser.add_argument('inputs', nargs='+', help='input files or glob patterns, ** is supported')
+    parser.add_argument('-f', '--filter', dest='filters', action='append', required=True,
+                        help='filter to apply, as NAME or NAME:ARG[,ARG...], e.g. "gaussian:3". Repeat to chain.')
+    parser.add_argument('-o', '--output-dir', required=True,
+                        help='directory to write the filtered images to, keeping their paths below the directory of '
+                             'the inputs, e.g. photos for "photos/**/*.jpg"')
+    parser.add_argument('--format', help='output file extension, e.g. png. Defaults to the input extension')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--queue-depth', type=int, default=2,
+                        help='files queued per worker, bounds the number of images in memory')
+    parser.add_argument('--memory-budget', type=int, default=None,
+                        help='process each image in tiles using at most this many MB per tile where possible')
+    parser.add_argument('--fuse', action='store_true',
+                        help='fuse runs of linear filters and of point operations into single passes. Faster, but '
+                             'it skips the rounding and clamping between linear filters, so chains with sharpening '
+                             'kernels can differ from the editor by over 100 levels')
+    parser.add_argument('--cache-dir',
+                        help='directory of a result cache shared between runs, so unchanged files are not filtered '
+                             'again')
+    parser.add_argument('--cache-size', type=int, default=cache.DEFAULT_DISK_BYTES // (1024 * 1024),
+                        help='MB the result cache directory may use before the least recently used results are '
+                             'evicted')
+    parser.add_argument('--stack', type=int, default=1, metavar='COUNT',
+                        help='filter up to this many same-sized images at once as one array, which is much faster '
+                             'for many small images such as thumbnails. Can not be combined with --cache-dir or '
+                             '--memory-budget')
+    parser.add_argument('--quality', type=int, help='JPEG and WebP quality, 1-100')
+    parser.add_argument('--compress-level', type=int, choices=range(10), metavar='0-9',
+                        help='PNG compression level, higher is smaller but slower')
+    parser.add_argument('--optimize', action='store_true',
+                        help='let the JPEG and PNG encoders take extra time for smaller files')
+    parser.add_argument('--progressive', action='store_true', help='write progressive JPEGs')
+    parser.add_argument('--encoder', choices=(registry.PIL_BACKEND, registry.OPENCV_BACKEND),
+                        default=registry.PIL_BACKEND, help='library to encode the output files with')
+    parser.add_argument('--log-file', help='also write the log to this file')
+    parser.add_argument('-v', '--verbose', action='store_true', help='log every file written')
+    arguments = parser.parse_args(argv)
+
+    if arguments.stack < 1:
+        parser.error('--stack must be at least 1')
+    if arguments.stack > 1 and (arguments.cache_dir or arguments.memory_budget):
+        parser.error('--stack can not be combined with --cache-dir or --memory-budget')
+    utils.setup_logger_to_console_file(arguments.log_file, logging.DEBUG if arguments.verbose else logging.INFO)
+
+    chain = build_chain(arguments.filters)
+    paths = expand_inputs(arguments.inputs)
+    if not paths:
+        logger.error('No input files matched {}'.format(arguments.inputs))
+        return 1
+    os.makedirs(arguments.output_dir, exist_ok=True)
+    logger.info('Applying {} to {} files'.format(' -> '.join('{}{}'.format(name, args or '') for name, args in chain),
+                                                  len(paths)))
+
+    memory_budget = arguments.memory_budget * 1024 * 1024 if arguments.memory_budget else None
+    try:
+        _, failures = run_batch(paths, chain, arguments.output_dir, workers=arguments.workers,
+                                queue_depth=arguments.queue_depth, output_format=arguments.format,
+                                memory_budget=memory_budget, fuse=arguments.fuse,
+                                cache_directory=arguments.cache_dir, cache_bytes=arguments.cache_size * 1024 * 1024,
+                                stack_size=arguments.stack,
+                                save_options={'quality': arguments.quality, 'compress_level': arguments.compress_level,
+                                              'optimize': arguments.optimize, 'progressive': arguments.progressive,
+                                              'backend': arguments.encoder},
+                                root=input_root(arguments.inputs))
+    except ValueError as e:
+        logger.error(e)
+        return 1
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,96 @@
+import argparse
+import logging
+import time
+
+import PIL.Image
+import PIL.ImageDraw
+import numpy as np
+
+import Filter
+import convolution
+import utils
+
+logger = logging.getLogger(__name__)
+
+KERNELS = {
+    'box 3x3': np.full((3, 3), 1 / 9.0),
+    'gaussian 5x5': np.outer([1, 4, 6, 4, 1], [1, 4, 6, 4, 1]) / 256.0,
+    'laplacian 3x3': np.array([[0, -1, 0], [-1, 5, -1], [0, -1, 0]], dtype=np.float64),
+    'random 15x15': np.random.RandomState(0).uniform(-1, 1, (15, 15)) / 15.0,
+}
+
+
+def apply_kernel_loop(kernel, original_image):
+    """
+    The original per-pixel implementation of Filter.apply_kernel, kept here as the reference to beat
+    """
+    input_pixels = original_image.load()
+
+    # Middle of the kernel
+    offset = len(kernel) // 2
+
+    # Create output image
+    output_image = PIL.Image.new("RGB", original_image.size)
+    draw = PIL.ImageDraw.Draw(output_image)
+
+    # Compute convolution between intensity and kernels
+    for x in range(offset, original_image.width - offset):
+        for y in range(offset, original_image.height - offset):
+            acc = [0, 0, 0]
+            for a in range(len(kernel)):
+                for b in range(len(kernel)):
+                    xn = x + a - offset
+                    yn = y + b - offset
+                    pixel = input_pixels[xn, yn]
+                    acc[0] += pixel[0] * kernel[a][b]
+                    acc[1] += pixel[1] * kernel[a][b]
+                    acc[2] += pixel[2] * kernel[a][b]
+
+            draw.point((x, y), (int(acc[0]), int(acc[1]), int(acc[2])))
+    return output_image
+
+
+def synthetic_image(width, height):
+    pixels = np.random.RandomState(1).randint(0, 256, (height, width, 3), dtype=np.uint8)
+    return PIL.Image.fromarray(pixels, 'RGB')
+
+
+def time_call(function, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run(sizes, loop_size, repeat):
+    kernel_filter = Filter.Filter()
+    loop_image = synthetic_image(loop_size, loop_size)
+    for kernel_name, kernel in KERNELS.items():
+        kernel_filter.kernel = kernel.tolist()
+        loop_seconds = time_call(lambda: apply_kernel_loop(kernel_filter.kernel, loop_image), 1)
+        loop_rate = loop_size * loop_size / loop_seconds / 1e6
+        logger.info('{:<14} {:>11} {:>9}  loop {:>10.1f} ms  {:8.3f} MP/s'.format(
+            kernel_name, '{0}x{0}'.format(loop_size), '', loop_seconds * 1000, loop_rate))
+        for size in sizes:
+            image = synthetic_image(size, size)
+            seconds = time_call(lambda: kernel_filter.apply_kernel(image), repeat)
+            rate = size * size / seconds / 1e6
+            logger.info('{:<14} {:>11} {:>9}  engine {:>8.1f} ms  {:8.3f} MP/s  {:8.0f}x faster than the loop'.format(
+                kernel_name, '{0}x{0}'.format(size), convolution.choose_uint8_method(np.asarray(image), kernel),
+                seconds * 1000, rate, rate / loop_rate))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares Filter.apply_kernel with the original per-pixel loop')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[256, 1024, 2048],
+                        help='edge lengths of the square test images for the vectorised engine')
+    parser.add_argument('--loop-size', type=int, default=128,
+                        help='edge length of the test image for the (slow) per-pixel loop')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs, the best one is reported')
+    arguments = parser.parse_args()
+
+    utils.setup_logger_to_console_file()
+    run(arguments.sizes, arguments.loop_size, arguments.repeat)
@@ -0,0 +1,298 @@
+import argparse
+import json
+import logging
+import platform
+import sys
+import time
+import tracemalloc
+
+import PIL
+import PIL.Image
+import numpy as np
+
+import Filter
+import CV2Filters  # noqa: F401 -- registers the OpenCV filters as Filter subclasses
+import pipeline
+import utils
+
+logger = logging.getLogger(__name__)
+
+MODES = ('RGB', 'RGBA', 'L')
+# Blocks a filter may leave allocated beyond the baseline's, on top of the threshold, before --compare reports it.
+# A few blocks come and go with caches and interned objects.
+RETAINED_BLOCKS_SLACK = 100
+
+
+def discover_filters():
+    """
+    Returns every concrete filter class, keyed by class name since several filters share a display name
+    """
+    return {filter_class.__name__: filter_class for filter_class in Filter.iter_filter_classes()}
+
+
+def synthetic_image(size, mode):
+    """
+    Returns a square test image with smooth gradients, edges and noise, so edge-aware filters have work to do
+    """
+    random = np.random.RandomState(size)
+    y, x = np.mgrid[0:size, 0:size] / float(size)
+    base = np.stack([x, y, (x + y) / 2], axis=2) * 200
+    base[(x > 0.25) & (x < 0.75) & (y > 0.25) & (y < 0.75)] += 40
+    pixels = np.clip(base + random.normal(0, 12, base.shape), 0, 255).astype(np.uint8)
+    image = PIL.Image.fromarray(pixels, 'RGB')
+    if mode == 'RGBA':
+        image.putalpha(PIL.Image.fromarray(random.randint(128, 256, (size, size), dtype=np.uint8)))
+    return image.convert(mode)
+
+
+def measure(filter_class, image, repeat):
+    """
+    Times repeat runs of the filter on image and then traces the memory of one more run. Returns the best and mean
+    wall time, the peak of memory traced by tracemalloc above the starting point and the bytes and blocks still held
+    afterwards, which are mostly the result. tracemalloc sees Python and numpy allocations, but not the buffers PIL
+    and OpenCV allocate internally.
+    """
+    f = filter_class()
+    args = f.default_parameters()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f.apply_filter(image, *args)
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        before_blocks = len(tracemalloc.take_snapshot().traces)
+        result = f.apply_filter(image, *args)
+        after, peak = tracemalloc.get_traced_memory()
+        after_blocks = len(tracemalloc.take_snapshot().traces)
+    finally:
+        tracemalloc.stop()
+    del result
+
+    return {
+        'seconds': min(times),
+        'mean_seconds': sum(times) / len(times),
+        'peak_traced_bytes': peak - before,
+        'retained_bytes': after - before,
+        'retained_blocks': after_blocks - before_blocks,
+    }
+
+
+def measure_approximation(filter_class, image, megapixels, repeat):
+    """
+    Times the approximate mode of a filter at the given working resolution against its exact mode, and returns the
+    times and the mean, 99th percentile and largest absolute difference of the results in levels
+    """
+    f = filter_class()
+    exact_times = []
+    approximate_times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        exact = f.apply_filter(image)
+        exact_times.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        approximate = f.apply_filter(image, megapixels)
+        approximate_times.append(time.perf_counter() - start)
+    difference = np.abs(np.asarray(approximate, dtype=np.int16) - np.asarray(exact, dtype=np.int16))
+    return {
+        'megapixels': megapixels,
+        'exact_seconds': min(exact_times),
+        'seconds': min(approximate_times),
+        'mean_error': float(difference.mean()),
+        'p99_error': float(np.percentile(difference, 99)),
+        'max_error': int(difference.max()),
+    }
+
+
+def measure_batch(filter_class, image, count, repeat):
+    """
+    Times filtering count copies of image one by one with apply_filter against filtering them as one stack with
+    apply_batch, and returns the time per image of both and the mean and largest absolute difference in levels
+    """
+    f = filter_class()
+    args = f.default_parameters()
+    stack = np.stack([pipeline.to_array(image)] * count)
+    looped_times = []
+    batch_times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        looped = [f.apply_filter(image, *args) for _ in range(count)]
+        looped_times.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        batched = f.apply_batch(stack, *args)
+        batch_times.append(time.perf_counter() - start)
+    difference = np.abs(np.asarray(batched[0], dtype=np.int16) - np.asarray(looped[0], dtype=np.int16))
+    return {
+        'count': count,
+        'looped_seconds': min(looped_times) / count,
+        'seconds': min(batch_times) / count,
+        'mean_error': float(difference.mean()),
+        'max_error': int(difference.max()),
+    }
+
+
+def describe_error(e):
+    # OpenCV errors span several lines, the first one names the failing function
+    lines = str(e).strip().splitlines()
+    return '{}: {}'.format(type(e).__name__, lines[0] if lines else '')
+
+
+def versions():
+    try:
+        import cv2
+        cv2_version = cv2.__version__
+    except ImportError:
+        cv2_version = None
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pillow': PIL.__version__,
+        'opencv': cv2_version,
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+    }
+
+
+def run(filter_names, sizes, modes, repeat, approximate_megapixels=None, batch_count=None):
+    """
+    Benchmarks every filter at every size and mode and returns the results document. With approximate_megapixels,
+    the approximate mode of the filters that have one is measured against their exact mode too. With batch_count,
+    filtering that many images as one stack is measured against filtering them one by one.
+    """
+    filters = discover_filters()
+    if filter_names:
+        unknown = sorted(set(filter_names) - set(filters))
+        if unknown:
+            raise ValueError('Unknown filter classes {}, expected some of: {}'.format(
+                unknown, ', '.join(sorted(filters))))
+        filters = {name: filters[name] for name in filter_names}
+
+    results = []
+    for size in sizes:
+        for mode in modes:
+            image = synthetic_image(size, mode)
+            for class_name, filter_class in sorted(filters.items()):
+                entry = {'filter': class_name, 'name': filter_class.name, 'mode': mode, 'size': size}
+                try:
+                    entry.update(measure(filter_class, image, repeat))
+                except Exception as e:
+                    entry['error'] = describe_error(e)
+                    logger.warning('{:<24} {:>4} {:>5}  failed: {}'.format(class_name, mode, size, entry['error']))
+                else:
+                    logger.info('{:<24} {:>4} {:>5}  {:9.2f} ms  {:8.2f} MP/s  peak {:8.1f} MB  '
+                                'retained {:8.1f} MB in {} blocks'.format(
+                                    class_name, mode, size, entry['seconds'] * 1000,
+                                    size * size / entry['seconds'] / 1e6, entry['peak_traced_bytes'] / 1e6,
+                                    entry['retained_bytes'] / 1e6, entry['retained_blocks']))
+                    if approximate_megapixels and filter_class.supports_approximation:
+                        approximation = measure_approximation(filter_class, image, approximate_megapixels, repeat)
+                        entry['approximate'] = approximation
+                        logger.info('{:<24} {:>4} {:>5}  approximate at {} MP: {:9.2f} ms, mean error {:.2f}, '
+                                    '99% within {:.0f}, max {}'.format(
+                                        class_name, mode, size, approximate_megapixels, approximation['seconds'] * 1000,
+                                        approximation['mean_error'], approximation['p99_error'],
+                                        approximation['max_error']))
+                    if batch_count:
+                        batch = measure_batch(filter_class, image, batch_count, repeat)
+                        entry['batch'] = batch
+                        logger.info('{:<24} {:>4} {:>5}  stack of {}: {:9.2f} ms per image, {:5.1f}x faster, '
+                                    'mean difference {:.2f}, max {}'.format(
+                                        class_name, mode, size, batch_count, batch['seconds'] * 1000,
+                                        batch['looped_seconds'] / batch['seconds'], batch['mean_error'],
+                                        batch['max_error']))
+                results.append(entry)
+    return {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'repeat': repeat,
+        'versions': versions(),
+        'results': results,
+    }
+
+
+def result_key(entry):
+    return entry['filter'], entry['mode'], entry['size']
+
+
+def compare(baseline, current, threshold=0.2, min_seconds=0.002):
+    """
+    Compares two results documents and returns the list of regressions, as (key, metric, old, new) tuples.
+    A time regression is a slowdown of more than threshold on a case that took at least min_seconds, a memory
+    regression a growth of the traced peak by more than threshold, or of the blocks still held after the run by more
+    than threshold and RETAINED_BLOCKS_SLACK. The latter are live blocks, not a count of allocations. Cases that
+    started failing are regressions too.
+    """
+    old_results = {result_key(entry): entry for entry in baseline['results']}
+    regressions = []
+    for entry in current['results']:
+        key = result_key(entry)
+        old = old_results.get(key)
+        if old is None or 'error' in old:
+            continue
+        if 'error' in entry:
+            regressions.append((key, 'error', None, entry['error']))
+            continue
+        if old['seconds'] >= min_seconds and entry['seconds'] > old['seconds'] * (1 + threshold):
+            regressions.append((key, 'seconds', old['seconds'], entry['seconds']))
+        if entry['peak_traced_bytes'] > max(old['peak_traced_bytes'], 1) * (1 + threshold) + 64 * 1024:
+            regressions.append((key, 'peak_traced_bytes', old['peak_traced_bytes'], entry['peak_traced_bytes']))
+        if 'retained_blocks' in old and \
+                entry['retained_blocks'] > max(old['retained_blocks'], 0) * (1 + threshold) + RETAINED_BLOCKS_SLACK:
+            regressions.append((key, 'retained_blocks', old['retained_blocks'], entry['retained_blocks']))
+    return regressions
+
+
+def report_comparison(baseline, current, regressions):
+    if baseline['versions'] != current['versions']:
+        logger.warning('Baseline was recorded with different versions: {}'.format(baseline['versions']))
+    for (class_name, mode, size), metric, old, new in regressions:
+        if metric == 'error':
+            logger.error('REGRESSION {} {} {}: now fails with {}'.format(class_name, mode, size, new))
+        else:
+            logger.error('REGRESSION {} {} {}: {} {:.4g} -> {:.4g} ({:+.0%})'.format(
+                class_name, mode, size, metric, old, new, new / float(old) - 1 if old else float('inf')))
+    if not regressions:
+        logger.info('No regressions against the baseline from {}'.format(baseline['created']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Times every registered filter on synthetic images')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[256, 1024],
+                        help='edge lengths of the square test images')
+    parser.add_argument('--modes', nargs='+', default=list(MODES), choices=MODES, help='image modes to test')
+    parser.add_argument('--filter', dest='filters', action='append',
+                        help='filter class to benchmark, e.g. GaussianFilter. Repeat for several, defaults to all')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs, the best one is compared')
+    parser.add_argument('--approximate', type=float, metavar='MEGAPIXELS',
+                        help='also measure the approximate mode of the filters that have one at this working '
+                             'resolution, and its error against the exact mode')
+    parser.add_argument('--batch', type=int, metavar='COUNT',
+                        help='also measure filtering this many images as one stack with apply_batch, against '
+                             'filtering them one by one')
+    parser.add_argument('-o', '--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='compare against a results file and exit with status 1 on regressions')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='relative slowdown or memory growth that counts as a regression')
+    arguments = parser.parse_args(argv)
+
+    utils.setup_logger_to_console_file()
+    current = run(arguments.filters, arguments.sizes, arguments.modes, arguments.repeat, arguments.approximate,
+                  arguments.batch)
+    if arguments.output:
+        with open(arguments.output, 'w') as f:
+            json.dump(current, f, indent=2)
+        logger.info('Wrote {} results to {}'.format(len(current['results']), arguments.output))
+
+    if arguments.compare:
+        with open(arguments.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, current, arguments.threshold)
+        report_comparison(baseline, current, regressions)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
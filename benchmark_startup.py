@@ -0,0 +1,66 @@
+import argparse
+import json
+import logging
+import statistics
+import subprocess
+import sys
+import time
+
+import utils
+
+logger = logging.getLogger(__name__)
+
+# Modules that are slow to import and should only be loaded when a filter or function needs them
+HEAVY_MODULES = ('cv2', 'matplotlib', 'skimage', 'scipy')
+
+PROBE = '''
+import json, sys, time
+start = time.perf_counter()
+import {module}
+imported = time.perf_counter() - start
+heavy = [name for name in {heavy!r} if name in sys.modules]
+start = time.perf_counter()
+{first_use}
+first_use = time.perf_counter() - start
+print(json.dumps({{'import': imported, 'first_use': first_use, 'heavy': heavy}}))
+'''
+
+
+def probe(module, first_use, cwd=None):
+    """
+    Imports module in a fresh interpreter, then runs the first_use statement, and returns the wall time of the whole
+    process, the time spent importing module and running first_use, and the heavy modules loaded by the import
+    """
+    code = PROBE.format(module=module, heavy=HEAVY_MODULES, first_use=first_use or 'pass')
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', code], check=True, stdout=subprocess.PIPE, cwd=cwd,
+                            universal_newlines=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result['process'] = time.perf_counter() - start
+    return result
+
+
+def run(module, first_use, repeat):
+    results = [probe(module, first_use) for _ in range(repeat)]
+    for key, label in (('process', 'interpreter start and import'), ('import', 'import {}'.format(module)),
+                       ('first_use', 'first use: {}'.format(first_use))):
+        if key == 'first_use' and not first_use:
+            continue
+        seconds = [result[key] for result in results]
+        logger.info('{:<48} median {:7.0f} ms  min {:7.0f} ms'.format(
+            label, statistics.median(seconds) * 1000, min(seconds) * 1000))
+    heavy = results[-1]['heavy']
+    logger.info('Heavy modules loaded by importing {}: {}'.format(module, ', '.join(heavy) if heavy else 'none'))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measures how long the editor takes to import in a fresh process')
+    parser.add_argument('--module', default='main_ui', help='module to import, main_ui by default')
+    parser.add_argument('--first-use', default="import registry; registry.load('Bilateral')",
+                        help='statement timed after the import, by default loading an OpenCV filter')
+    parser.add_argument('--repeat', type=int, default=5, help='number of fresh processes to measure')
+    arguments = parser.parse_args()
+
+    utils.setup_logger_to_console_file()
+    run(arguments.module, arguments.first_use, arguments.repeat)
@@ -0,0 +1,285 @@
+import collections
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+
+import PIL.Image
+import numpy as np
+
+import Filter
+import instrumentation
+import jobs
+import parallel
+import pipeline
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MEMORY_BYTES = 512 * 1024 * 1024
+DEFAULT_DISK_BYTES = 4 * 1024 * 1024 * 1024
+# Writes after which a disk cache lists its directory again, to count the results other processes wrote
+DISK_RESCAN_PUTS = 100
+# Image modes whose pixels round-trip through a numpy array, so their results can be cached
+CACHEABLE_MODES = ('L', 'RGB', 'RGBA')
+
+
+def _hasher():
+    return hashlib.blake2b(digest_size=16)
+
+
+def image_digest(image):
+    """
+    Returns a hex digest of the pixels of a PIL image or numpy array, together with its shape and pixel format
+    """
+    hasher = _hasher()
+    if isinstance(image, PIL.Image.Image):
+        hasher.update('{} {}'.format(image.mode, image.size).encode())
+        hasher.update(image.tobytes())
+    else:
+        image = np.ascontiguousarray(image)
+        hasher.update('{} {}'.format(image.dtype.str, image.shape).encode())
+        hasher.update(image.data)
+    return hasher.hexdigest()
+
+
+def file_digest(path, block_size=1024 * 1024):
+    """
+    Returns a hex digest of the contents of a file, which identifies an image without decoding it
+    """
+    hasher = _hasher()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def derive_key(key, *parts):
+    """
+    Returns the key of something derived from key, such as a resized copy, described by parts
+    """
+    hasher = _hasher()
+    hasher.update(key.encode())
+    for part in parts:
+        hasher.update(b'\0' + repr(part).encode())
+    return hasher.hexdigest()
+
+
+def chain_keys(source_key, chain, scale=1.0, fuse=False):
+    """
+    Returns the cache key of the result after every step of a chain of (filter class, arguments) steps applied to
+    the source with the given key. The key of each step depends on all the steps before it, so a chain shares the
+    keys of its prefixes with every chain that starts the same way.
+    """
+    keys = []
+    key = derive_key(source_key, 'scale', float(scale), 'fuse', bool(fuse))
+    for filter_class, args in chain:
+        key = derive_key(key, '{}.{}'.format(filter_class.__module__, filter_class.__qualname__), list(args))
+        keys.append(key)
+    return keys
+
+
+class DiskCache:
+    """
+    Results stored as .npy files in a directory, evicting the least recently used files once they take more than
+    max_bytes. Several processes can share a directory. Each keeps a running total of the directory size and only
+    lists the directory when that total exceeds max_bytes, or every DISK_RESCAN_PUTS writes to count the files the
+    other processes wrote.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_DISK_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.total_bytes = None  # Size of the files in the directory as far as this process knows, None until listed
+        self.puts_since_scan = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def path_for(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def get(self, key):
+        path = self.path_for(key)
+        try:
+            array = np.load(path)
+            # Loading counts as a use for the eviction order
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return array
+
+    def put(self, key, array):
+        path = self.path_for(key)
+        if self.total_bytes is None:
+            self.evict()
+        temporary_path = None
+        try:
+            # A file of its own, so that threads and processes writing the same key do not write into each other's
+            descriptor, temporary_path = tempfile.mkstemp(suffix='.tmp', prefix=key + '.', dir=self.directory)
+            with os.fdopen(descriptor, 'wb') as f:
+                np.save(f, array)
+                written = f.tell()
+            replaced = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(temporary_path, path)
+        except OSError as e:
+            logger.warning('Could not write {} to the result cache: {}'.format(path, e))
+            if temporary_path is not None and os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            return
+        self.total_bytes += written - replaced
+        self.puts_since_scan += 1
+        if self.total_bytes > self.max_bytes or self.puts_since_scan >= DISK_RESCAN_PUTS:
+            self.evict()
+
+    def evict(self):
+        """
+        Lists the directory, removes the least recently used files beyond max_bytes and updates the running total
+        """
+        self.puts_since_scan = 0
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.npy'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self.total_bytes = total
+
+
+class ResultCache:
+    """
+    Filter chain results keyed by content: the digest of the source image and every step applied to it, see
+    chain_keys. Results are kept in memory up to max_bytes, least recently used first out, and spilled to a
+    DiskCache in disk_directory when one is given.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MEMORY_BYTES, disk_directory=None, max_disk_bytes=DEFAULT_DISK_BYTES):
+        self.max_bytes = max_bytes
+        self.disk = DiskCache(disk_directory, max_disk_bytes) if disk_directory else None
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the read-only result array stored under key, or None
+        """
+        with self.lock:
+            array = self.entries.get(key)
+            if array is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return array
+        if self.disk is not None:
+            array = self.disk.get(key)
+            if array is not None:
+                # The array was just loaded, so nothing else refers to it
+                self.put(key, array, copy=False)
+                with self.lock:
+                    self.hits += 1
+                    return self.entries.get(key, array)
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, array, persist=False, copy=True):
+        """
+        Stores a result array under key. With persist set it is also written to the disk tier straight away,
+        rather than only when it is evicted from memory. Pass copy=False for an array nothing else refers to.
+        """
+        array = np.array(array) if copy else np.asarray(array)
+        array.flags.writeable = False
+        spilled = []
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key).nbytes
+            if array.nbytes <= self.max_bytes:
+                self.entries[key] = array
+                self.size += array.nbytes
+            else:
+                spilled.append((key, array))
+            while self.size > self.max_bytes:
+                evicted_key, evicted = self.entries.popitem(last=False)
+                self.size -= evicted.nbytes
+                spilled.append((evicted_key, evicted))
+        if self.disk is not None:
+            if persist and key in self.entries:
+                self.disk.put(key, array)
+            for spilled_key, spilled_array in spilled:
+                self.disk.put(spilled_key, spilled_array)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def resize(self, max_bytes):
+        """
+        Changes the memory the results may take, evicting the least recently used ones beyond it
+        """
+        spilled = []
+        with self.lock:
+            self.max_bytes = max_bytes
+            while self.size > self.max_bytes:
+                evicted_key, evicted = self.entries.popitem(last=False)
+                self.size -= evicted.nbytes
+                spilled.append((evicted_key, evicted))
+        if self.disk is not None:
+            for spilled_key, spilled_array in spilled:
+                self.disk.put(spilled_key, spilled_array)
+
+    def put_image(self, key, image, persist=False):
+        """
+        Stores a result given as a PIL image or array, skipping PIL modes that do not round-trip through an array
+        """
+        if isinstance(image, np.ndarray):
+            self.put(key, image, persist=persist)
+        elif image.mode in CACHEABLE_MODES:
+            self.put(key, np.asarray(image), persist=persist, copy=False)
+
+    def run_chain(self, source, source_key, chain, scale=1.0, fuse=False, start=None, persist=False,
+                  intermediates=False, workers=1):
+        """
+        Returns the result of Filter.apply_chain(source, chain, scale, fuse), starting from the longest prefix of
+        chain that is cached. start can give a (steps, image) pair the caller already has, the result of the first
+        steps of chain, to continue from when no longer prefix is cached. With intermediates set, the result after
+        every step is cached rather than only the final one, so that a later chain differing from this one in a
+        single step is computed from that step onwards. With several workers, large images are filtered on that many
+        cores, see parallel.run. Returns the same type as source.
+        """
+        keys = chain_keys(source_key, chain, scale, fuse)
+        done, current = start if start else (0, source)
+        with instrumentation.span('cache lookup', 'cache', steps=len(chain)) as lookup:
+            for steps in range(len(chain), done, -1):
+                cached = self.get(keys[steps - 1])
+                if cached is not None:
+                    done, current = steps, cached
+                    break
+            lookup.annotate(cached_steps=done)
+        logger.debug('Result cache has {} of {} steps, computing the rest'.format(done, len(chain)))
+
+        if done < len(chain) and intermediates and not fuse:
+            context = pipeline.PipelineContext()
+            for index in range(done, len(chain)):
+                step = pipeline.Pipeline.from_chain(chain[index:index + 1], scale)
+                current = parallel.run(step, current, workers, context=context, report_progress=False)
+                self.put_image(keys[index], current, persist=persist)
+                jobs.report_progress((index + 1 - done) / float(len(chain) - done))
+        elif done < len(chain):
+            current = Filter.apply_chain(current, chain[done:], scale, fuse, workers)
+            self.put_image(keys[-1], current, persist=persist)
+
+        if isinstance(source, PIL.Image.Image):
+            return pipeline.to_image(current)
+        return np.array(current)
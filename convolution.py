@@ -0,0 +1,315 @@
+import numpy as np
+
+# Above this many multiply-adds per output pixel the FFT path is cheaper than shifting and summing slices.
+FFT_MIN_TAPS = 96
+# Gaussian blurs with at least this standard deviation are computed on a reduced image by pyramid_gaussian_blur
+PYRAMID_MIN_SIGMA = 8.0
+# pyramid_gaussian_blur halves the image until the blur left to apply would drop below this standard deviation.
+# Smaller values are faster but less accurate.
+PYRAMID_REDUCED_SIGMA = 4.0
+# ... and keeps at least this many pixels on the short side of the reduced image, as the bilinear enlargement of a
+# coarser grid shows, on the small images of the previews and thumbnails
+PYRAMID_MIN_REDUCED_SIZE = 32
+
+BORDER_MODES = {
+    'reflect': 'reflect',
+    'edge': 'edge',
+    'constant': 'constant',
+    'wrap': 'wrap',
+}
+
+
+def next_fast_length(n):
+    """
+    Returns the smallest integer >= n whose only prime factors are 2, 3 and 5, which numpy's FFT handles quickly
+    """
+    best = 2 * n
+    power_5 = 1
+    while power_5 < best:
+        power_35 = power_5
+        while power_35 < best:
+            candidate = power_35
+            while candidate < n:
+                candidate *= 2
+            best = min(best, candidate)
+            power_35 *= 3
+        power_5 *= 5
+    return best
+
+
+def separate(weights, tolerance=1e-6):
+    """
+    Splits a 2-D kernel into a column and a row vector when it has rank one, otherwise returns None
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    if weights.ndim != 2 or min(weights.shape) == 1:
+        return None
+    u, s, vt = np.linalg.svd(weights)
+    if s[0] == 0 or s[1] > tolerance * s[0]:
+        return None
+    scale = np.sqrt(s[0])
+    return u[:, 0] * scale, vt[0, :] * scale
+
+
+def choose_method(weights):
+    """
+    Picks 'separable', 'direct' or 'fft' for the given kernel from a simple cost model
+    """
+    weights = np.asarray(weights)
+    if separate(weights) is not None:
+        method = 'separable'
+        taps = weights.shape[0] + weights.shape[1]
+    else:
+        method = 'direct'
+        taps = np.count_nonzero(weights)
+    return 'fft' if taps > FFT_MIN_TAPS else method
+
+
+def _pad(array, pad_y, pad_x, border):
+    if border not in BORDER_MODES:
+        raise ValueError('Unknown border mode "{}", expected one of {}'.format(border, sorted(BORDER_MODES)))
+    pad_width = [pad_y, pad_x] + [(0, 0)] * (array.ndim - 2)
+    return np.pad(array, pad_width, mode=BORDER_MODES[border])
+
+
+def _correlate_direct(padded, weights, height, width):
+    result = np.zeros((height, width) + padded.shape[2:], dtype=np.float32)
+    for dy in range(weights.shape[0]):
+        for dx in range(weights.shape[1]):
+            weight = weights[dy, dx]
+            if weight:
+                result += np.float32(weight) * padded[dy:dy + height, dx:dx + width]
+    return result
+
+
+def _correlate_separable(padded, column, row, height, width):
+    vertical = np.zeros((height,) + padded.shape[1:], dtype=np.float32)
+    for dy, weight in enumerate(column):
+        if weight:
+            vertical += np.float32(weight) * padded[dy:dy + height]
+    result = np.zeros((height, width) + padded.shape[2:], dtype=np.float32)
+    for dx, weight in enumerate(row):
+        if weight:
+            result += np.float32(weight) * vertical[:, dx:dx + width]
+    return result
+
+
+def _correlate_fft(padded, weights, height, width):
+    fft_shape = (next_fast_length(padded.shape[0]), next_fast_length(padded.shape[1]))
+    # Correlating with the kernel is convolving with the kernel flipped on both axes
+    kernel_ft = np.fft.rfft2(weights[::-1, ::-1].astype(np.float32), s=fft_shape)
+    image_ft = np.fft.rfft2(padded.astype(np.float32), s=fft_shape, axes=(0, 1))
+    if padded.ndim > 2:
+        kernel_ft = kernel_ft.reshape(kernel_ft.shape + (1,) * (padded.ndim - 2))
+    full = np.fft.irfft2(image_ft * kernel_ft, s=fft_shape, axes=(0, 1))
+    top = weights.shape[0] - 1
+    left = weights.shape[1] - 1
+    return full[top:top + height, left:left + width].astype(np.float32)
+
+
+def correlate(array, weights, offset=0.0, border='reflect', method='auto'):
+    """
+    Correlates an (H, W) or (H, W, C) array with a 2-D kernel indexed weights[dy][dx], returning float32 values.
+    Every channel is filtered independently and the border is filled according to border before filtering.
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    if weights.ndim != 2:
+        raise ValueError('Kernel must be 2-D, got shape {}'.format(weights.shape))
+    array = np.asarray(array)
+    height, width = array.shape[:2]
+    kernel_height, kernel_width = weights.shape
+    top = (kernel_height - 1) // 2
+    left = (kernel_width - 1) // 2
+    padded = _pad(array.astype(np.float32, copy=False),
+                  (top, kernel_height - 1 - top), (left, kernel_width - 1 - left), border)
+
+    if method == 'auto':
+        method = choose_method(weights)
+    if method == 'fft':
+        result = _correlate_fft(padded, weights, height, width)
+    elif method == 'separable':
+        vectors = separate(weights)
+        if vectors is None:
+            raise ValueError('Kernel of shape {} is not separable'.format(weights.shape))
+        result = _correlate_separable(padded, vectors[0], vectors[1], height, width)
+    elif method == 'direct':
+        result = _correlate_direct(padded, weights, height, width)
+    else:
+        raise ValueError('Unknown method "{}"'.format(method))
+
+    if offset:
+        result += np.float32(offset)
+    return result
+
+
+def to_uint8(values):
+    """
+    Rounds and clamps float pixel values into a uint8 array
+    """
+    return np.clip(np.rint(values), 0, 255).astype(np.uint8)
+
+
+def _opencv():
+    # OpenCV is only used to speed up uint8 correlation when it is installed
+    try:
+        import cv2
+    except ImportError:
+        return None
+    return cv2
+
+
+def has_opencv():
+    return _opencv() is not None
+
+
+def choose_uint8_method(array, weights, border='reflect'):
+    """
+    Picks the method correlate_uint8 uses for the given input: 'opencv' when cv2.filter2D can do the whole job
+    on uint8 pixels, otherwise the choice of choose_method
+    """
+    array = np.asarray(array)
+    channels = array.shape[2] if array.ndim == 3 else 1
+    if array.dtype == np.uint8 and border == 'reflect' and channels <= 4 and has_opencv():
+        return 'opencv'
+    return choose_method(weights)
+
+
+def correlate_uint8(array, weights, offset=0.0, border='reflect', method='auto'):
+    """
+    Same as correlate, but rounds and clamps the result back into uint8 pixels
+    """
+    if method == 'auto':
+        method = choose_uint8_method(array, weights, border)
+    if method == 'opencv':
+        cv2 = _opencv()
+        # numpy's 'reflect' padding is OpenCV's BORDER_REFLECT_101
+        return cv2.filter2D(np.asarray(array), -1, np.asarray(weights, dtype=np.float32), delta=offset,
+                            borderType=cv2.BORDER_REFLECT_101)
+    return to_uint8(correlate(array, weights, offset=offset, border=border, method=method))
+
+
+def correlate_batch(images, weights, offset=0.0, border='reflect', method='auto'):
+    """
+    Same as correlate for an (N, H, W) or (N, H, W, C) stack of same-sized images. The stack is filtered as one
+    array with the images as extra channels, so every tap costs one pass over the whole stack instead of one per
+    image.
+    """
+    images = np.asarray(images)
+    return np.moveaxis(correlate(np.moveaxis(images, 0, -1), weights, offset=offset, border=border, method=method),
+                       -1, 0)
+
+
+def correlate_uint8_batch(images, weights, offset=0.0, border='reflect', method='auto'):
+    """
+    Same as correlate_uint8 for an (N, H, W) or (N, H, W, C) stack of same-sized images, returning a contiguous
+    uint8 stack. Separable kernels are applied as a row and a column pass.
+    """
+    images = np.asarray(images)
+    if method == 'auto':
+        method = choose_uint8_method(images[0], weights, border)
+    if method != 'opencv':
+        return np.ascontiguousarray(to_uint8(correlate_batch(images, weights, offset=offset, border=border,
+                                                             method=method)))
+
+    cv2 = _opencv()
+    weights = np.asarray(weights, dtype=np.float32)
+    vectors = separate(weights)
+    if vectors is not None:
+        column, row = (vector.astype(np.float32) for vector in vectors)
+    out = np.empty_like(images)
+    # OpenCV filters an image in one vectorized pass and a call costs microseconds, which is less than copying the
+    # stack into one tall image with a border around every image would cost
+    for image, filtered in zip(images, out):
+        if vectors is None:
+            cv2.filter2D(image, -1, weights, dst=filtered, delta=offset, borderType=cv2.BORDER_REFLECT_101)
+        else:
+            cv2.sepFilter2D(image, -1, row, column, dst=filtered, delta=offset, borderType=cv2.BORDER_REFLECT_101)
+    return out
+
+
+def _centre_padding(size, centre):
+    # Zeros to add (before, after) so that centre ends up at index (size - 1) // 2 as correlate expects
+    half = max(centre, size - 1 - centre)
+    return half - centre, half - (size - 1 - centre)
+
+
+def compose(first_weights, first_offset, second_weights, second_offset):
+    """
+    Returns the (weights, offset) pair that has the same effect as correlating with the first pair and then with
+    the second, ignoring the rounding and clamping that would happen in between
+    """
+    first_weights = np.asarray(first_weights, dtype=np.float64)
+    second_weights = np.asarray(second_weights, dtype=np.float64)
+    first_height, first_width = first_weights.shape
+    second_height, second_width = second_weights.shape
+    combined = np.zeros((first_height + second_height - 1, first_width + second_width - 1))
+    for dy in range(second_height):
+        for dx in range(second_width):
+            combined[dy:dy + first_height, dx:dx + first_width] += second_weights[dy, dx] * first_weights
+    centre_y = (first_height - 1) // 2 + (second_height - 1) // 2
+    centre_x = (first_width - 1) // 2 + (second_width - 1) // 2
+    combined = np.pad(combined, [_centre_padding(combined.shape[0], centre_y),
+                                 _centre_padding(combined.shape[1], centre_x)], mode='constant')
+    return combined, first_offset * second_weights.sum() + second_offset
+
+
+def gaussian_kernel(sigma, truncate=3.0):
+    """
+    Returns a normalised 2-D Gaussian kernel reaching truncate standard deviations from the centre
+    """
+    half = max(int(np.ceil(truncate * sigma)), 1)
+    taps = np.exp(-0.5 * (np.arange(-half, half + 1) / float(sigma)) ** 2)
+    taps /= taps.sum()
+    return np.outer(taps, taps)
+
+
+def pyramid_factor(sigma, height=None, width=None):
+    """
+    Returns the power of two pyramid_gaussian_blur reduces an image of the given size by for a blur of sigma. Without
+    a size, returns the factor for images large enough not to limit it, which smaller ones reduce by a divisor of.
+    """
+    factor = 1
+    while sigma / (2 * factor) >= PYRAMID_REDUCED_SIGMA and (
+            height is None or min(height, width) >= 2 * factor * PYRAMID_MIN_REDUCED_SIZE):
+        factor *= 2
+    return factor
+
+
+def pyramid_footprint(sigma):
+    """
+    Returns how many pixels beyond its own position an output pixel of pyramid_gaussian_blur depends on, a multiple
+    of pyramid_factor(sigma). Pieces of an image that start at multiples of the factor and are padded by this halo
+    are blurred exactly as in the whole image: their reduced grids line up with the whole image's, and every piece
+    is at least PYRAMID_MIN_REDUCED_SIZE factors wide where the image is, so it is reduced by the same factor.
+    """
+    factor = pyramid_factor(sigma)
+    # The reduced blur reaches 3 standard deviations, and the averaging, the enlargement and the padding of the last
+    # block each about one reduced pixel more
+    halo = max(int(np.ceil(3 * sigma)) + 4 * factor, PYRAMID_MIN_REDUCED_SIZE * factor)
+    return halo + -halo % factor
+
+
+def pyramid_gaussian_blur(pixels, sigma):
+    """
+    Approximates a Gaussian blur of a uint8 (H, W) or (H, W, C) array with standard deviation sigma in near-constant
+    time: the image is averaged down by a power of two, blurred there with the remaining standard deviation and
+    enlarged again bilinearly, which smooths out the coarser grid as the blur is wide compared to it. Borders are
+    reflected like cv2.BORDER_REFLECT_101. Compared with the exact blur, 99.9% of the pixels are within 4 levels; the
+    largest errors, up to 8 levels, are next to the borders. The mean error is below 1 level while sigma is at most a
+    third of the short side of the image, and up to 1.7 levels for wider blurs, which leave such an image close to
+    flat. Needs OpenCV.
+    """
+    cv2 = _opencv()
+    height, width = pixels.shape[:2]
+    factor = pyramid_factor(sigma, height, width)
+    if factor == 1:
+        return cv2.GaussianBlur(pixels, (0, 0), sigma, borderType=cv2.BORDER_REFLECT_101)
+    # Padding to a multiple of factor keeps the reduced grid aligned with the pixels, so nothing shifts
+    padded = cv2.copyMakeBorder(np.ascontiguousarray(pixels), 0, -height % factor, 0, -width % factor,
+                                cv2.BORDER_REFLECT_101)
+    small = cv2.resize(padded, (padded.shape[1] // factor, padded.shape[0] // factor), interpolation=cv2.INTER_AREA)
+    # Averaging factor x factor blocks and the bilinear enlargement blur by about factor / 2 between them
+    small_sigma = np.sqrt(max(sigma ** 2 - 0.25 * factor ** 2, 0.25 * factor ** 2)) / factor
+    small = cv2.GaussianBlur(small, (0, 0), small_sigma, borderType=cv2.BORDER_REFLECT_101)
+    blurred = cv2.resize(small, (padded.shape[1], padded.shape[0]), interpolation=cv2.INTER_LINEAR)
+    return blurred[:height, :width]
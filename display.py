@@ -0,0 +1,86 @@
+import collections
+import logging
+
+import PIL.Image
+
+logger = logging.getLogger(__name__)
+
+# Levels are halved until they are no larger than this
+MIN_LEVEL_SIZE = 64
+# How many display-sized versions a pyramid remembers, e.g. for the panel size before and after a window resize
+RESIZED_CACHE_SIZE = 2
+
+
+class ImagePyramid:
+    """
+    Successively halved copies of an image, computed on first use, so that display-sized versions are resampled
+    from the smallest level that is still at least as large instead of from the full-size image every time.
+    The image must not be modified while the pyramid is in use.
+    """
+
+    def __init__(self, image):
+        self.levels = [image]
+        self.resized_images = collections.OrderedDict()
+
+    def level_for(self, size):
+        """
+        Returns the smallest level at least size = (width, height) large
+        """
+        width, height = size
+        level = self.levels[-1]
+        while level.width >= 2 * width and level.height >= 2 * height and min(level.size) > MIN_LEVEL_SIZE:
+            try:
+                # reduce() averages 2x2 blocks, which is cheap and does not alias
+                level = level.reduce(2)
+            except ValueError:
+                # Modes such as P can not be averaged and are resized from the full-size image
+                break
+            self.levels.append(level)
+        for level in self.levels:
+            if level.width < 2 * width or level.height < 2 * height:
+                return level
+        return self.levels[-1]
+
+    def resized(self, size):
+        """
+        Returns the image resized to size, resampled from the nearest level and cached
+        """
+        size = tuple(size)
+        if size in self.resized_images:
+            self.resized_images.move_to_end(size)
+            return self.resized_images[size]
+        level = self.level_for(size)
+        logger.debug('Resizing pyramid level of {} x {} to {} x {}'.format(level.width, level.height, *size))
+        resized = level if level.size == size else level.resize(size, PIL.Image.LANCZOS)
+        self.resized_images[size] = resized
+        while len(self.resized_images) > RESIZED_CACHE_SIZE:
+            self.resized_images.popitem(last=False)
+        return resized
+
+
+class PyramidCache:
+    """
+    The pyramids of the last few images displayed. Images are identified by object, as the editor replaces
+    rather than modifies them, so a new image gets a new pyramid and the pyramid of an image that is no longer
+    displayed eventually falls out.
+    """
+
+    def __init__(self, size=4):
+        self.size = size
+        self.pyramids = collections.OrderedDict()
+
+    def pyramid(self, image):
+        key = id(image)
+        entry = self.pyramids.get(key)
+        # The image is kept in the entry, so its id can not be reused while the entry exists
+        if entry is not None and entry[0] is image:
+            self.pyramids.move_to_end(key)
+            return entry[1]
+        pyramid = ImagePyramid(image)
+        self.pyramids[key] = (image, pyramid)
+        while len(self.pyramids) > self.size:
+            self.pyramids.popitem(last=False)
+        return pyramid
+
+    def clear(self):
+        self.pyramids.clear()
@@ -0,0 +1,197 @@
+import collections
+import concurrent.futures
+import functools
+import logging
+import queue
+import time
+import tkinter
+
+import PIL.Image
+from PIL import ImageTk
+
+import instrumentation
+import parallel
+import pipeline
+import registry
+
+logger = logging.getLogger(__name__)
+
+# Longest side of the thumbnails, in pixels
+THUMBNAIL_SIZE = 160
+# Thumbnails per row of the gallery
+COLUMNS = 5
+# How often the gallery picks up finished thumbnails
+POLL_INTERVAL_MS = 50
+
+Thumbnail = collections.namedtuple('Thumbnail', ['name', 'filter_class', 'args', 'image', 'error', 'seconds'])
+
+
+def thumbnail_source(image, size=THUMBNAIL_SIZE):
+    """
+    Returns a copy of image reduced to fit size x size, the image every thumbnail is rendered from
+    """
+    source = image.copy()
+    source.thumbnail((size, size), PIL.Image.LANCZOS)
+    return source
+
+
+def thumbnail_arguments(filter_class, approximate_megapixels=None):
+    """
+    The arguments a filter is previewed and applied with from the gallery: its default parameters, or the working
+    resolution of the approximate mode when that is switched on and the filter has one
+    """
+    args = filter_class().default_parameters()
+    if not args and approximate_megapixels and filter_class.supports_approximation:
+        return [approximate_megapixels]
+    return list(args)
+
+
+def render_thumbnail(source, scale, name, approximate_megapixels=None):
+    """
+    Applies the filter called name to source, which is scale times the size of the image the filter will be applied
+    to, and returns a Thumbnail. Runs on a renderer thread, so a filter's backend is imported there the first time.
+    """
+    start = time.perf_counter()
+    filter_class, args, image, error = None, None, None, None
+    try:
+        with instrumentation.span('thumbnail', 'gallery', filter=name):
+            filter_class = registry.load(name)
+            args = thumbnail_arguments(filter_class, approximate_megapixels)
+            image = pipeline.Pipeline.from_chain([(filter_class, args)], scale=scale).run(source, report_progress=False)
+    except Exception as e:
+        logger.exception('Thumbnail of {} failed'.format(name))
+        error = e
+    return Thumbnail(name, filter_class, args, image, error, time.perf_counter() - start)
+
+
+class ThumbnailRenderer:
+    """
+    Renders thumbnails of many filters at once on a thread pool and hands them out in the order they finish. The
+    thumbnails are small, so threads beat worker processes, which would spend longer receiving the image than
+    filtering it; most filters release the GIL in PIL, NumPy and OpenCV. Starting a new set of thumbnails drops the
+    ones of the previous set that have not started yet and ignores those that are still running.
+    """
+
+    def __init__(self, workers=None):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers or parallel.default_workers(),
+                                                              thread_name_prefix='thumbnail')
+        self.finished = queue.Queue()
+        self.generation = 0
+        self.futures = []
+
+    def start(self, source, scale, names, approximate_megapixels=None):
+        """
+        Starts rendering a thumbnail of every filter in names from source
+        """
+        self.cancel()
+        generation = self.generation
+        for name in names:
+            future = self.executor.submit(render_thumbnail, source, scale, name, approximate_megapixels)
+            future.add_done_callback(functools.partial(self._put, generation))
+            self.futures.append(future)
+
+    def _put(self, generation, future):
+        if not future.cancelled():
+            self.finished.put((generation, future.result()))
+
+    def cancel(self):
+        self.generation += 1
+        for future in self.futures:
+            future.cancel()
+        self.futures = []
+
+    def take_finished(self):
+        """
+        Returns the thumbnails of the current set that finished since the last call
+        """
+        thumbnails = []
+        while True:
+            try:
+                generation, thumbnail = self.finished.get_nowait()
+            except queue.Empty:
+                return thumbnails
+            if generation == self.generation:
+                thumbnails.append(thumbnail)
+
+    def shutdown(self):
+        self.cancel()
+        self.executor.shutdown(wait=False)
+
+
+class GalleryWindow(tkinter.Toplevel):
+    """
+    A grid with a thumbnail of every filter applied to the current image. The thumbnails are rendered in parallel
+    and shown as they finish; clicking one calls on_choose with the filter class and its arguments.
+    """
+
+    def __init__(self, master, filter_names, on_choose):
+        tkinter.Toplevel.__init__(self, master)
+        self.title('Filters')
+        self.filter_names = list(filter_names)
+        self.on_choose = on_choose
+        self.renderer = ThumbnailRenderer()
+        self.key = None  # What the current thumbnails show, so showing the same state again renders nothing
+        self.thumbnails = {}  # filter name -> Thumbnail of the current set
+        self.photos = {}  # filter name -> Tk image, which has to be kept referenced while shown
+        self.pending = 0
+        self.started = None
+        self.poll_after_id = None
+        # A blank image keeps the buttons at thumbnail size until their thumbnails arrive
+        self.placeholder = tkinter.PhotoImage(master=self, width=THUMBNAIL_SIZE, height=THUMBNAIL_SIZE)
+        self.buttons = collections.OrderedDict()
+        for index, name in enumerate(self.filter_names):
+            button = tkinter.Button(self, text=name, image=self.placeholder, compound=tkinter.TOP,
+                                    state=tkinter.DISABLED, command=functools.partial(self.choose, name))
+            button.grid(row=index // COLUMNS, column=index % COLUMNS)
+            self.buttons[name] = button
+        self.protocol('WM_DELETE_WINDOW', self.close)
+
+    def show(self, image, full_width, key, approximate_megapixels=None):
+        """
+        Renders the thumbnails of image, a reduced version of an image full_width pixels wide, unless the gallery
+        already shows the state identified by key
+        """
+        if key == self.key:
+            return
+        self.key = key
+        source = thumbnail_source(image)
+        self.thumbnails = {}
+        for name, button in self.buttons.items():
+            button.configure(text='{}\n...'.format(name), state=tkinter.DISABLED)
+        self.pending = len(self.filter_names)
+        self.started = time.perf_counter()
+        self.renderer.start(source, source.width / float(full_width), self.filter_names, approximate_megapixels)
+        if self.poll_after_id is None:
+            self.poll_after_id = self.after(POLL_INTERVAL_MS, self.poll)
+
+    def poll(self):
+        self.poll_after_id = None
+        for thumbnail in self.renderer.take_finished():
+            self.pending -= 1
+            self.thumbnails[thumbnail.name] = thumbnail
+            button = self.buttons[thumbnail.name]
+            if thumbnail.error is not None:
+                button.configure(text='{}\nfailed'.format(thumbnail.name))
+                continue
+            self.photos[thumbnail.name] = ImageTk.PhotoImage(thumbnail.image)
+            button.configure(image=self.photos[thumbnail.name], state=tkinter.NORMAL,
+                             text='{} ({:.0f} ms)'.format(thumbnail.name, thumbnail.seconds * 1000))
+        if self.pending > 0:
+            self.title('Filters ({} of {})'.format(len(self.filter_names) - self.pending, len(self.filter_names)))
+            self.poll_after_id = self.after(POLL_INTERVAL_MS, self.poll)
+        else:
+            self.title('Filters')
+            logger.debug('Rendered {} thumbnails in {:.2f} s'.format(len(self.thumbnails),
+                                                                      time.perf_counter() - self.started))
+
+    def choose(self, name):
+        thumbnail = self.thumbnails.get(name)
+        if thumbnail is not None and thumbnail.error is None:
+            self.on_choose(thumbnail.filter_class, thumbnail.args)
+
+    def close(self):
+        if self.poll_after_id is not None:
+            self.after_cancel(self.poll_after_id)
+            self.poll_after_id = None
+        self.renderer.shutdown()
+        self.destroy()
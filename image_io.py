@@ -0,0 +1,303 @@
+import collections
+import concurrent.futures
+import io
+import logging
+import os
+import threading
+import time
+
+import PIL.Image
+import numpy as np
+
+import instrumentation
+import registry
+
+logger = logging.getLogger(__name__)
+
+# The modes the filters work on. Other modes are converted to RGB, or to RGBA when they have transparency.
+FILTER_MODES = ('L', 'RGB', 'RGBA')
+# Files next_path steps through when looking for the next image in a directory
+IMAGE_EXTENSIONS = ('.bmp', '.gif', '.jpeg', '.jpg', '.npy', '.pbm', '.pgm', '.png', '.ppm', '.tif', '.tiff', '.webp')
+# Uncompressed pixel layouts PIL decodes with its 'raw' decoder that a memory map can expose without copying, as
+# the image mode, the bytes per pixel and the bytes of each pixel to take in RGB(A) order
+RAW_LAYOUTS = {
+    'L': ('L', 1, None),
+    'RGB': ('RGB', 3, np.s_[:]),
+    'RGBA': ('RGBA', 4, np.s_[:]),
+    'RGBX': ('RGB', 4, np.s_[:3]),
+    'BGR': ('RGB', 3, np.s_[::-1]),
+    'BGRX': ('RGB', 4, np.s_[2::-1]),
+}
+# How many images a Prefetcher keeps decoded ahead
+PREFETCH_COUNT = 2
+# The encoder options save_image passes on for each format, others are left at the encoder's defaults
+ENCODER_OPTIONS = {
+    'JPEG': ('quality', 'optimize', 'progressive'),
+    'PNG': ('compress_level', 'optimize'),
+    'WEBP': ('quality',),
+}
+# Formats that can not store an alpha channel, RGBA images are saved as RGB in them
+OPAQUE_FORMATS = ('JPEG', 'BMP', 'PPM')
+
+SavedImage = collections.namedtuple('SavedImage', ['path', 'size_bytes', 'seconds', 'backend'])
+
+
+def to_filter_mode(image):
+    """
+    Converts a PIL image to one of FILTER_MODES, keeping transparency, unless it already is in one
+    """
+    if image.mode in FILTER_MODES:
+        return image
+    if image.mode in ('LA', 'La', 'PA', 'RGBa') or 'transparency' in image.info:
+        return image.convert('RGBA')
+    return image.convert('RGB')
+
+
+def read_image(path, size=None):
+    """
+    Decodes the image at path into a uint8 PIL image in one of FILTER_MODES. With size = (width, height), a JPEG
+    is decoded at the largest reduction by 2, 4 or 8 that still covers that size, which is several times faster
+    when only a preview or a thumbnail is needed. The image then has to be resized to size by the caller. Other
+    formats are always decoded at full size.
+    """
+    if path.lower().endswith('.npy'):
+        return PIL.Image.fromarray(np.asarray(read_array(path)))
+    image = PIL.Image.open(path)
+    if size is not None:
+        # Only the JPEG decoder can skip detail, draft() does nothing for other formats
+        image.draft(None, tuple(size))
+    image.load()
+    return to_filter_mode(image)
+
+
+def _map_raw(path, image):
+    # Returns a read-only memory map of the pixels of an uncompressed image, or None when they are not stored in
+    # one of RAW_LAYOUTS in a single block
+    if len(image.tile) != 1:
+        return None
+    codec, extents, offset, args = image.tile[0][:4]
+    if codec != 'raw' or tuple(extents) != (0, 0) + image.size:
+        return None
+    # The raw decoder takes the raw mode, the bytes per row and 1 or -1 for rows stored top down or bottom up
+    args = (args,) if isinstance(args, str) else tuple(args)
+    raw_mode = args[0]
+    stride = args[1] if len(args) > 1 else 0
+    orientation = args[2] if len(args) > 2 else 1
+    layout = RAW_LAYOUTS.get(raw_mode)
+    if layout is None or layout[0] != image.mode:
+        return None
+    _, pixel_bytes, channels = layout
+    width, height = image.size
+    try:
+        rows = np.memmap(path, dtype=np.uint8, mode='r', offset=offset, shape=(height, stride or width * pixel_bytes))
+    except ValueError:
+        # The file is shorter than its header says
+        return None
+    pixels = rows[:, :width * pixel_bytes]
+    if orientation < 0:
+        pixels = pixels[::-1]
+    if channels is None:
+        return pixels
+    return pixels.reshape(height, width, pixel_bytes)[..., channels]
+
+
+def read_array(path):
+    """
+    Returns the pixels of the image at path as a read-only uint8 (H, W) or (H, W, C) array. .npy files and
+    uncompressed PPM, PGM, BMP and TIFF files are memory-mapped, so only the rows that are used are read from disk.
+    Other files are decoded with read_image.
+    """
+    if path.lower().endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    with PIL.Image.open(path) as image:
+        pixels = _map_raw(path, image)
+    if pixels is not None:
+        logger.debug('Memory-mapped the pixels of {}'.format(path))
+        return pixels
+    return np.asarray(read_image(path))
+
+
+def next_path(path, step=1):
+    """
+    Returns the path of the image step places after path in its directory, sorted by name, or None when there is
+    none. A negative step goes back.
+    """
+    directory, name = os.path.split(path)
+    try:
+        names = sorted(entry for entry in os.listdir(directory or '.') if entry.lower().endswith(IMAGE_EXTENSIONS))
+    except OSError:
+        return None
+    if name not in names:
+        return None
+    index = names.index(name) + step
+    if 0 <= index < len(names):
+        return os.path.join(directory, names[index])
+    return None
+
+
+class Prefetcher:
+    """
+    Reads images with read_image, and decodes the images after and before the last one read in a background thread,
+    so that stepping through a directory does not wait for the decoder. Images changed on disk since they were
+    prefetched are read again.
+    """
+
+    def __init__(self, count=PREFETCH_COUNT):
+        self.count = count
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='prefetch')
+        self.lock = threading.Lock()
+        self.prefetched = collections.OrderedDict()  # path -> (modification time, future of the image)
+        self.hits = 0
+        self.misses = 0
+
+    def read(self, path):
+        """
+        Returns the image at path, waiting for its prefetch if there is one, and starts prefetching its neighbours
+        """
+        with self.lock:
+            entry = self.prefetched.pop(path, None)
+        image = None
+        if entry is not None and entry[0] == _modification_time(path):
+            try:
+                image = entry[1].result()
+            except Exception as e:
+                logger.debug('Prefetching {} failed: {}'.format(path, e))
+        if image is None:
+            self.misses += 1
+            image = read_image(path)
+        else:
+            self.hits += 1
+        for step in (1, -1):
+            self.prefetch(next_path(path, step))
+        return image
+
+    def read_preview(self, path, size):
+        """
+        Returns the image at path for a first display at size = (width, height): the full image when its prefetch
+        has finished, otherwise a JPEG decoded at a reduced size covering size, see read_image. The full image is
+        still read with read.
+        """
+        with self.lock:
+            entry = self.prefetched.get(path)
+        if entry is not None and entry[1].done() and not entry[1].exception() and entry[0] == _modification_time(path):
+            return entry[1].result()
+        return read_image(path, size)
+
+    def prefetch(self, path):
+        """
+        Starts decoding the image at path in the background, dropping the oldest prefetched images beyond count
+        """
+        if path is None:
+            return
+        with self.lock:
+            if path in self.prefetched:
+                self.prefetched.move_to_end(path)
+                return
+            logger.debug('Prefetching {}'.format(path))
+            self.prefetched[path] = (_modification_time(path), self.executor.submit(read_image, path))
+            while len(self.prefetched) > self.count:
+                _, (_, future) = self.prefetched.popitem(last=False)
+                future.cancel()
+
+    def shutdown(self):
+        with self.lock:
+            for _, future in self.prefetched.values():
+                future.cancel()
+            self.prefetched.clear()
+        self.executor.shutdown(wait=False)
+
+
+def _modification_time(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def format_for(path):
+    """
+    Returns PIL's name for the image format of path, such as 'JPEG', from its extension
+    """
+    PIL.Image.init()
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in PIL.Image.EXTENSION:
+        raise ValueError('Unknown image file extension "{}"'.format(extension))
+    return PIL.Image.EXTENSION[extension]
+
+
+def encoder_options(path):
+    """
+    Returns the names of the save_image options that the format of path uses
+    """
+    return ENCODER_OPTIONS.get(format_for(path), ())
+
+
+def _encode_pil(image, image_format, options):
+    buffer = io.BytesIO()
+    image.save(buffer, image_format, **options)
+    return buffer.getvalue()
+
+
+def _encode_opencv(image, path, options):
+    import cv2
+
+    flags = {
+        'quality': cv2.IMWRITE_WEBP_QUALITY if format_for(path) == 'WEBP' else cv2.IMWRITE_JPEG_QUALITY,
+        'compress_level': cv2.IMWRITE_PNG_COMPRESSION,
+        'optimize': cv2.IMWRITE_JPEG_OPTIMIZE,
+        'progressive': cv2.IMWRITE_JPEG_PROGRESSIVE,
+    }
+    parameters = []
+    for name, value in options.items():
+        if name == 'optimize' and format_for(path) != 'JPEG':
+            continue
+        parameters += [flags[name], int(value)]
+    pixels = np.asarray(image)
+    if pixels.ndim == 3:
+        pixels = cv2.cvtColor(pixels, cv2.COLOR_RGBA2BGRA if pixels.shape[2] == 4 else cv2.COLOR_RGB2BGR)
+    succeeded, encoded = cv2.imencode(os.path.splitext(path)[1], pixels, parameters)
+    if not succeeded:
+        raise ValueError('OpenCV could not encode {}'.format(path))
+    return encoded.tobytes()
+
+
+def save_image(image, path, quality=None, compress_level=None, optimize=False, progressive=False,
+               backend=registry.PIL_BACKEND):
+    """
+    Encodes a PIL image or uint8 array into path with Pillow, or with OpenCV for backend 'opencv', in the format of
+    its extension. quality (1-100) applies to JPEG and WebP, compress_level (0-9) to PNG, optimize to JPEG and PNG
+    and progressive to JPEG; options the format does not have are ignored and None leaves the encoder's default.
+    The file is written under a temporary name and renamed when complete, so a failed save leaves no partial file.
+    Returns a SavedImage with the size of the file and the seconds spent encoding and writing it.
+    """
+    start = time.perf_counter()
+    image = to_filter_mode(image if isinstance(image, PIL.Image.Image) else PIL.Image.fromarray(np.asarray(image)))
+    image_format = format_for(path)
+    if image_format in OPAQUE_FORMATS and image.mode == 'RGBA':
+        image = image.convert('RGB')
+    given = {'quality': quality, 'compress_level': compress_level, 'optimize': optimize, 'progressive': progressive}
+    options = {name: given[name] for name in ENCODER_OPTIONS.get(image_format, ())
+               if given[name] is not None and given[name] is not False}
+
+    with instrumentation.span('encode', 'io', format=image_format, backend=backend) as encode_span:
+        if backend == registry.OPENCV_BACKEND:
+            data = _encode_opencv(image, path, options)
+        elif backend == registry.PIL_BACKEND:
+            data = _encode_pil(image, image_format, options)
+        else:
+            raise ValueError('Unknown encoder backend "{}"'.format(backend))
+        encode_span.annotate(bytes=len(data))
+
+    temporary_path = '{}.{}.saving'.format(path, os.getpid())
+    try:
+        with open(temporary_path, 'wb') as f:
+            f.write(data)
+        os.replace(temporary_path, path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+    seconds = time.perf_counter() - start
+    logger.debug('Saved {} x {} {} image to {}: {:.1f} KB in {:.0f} ms with {}'.format(
+        image.width, image.height, image_format, path, len(data) / 1024.0, seconds * 1000, backend))
+    return SavedImage(path, len(data), seconds, backend)
@@ -0,0 +1,191 @@
+import atexit
+import collections
+import json
+import logging
+import multiprocessing
+import multiprocessing.util
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Records spans from startup when set to a path, and writes them there as a Chrome trace when the process exits.
+# Worker processes write to the path with their process id added.
+TRACE_PATH_VARIABLE = 'FILTER_IMAGES_TRACE'
+# Logs every span as JSON when set to anything but an empty string
+TRACE_LOG_VARIABLE = 'FILTER_IMAGES_TRACE_LOG'
+# The oldest spans are dropped beyond this many
+MAX_SPANS = 100000
+
+Span = collections.namedtuple('Span', ['name', 'category', 'start_ns', 'duration_ns', 'process_id', 'thread_id',
+                                       'thread_name', 'args'])
+
+_enabled = False
+_log_spans = False
+_spans = collections.deque(maxlen=MAX_SPANS)
+_trace_paths = set()
+
+
+class _NullSpan:
+    """
+    What span() returns while instrumentation is disabled, so a disabled span costs one call and no allocation
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+    def annotate(self, **args):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _TimedSpan:
+    __slots__ = ('name', 'category', 'args', 'start_ns')
+
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+        self.start_ns = None
+
+    def __enter__(self):
+        self.start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        duration_ns = time.perf_counter_ns() - self.start_ns
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        record(Span(self.name, self.category, self.start_ns, duration_ns, os.getpid(), threading.get_ident(),
+                    threading.current_thread().name, self.args))
+        return False
+
+    def annotate(self, **args):
+        """
+        Adds arguments, such as sizes only known once the work is done, to the span
+        """
+        self.args.update(args)
+
+
+def span(name, category='app', **args):
+    """
+    Returns a context manager that times the code it wraps as a span called name, with args as details. While
+    instrumentation is disabled it does nothing.
+    """
+    if not _enabled:
+        return _NULL_SPAN
+    return _TimedSpan(name, category, args)
+
+
+def record(finished_span):
+    _spans.append(finished_span)
+    if _log_spans:
+        logger.info(json.dumps({
+            'span': finished_span.name,
+            'category': finished_span.category,
+            'ms': round(finished_span.duration_ns / 1e6, 3),
+            'thread': finished_span.thread_name,
+            'args': finished_span.args,
+        }, default=str))
+
+
+def is_enabled():
+    return _enabled
+
+
+def enable(log=False, trace_path=None):
+    """
+    Starts recording spans. With log set, every span is also logged as a JSON message through the instrumentation
+    logger, so it ends up wherever utils.setup_logger_to_console_file sends the log. With a trace_path, the spans are
+    written there as a Chrome trace when the process exits.
+    """
+    global _enabled, _log_spans
+    _enabled = True
+    _log_spans = log
+    if trace_path and trace_path not in _trace_paths:
+        _trace_paths.add(trace_path)
+        if multiprocessing.parent_process() is None:
+            atexit.register(write_at_exit, trace_path)
+        else:
+            # Worker processes skip atexit handlers, but run multiprocessing's finalizers
+            root, extension = os.path.splitext(trace_path)
+            multiprocessing.util.Finalize(None, write_at_exit,
+                                          args=('{}.{}{}'.format(root, os.getpid(), extension),), exitpriority=0)
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def clear():
+    _spans.clear()
+
+
+def spans():
+    return list(_spans)
+
+
+def summary():
+    """
+    Returns the count, total, mean and longest duration in milliseconds of the recorded spans, by name
+    """
+    durations = collections.OrderedDict()
+    for recorded in spans():
+        durations.setdefault((recorded.category, recorded.name), []).append(recorded.duration_ns / 1e6)
+    return collections.OrderedDict(
+        (key, {'count': len(values), 'total_ms': sum(values), 'mean_ms': sum(values) / len(values),
+               'max_ms': max(values)})
+        for key, values in sorted(durations.items(), key=lambda item: -sum(item[1])))
+
+
+def report_summary():
+    for (category, name), stats in summary().items():
+        logger.info('{:<8} {:<32} {:6d} x  {:10.1f} ms total  {:9.2f} ms mean  {:9.2f} ms max'.format(
+            category, name, stats['count'], stats['total_ms'], stats['mean_ms'], stats['max_ms']))
+
+
+def chrome_trace():
+    """
+    Returns the recorded spans in the Chrome trace event format, for chrome://tracing or https://ui.perfetto.dev
+    """
+    events = []
+    threads = {}
+    for recorded in spans():
+        threads[(recorded.process_id, recorded.thread_id)] = recorded.thread_name
+        events.append({
+            'name': recorded.name,
+            'cat': recorded.category,
+            'ph': 'X',
+            'ts': recorded.start_ns / 1000.0,
+            'dur': recorded.duration_ns / 1000.0,
+            'pid': recorded.process_id,
+            'tid': recorded.thread_id,
+            'args': {key: value if isinstance(value, (int, float, bool)) else str(value)
+                     for key, value in recorded.args.items()},
+        })
+    for (process_id, thread_id), thread_name in threads.items():
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': process_id, 'tid': thread_id,
+                       'args': {'name': thread_name}})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def write_chrome_trace(path):
+    with open(path, 'w') as f:
+        json.dump(chrome_trace(), f)
+    logger.info('Wrote {} spans to {}'.format(len(_spans), path))
+
+
+def write_at_exit(path):
+    report_summary()
+    write_chrome_trace(path)
+
+
+if os.environ.get(TRACE_PATH_VARIABLE) or os.environ.get(TRACE_LOG_VARIABLE):
+    enable(log=bool(os.environ.get(TRACE_LOG_VARIABLE)), trace_path=os.environ.get(TRACE_PATH_VARIABLE))
@@ -0,0 +1,151 @@
+import concurrent.futures
+import logging
+import queue
+import threading
+
+import instrumentation
+
+logger = logging.getLogger(__name__)
+
+_current = threading.local()
+
+
+class JobCancelled(Exception):
+    """
+    Raised inside a job's worker thread when the job has been cancelled or superseded
+    """
+    pass
+
+
+class Job:
+    """
+    A unit of work run by JobRunner. The function runs on the worker thread, while the callbacks are called on the
+    Tk thread.
+    """
+
+    def __init__(self, function, on_done, on_error=None, on_progress=None, description=None):
+        self.function = function
+        self.on_done = on_done
+        self.on_error = on_error
+        self.on_progress = on_progress
+        self.description = description
+        self.cancelled = threading.Event()
+        self.messages = None
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def check_cancelled(self):
+        if self.cancelled.is_set():
+            raise JobCancelled(self.description)
+
+    def report_progress(self, fraction):
+        self.check_cancelled()
+        if self.messages is not None:
+            self.messages.put((self, 'progress', fraction))
+
+    def run(self):
+        _current.job = self
+        try:
+            self.check_cancelled()
+            with instrumentation.span(self.description or 'job', 'job'):
+                result = self.function()
+            self.check_cancelled()
+            self.messages.put((self, 'done', result))
+        except JobCancelled:
+            logger.debug('Cancelled job {}'.format(self.description))
+        except Exception as e:
+            logger.exception('Job {} failed'.format(self.description))
+            self.messages.put((self, 'error', e))
+        finally:
+            _current.job = None
+
+
+def current_job():
+    """
+    Returns the job running on this thread, or None when not called from a job
+    """
+    return getattr(_current, 'job', None)
+
+
+def report_progress(fraction):
+    """
+    Reports progress of the job running on this thread, and raises JobCancelled if it was cancelled.
+    Does nothing when not called from a job, so filters can call it unconditionally.
+    """
+    job = current_job()
+    if job is not None:
+        job.report_progress(fraction)
+
+
+class JobRunner:
+    """
+    Runs jobs one at a time on a background thread and passes their results back to the Tk thread with after().
+    Submitting a new job cancels the previous one, and anything the stale job still reports is ignored. With
+    supersede off, jobs instead wait for the ones submitted before them, and every one of them reports back, as for
+    saves that must all happen.
+    """
+
+    def __init__(self, widget, poll_interval=50, supersede=True):
+        self.widget = widget
+        self.poll_interval = poll_interval
+        self.supersede = supersede
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.messages = queue.Queue()
+        self.jobs = []  # Jobs submitted and not yet reported back, oldest first
+        self.polling = False
+
+    def submit(self, function, on_done, on_error=None, on_progress=None, description=None):
+        """
+        Cancels the running job, if any and supersede is on, and queues a new one
+        """
+        if self.supersede:
+            self.cancel()
+        job = Job(function, on_done, on_error=on_error, on_progress=on_progress, description=description)
+        job.messages = self.messages
+        self.jobs.append(job)
+        self.executor.submit(job.run)
+        if not self.polling:
+            self.polling = True
+            self.widget.after(self.poll_interval, self.poll)
+        return job
+
+    def cancel(self):
+        """
+        Cancels the running job and any queued ones
+        """
+        for job in self.jobs:
+            logger.debug('Cancelling job {}'.format(job.description))
+            job.cancel()
+        self.jobs = []
+
+    def is_busy(self):
+        return bool(self.jobs)
+
+    def poll(self):
+        while True:
+            try:
+                job, kind, payload = self.messages.get_nowait()
+            except queue.Empty:
+                break
+            if job not in self.jobs:
+                continue
+            if kind == 'progress':
+                if job.on_progress:
+                    job.on_progress(payload)
+                continue
+            self.jobs.remove(job)
+            with instrumentation.span('{} callback'.format(job.description or 'job'), 'ui'):
+                if kind == 'done':
+                    job.on_done(payload)
+                elif job.on_error:
+                    job.on_error(payload)
+
+        if self.jobs:
+            self.widget.after(self.poll_interval, self.poll)
+        else:
+            self.polling = False
+
+    def shutdown(self):
+        self.cancel()
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,103 @@
+import functools
+
+import numpy as np
+
+
+def identity_table():
+    return np.arange(256, dtype=np.uint8)
+
+
+def compose(first, second):
+    """
+    Returns the table that applies first and then second. Each table is either a (256,) table for all colour
+    channels or a (C, 256) table with one row per channel.
+    """
+    first = np.asarray(first)
+    second = np.asarray(second)
+    if second.ndim == 1:
+        return second[first]
+    if first.ndim == 1:
+        return second[:, first]
+    if len(first) != len(second):
+        raise ValueError('Can not compose tables for {} and {} channels'.format(len(first), len(second)))
+    return np.take_along_axis(second, first.astype(np.intp), axis=1)
+
+
+def apply_table(pixels, table, out=None):
+    """
+    Maps the colour channels of a uint8 (H, W) or (H, W, C) array through a lookup table, leaving an alpha channel
+    as is. Pass out=pixels to map the array in place.
+    """
+    table = np.asarray(table)
+    if out is None:
+        out = np.array(pixels)
+    if pixels.ndim == 2:
+        np.take(table if table.ndim == 1 else table[0], pixels, out=out)
+        return out
+    colour_channels = 3 if pixels.shape[-1] == 4 else pixels.shape[-1]
+    for channel in range(colour_channels):
+        channel_table = table if table.ndim == 1 else table[channel]
+        out[..., channel] = channel_table[pixels[..., channel]]
+    return out
+
+
+def apply_table_batch(images, table):
+    """
+    Same as apply_table for an (N, H, W) or (N, H, W, C) stack of same-sized images, mapping the whole stack in one
+    pass per channel
+    """
+    out = np.array(images)
+    if out.ndim == 3:
+        # A stack of single channel images is mapped like one tall single channel image
+        apply_table(out.reshape(-1, out.shape[2]), table, out=out.reshape(-1, out.shape[2]))
+        return out
+    return apply_table(out, table, out=out)
+
+
+@functools.lru_cache(maxsize=64)
+def _curve_table(values, bits):
+    levels = 1 << bits
+    curve = np.interp(np.linspace(0, 1, levels), np.linspace(0, 1, len(values)), values)
+    table = np.clip(np.rint(curve * (levels - 1)), 0, levels - 1).astype(np.uint8 if bits == 8 else np.uint16)
+    table.flags.writeable = False
+    return table
+
+
+def curve_table(values, bits=8):
+    """
+    Returns the lookup table for a tone curve given as control points in [0, 1], spaced evenly over the input range
+    like Filter.channel_adjust expects. Tables have 256 entries for 8-bit channels and 65536 for 16-bit channels,
+    and are cached, so they are only computed once per curve.
+    """
+    return _curve_table(tuple(float(value) for value in values), bits)
+
+
+def offset_table(amount, bits=8):
+    """
+    Returns the lookup table that adds amount, as a fraction of the full range, and clamps
+    """
+    return _offset_table(float(amount), bits)
+
+
+@functools.lru_cache(maxsize=64)
+def _offset_table(amount, bits):
+    levels = 1 << bits
+    values = np.arange(levels) + int(round(amount * (levels - 1)))
+    table = np.clip(values, 0, levels - 1).astype(np.uint8 if bits == 8 else np.uint16)
+    table.flags.writeable = False
+    return table
+
+
+def table_bits(dtype):
+    """
+    Returns 8 or 16 for the integer channel types lookup tables can be applied to, or None otherwise
+    """
+    return {np.dtype(np.uint8): 8, np.dtype(np.uint16): 16}.get(np.dtype(dtype))
+
+
+def apply_channel_table(channel, table):
+    """
+    Maps a single uint8 or uint16 channel, which may be a view into an image, through a lookup table in place
+    """
+    channel[...] = table[channel]
+    return channel
@@ -1,21 +1,47 @@
 # Simple enough, just import everything from tkinter.
 import functools
 import logging
+import os
+import time
 import tkinter
-from tkinter import filedialog
+from tkinter import filedialog, simpledialog
 
-from PIL import Image, ImageTk
+from PIL import ImageTk
 
 import utils
-import Filter
-import CV2Filters
+import cache
+import display
+import gallery
+import image_io
+import instrumentation
+import jobs
+import parallel
+import registry
+import undo
 
 logger = logging.getLogger(__name__)
 
+# How long the editor has to be idle before a chain applied in preview mode is rendered at full resolution
+FULL_RENDER_DELAY_MS = 1500
+# The undo history keeps the full-size image at most every this many steps and recomputes the states in between
+UNDO_CHECKPOINT_INTERVAL = 5
+# Memory the undo history may take: the compressed checkpoints and the result cache together, the cache gets what the
+# checkpoints leave over
+UNDO_MEMORY_BYTES = 512 * 1024 * 1024
+# How long the window size has to stay the same before the images are resized to it
+RESIZE_DELAY_MS = 100
+# Working resolution of the filters that support an approximate mode, when it is switched on
+APPROXIMATE_MEGAPIXELS = 2.0
+# Encoder settings offered when saving, see image_io.save_image
+SAVE_QUALITY = 92
+SAVE_COMPRESS_LEVEL = 6
+SAVE_OPTIMIZE = True
+SAVE_PROGRESSIVE = False
+
 
 class ButtonBar(tkinter.Frame):
 
-    def __init__(self, master, filter_map):
+    def __init__(self, master, filter_names):
         tkinter.Frame.__init__(self, master)
         # creating a button instance
         select_file_button = tkinter.Button(self, text="Open", command=self.master.open, padx=10)
@@ -25,16 +51,35 @@ class ButtonBar(tkinter.Frame):
         save_filter_button = tkinter.Button(self, padx=10, text="Save ...",
                                             command=self.master.save_file)
         save_filter_button.grid(row=0, column=1)
-        reset_button = tkinter.Button(self, padx=10, text="Undo",
+        undo_button = tkinter.Button(self, padx=10, text="Undo", command=self.master.undo)
+        undo_button.grid(row=0, column=2)
+        reset_button = tkinter.Button(self, padx=10, text="Reset",
                                             command=self.master.reset_modified_image)
-        reset_button.grid(row=0, column=2)
+        reset_button.grid(row=1, column=0)
+        redo_button = tkinter.Button(self, padx=10, text="Redo", command=self.master.redo)
+        redo_button.grid(row=1, column=1)
+        cancel_button = tkinter.Button(self, padx=10, text="Cancel", command=self.master.cancel_button_pressed)
+        cancel_button.grid(row=1, column=2)
+        preview_button = tkinter.Checkbutton(self, text="Preview", variable=self.master.preview_mode,
+                                             command=self.master.preview_mode_changed)
+        preview_button.grid(row=2, column=0, columnspan=3)
+        approximate_button = tkinter.Checkbutton(self, text="Fast approximate", variable=self.master.approximate_mode)
+        approximate_button.grid(row=3, column=0, columnspan=3)
+        previous_button = tkinter.Button(self, padx=10, text="< Previous",
+                                         command=functools.partial(self.master.open_neighbour, -1))
+        previous_button.grid(row=4, column=0)
+        next_button = tkinter.Button(self, padx=10, text="Next >",
+                                     command=functools.partial(self.master.open_neighbour, 1))
+        next_button.grid(row=4, column=1)
+        gallery_button = tkinter.Button(self, padx=10, text="Gallery", command=self.master.open_gallery)
+        gallery_button.grid(row=4, column=2)
         row_index = 0
         column_index = 3
-        for (filter_name, filter_class) in filter_map.items():
+        for filter_name in filter_names:
             logger.debug('Creating button for {} with column index {}'.format(filter_name, column_index))
             filter_button = tkinter.Button(self, padx=10, text=filter_name,
-                                           command=functools.partial(self.master.apply_and_show_filter, filter_name,
-                                                                     filter_class))
+                                           command=functools.partial(self.master.apply_registered_filter,
+                                                                     filter_name))
             filter_button.grid(row=row_index, column=column_index)
             column_index += 1
             if column_index > 9:
@@ -53,7 +98,8 @@ class Window(tkinter.Frame):
     # Define settings upon initialization. Here you can specify
     def __init__(self, master=None):
 
-        self.filter_map = {x.name: x for x in Filter.Filter.__subclasses__()}
+        # Only the names, the filter classes and their backends are imported when a filter is first applied
+        self.filter_names = registry.filter_names()
 
         # parameters that you want to send through the Frame class.
         tkinter.Frame.__init__(self, master)
@@ -61,10 +107,17 @@ class Window(tkinter.Frame):
         # reference to the master widget, which is the tk window
         self.master = master
 
-        button_bar = ButtonBar(self, self.filter_map)
+        # When set, filters are applied to a display-sized proxy first and to the full-size image when idle
+        self.preview_mode = tkinter.BooleanVar(master, value=True)
+        # Runs the slow edge-preserving filters at a reduced working resolution, see CV2Filters.working_scale
+        self.approximate_mode = tkinter.BooleanVar(master, value=False)
+
+        button_bar = ButtonBar(self, self.filter_names)
         button_bar.pack()
 
         self.selected_path = None
+        # Reads the images opened, decoding the ones next to them in their directory in the background
+        self.image_reader = image_io.Prefetcher()
 
         self.displayed_image_width = 0
         self.displayed_image_height = 0
@@ -74,6 +127,30 @@ class Window(tkinter.Frame):
         self.modified_image = None  # Used to keep the actual modified image as read from the file
         self.modified_resized_image = None  # Used to keep the actual modified image
         self.modified_canvas = None  # Used to display the original Image
+        self.stage_list = None  # Lists the applied stages
+        self.job_runner = jobs.JobRunner(self)  # Runs the filters off the Tk thread
+        # Encodes saved images off the Tk thread, alongside the filters. Saves run one after the other, so a second
+        # one does not cancel the first.
+        self.save_runner = jobs.JobRunner(self, supersede=False)
+        self.original_proxy = None  # The original image reduced to the display size, used for previews
+        self.preview_scale = 1.0  # Size of original_proxy relative to original_image
+        self.preview_image = None  # The applied chain rendered on original_proxy
+        self.applied_chain = []  # (filter class, arguments) steps applied since the image was opened or reset
+        self.preview_steps = 0  # How many steps of applied_chain preview_image includes
+        self.rendered_steps = 0  # How many steps of applied_chain modified_image includes
+        self.full_render_after_id = None
+        # (description, callback) of actions, such as a save, that wait for the next full-size render
+        self.full_render_waiters = []
+        # Chain results by content, so applying a chain again, also after Undo, is served without recomputing it
+        self.result_cache = cache.ResultCache()
+        self.source_key = None  # Digest of original_image
+        self.proxy_key = None  # Key of original_proxy, derived from source_key
+        self.history = undo.UndoHistory(UNDO_CHECKPOINT_INTERVAL, UNDO_MEMORY_BYTES, self.result_cache)
+        self.pyramids = display.PyramidCache()  # Display-sized versions of the images shown
+        self.display_photos = []  # (display image, Tk image) pairs of the images shown, newest first
+        self.displayed_size = None  # Panel size the shown images were resized to
+        self.resize_after_id = None
+        self.gallery = None  # Thumbnails of every filter applied to the edited image, while the gallery is open
 
         # with that, we want to then run init_window, which doesn't yet exist
         self.init_window()
@@ -83,7 +160,7 @@ class Window(tkinter.Frame):
         logger.debug('Into init_window()')
 
         # changing the title of our master widget
-        self.master.title("Image Editor")
+        self.show_status(None)
         self.pack(fill=tkinter.BOTH, expand=1)
 
         button_bar_frame = tkinter.Frame(self.master, bd=1, relief=tkinter.RAISED, bg='blue',
@@ -129,6 +206,12 @@ class Window(tkinter.Frame):
         self.modified_canvas = tkinter.Label(frame_horizontal, borderwidth=2, width=self.get_displayed_image_width(),
                                              height=self.get_displayed_image_height(), bg='yellow')
         self.modified_canvas.pack(side=tkinter.RIGHT, fill=tkinter.Y, expand=1)
+        self.master.bind('<Configure>', self.window_resized)
+
+        # The stages of the applied chain, double-click one to change its parameters
+        self.stage_list = tkinter.Listbox(frame_horizontal, width=14, activestyle='none')
+        self.stage_list.pack(side=tkinter.LEFT, fill=tkinter.Y)
+        self.stage_list.bind('<Double-Button-1>', self.stage_list_double_clicked)
 
     def get_displayed_image_width(self):
         return int((self.winfo_width() - 100) // 2)
@@ -140,31 +223,72 @@ class Window(tkinter.Frame):
         """
         Present the open file dialog and then open the image and set the variables
         """
-        self.selected_path = filedialog.askopenfilename()
-        logger.debug("Image to be opened: {}".format(self.selected_path))
-        self.show_image(self.selected_path)
+        path = filedialog.askopenfilename()
+        logger.debug("Image to be opened: {}".format(path))
+        if path:
+            self.show_image(path)
+
+    def open_neighbour(self, step):
+        """
+        Opens the image step places after the current one in its directory, or before it for a negative step
+        """
+        path = image_io.next_path(self.selected_path, step) if self.selected_path else None
+        if path is None:
+            self.show_status('No {} image in this directory'.format('next' if step > 0 else 'previous'))
+            return
+        self.show_image(path)
 
     def show_image(self, path):
         """
         Reads the image from the given path and displays the image in the window
         """
         logger.debug('Starting show_image(path="{}"'.format(path))
-        load = Image.open(path)
+        self.drop_full_render_waiters('another image was opened')
+        self.cancel_filter()
+        display_size = (self.get_displayed_image_width(), self.get_displayed_image_height())
+        with instrumentation.span('read preview', 'ui', path=path):
+            preview = self.image_reader.read_preview(path, display_size)
+        self.show_first_display(preview)
+        with instrumentation.span('read image', 'ui', path=path):
+            load = self.image_reader.read(path)
+        self.selected_path = path
+        self.show_status(None)
         self.original_image = load
-        self.modified_image = load.copy()
+        # Filters return new images rather than modifying theirs, so both can share the image and its pyramid
+        self.modified_image = load
+        # The previews only need the display size, which the reduced decode already covers
+        self.original_proxy = self.resize_to_display(preview)
+        self.preview_scale = self.original_proxy.width / float(load.width)
+        self.source_key = cache.image_digest(load)
+        self.proxy_key = cache.derive_key(self.source_key, 'proxy', self.original_proxy.size)
+        self.history.reset()
+        self.reset_chain()
+
+        self.show_original_image()
+        self.update_displayed_modified_image()
+        logger.debug('Completed show_image(path="{}"'.format(path))
 
-        display_image = self.get_modified_image_to_display()
-        self.original_image_resized = ImageTk.PhotoImage(display_image)
+    def show_first_display(self, preview):
+        """
+        Shows the image being opened in both panels while its full-size version is decoded
+        """
+        with instrumentation.span('PhotoImage', 'ui', image='preview'):
+            photo = self.photo_image_for(self.resize_to_display(preview))
+        self.original_canvas.configure(image=photo)
+        self.modified_canvas.configure(image=photo)
+        self.master.update_idletasks()
+
+    def show_original_image(self):
+        """
+        Shows the original image on the window
+        """
+        with instrumentation.span('resize', 'ui', image='original'):
+            display_image = self.resize_to_display(self.original_image)
+        with instrumentation.span('PhotoImage', 'ui', image='original'):
+            self.original_image_resized = self.photo_image_for(display_image)
         self.original_canvas.configure(image=self.original_image_resized)
         # self.original_canvas.create_image(5, 5, image=display_image)
         self.original_canvas["image"] = self.original_image_resized
-        self.modified_resized_image = ImageTk.PhotoImage(display_image)
-        self.modified_canvas.configure(image=self.modified_resized_image)
-        # self.modified_canvas.create_image(5, 5, image=display_image)
-        self.modified_canvas["image"] = self.modified_resized_image
-
-        self.master.update_idletasks()
-        logger.debug('Completed show_image(path="{}"'.format(path))
 
     def update_displayed_modified_image(self):
         """
@@ -172,18 +296,65 @@ class Window(tkinter.Frame):
         """
         logger.debug('Started update_displayed_modified_image()')
 
-        display_image = self.get_modified_image_to_display()
-        self.modified_resized_image = ImageTk.PhotoImage(display_image)
+        with instrumentation.span('resize', 'ui', image='modified'):
+            display_image = self.get_modified_image_to_display()
+        # Shares the Tk image of the original panel while the image is unmodified
+        with instrumentation.span('PhotoImage', 'ui', image='modified'):
+            self.modified_resized_image = self.photo_image_for(display_image)
         self.modified_canvas.configure(image=self.modified_resized_image)
         # self.modified_canvas.create_image(5, 5, image=display_image)
         self.modified_canvas["image"] = self.modified_resized_image
 
-        self.master.update_idletasks()
+        with instrumentation.span('update_idletasks', 'ui'):
+            self.master.update_idletasks()
+        self.refresh_gallery(display_image)
         logger.debug('Completed update_displayed_modified_image()')
 
     def get_modified_image_to_display(self):
-        image_size_width = self.modified_image.width
-        image_size_height = self.modified_image.height
+        """
+        Returns the display-sized version of the modified image, or of the preview while the full-size image
+        has not caught up with the applied chain yet
+        """
+        if self.rendered_steps < len(self.applied_chain) and self.preview_steps == len(self.applied_chain):
+            return self.resize_to_display(self.preview_image)
+        return self.resize_to_display(self.modified_image)
+
+    def photo_image_for(self, display_image):
+        """
+        Returns the Tk image of a display image, converting every display image only once
+        """
+        for image, photo in self.display_photos:
+            if image is display_image:
+                return photo
+        photo = ImageTk.PhotoImage(display_image)
+        self.display_photos = [(display_image, photo)] + self.display_photos[:2]
+        return photo
+
+    def window_resized(self, event):
+        if event.widget is not self.master or self.original_image is None:
+            return
+        if (self.get_displayed_image_width(), self.get_displayed_image_height()) == self.displayed_size:
+            return
+        if self.resize_after_id is not None:
+            self.after_cancel(self.resize_after_id)
+        self.resize_after_id = self.after(RESIZE_DELAY_MS, self.refresh_display)
+
+    def refresh_display(self):
+        """
+        Shows both images at the current panel size, resampled from their pyramids
+        """
+        self.resize_after_id = None
+        self.show_original_image()
+        self.update_displayed_modified_image()
+
+    def resize_to_display(self, image):
+        """
+        Reduces the image to fit the image panels, keeping its aspect ratio. The result is resampled from the
+        nearest level of the image's pyramid, which is built once per image.
+        """
+        self.displayed_size = (self.get_displayed_image_width(), self.get_displayed_image_height())
+        image_size_width = image.width
+        image_size_height = image.height
         if image_size_width > self.get_displayed_image_width() or image_size_height > self.get_displayed_image_height():
             width_ratio = image_size_width / self.get_displayed_image_width()
             height_ratio = image_size_height / self.get_displayed_image_height()
@@ -198,10 +369,10 @@ class Window(tkinter.Frame):
 
             logger.debug('resizing image from {} x {} to {} x {}'.format(image_size_width, image_size_height,
                                                                          new_width, new_height))
-            display_image = self.modified_image.resize((new_width, new_height), Image.ANTIALIAS)
+            display_image = self.pyramids.pyramid(image).resized((new_width, new_height))
         else:
             logger.debug('Keeping image size at {} x {}'.format(image_size_width, image_size_height))
-            display_image = self.modified_image
+            display_image = image
         return display_image
 
     # def show_blur_filter(self):
@@ -216,19 +387,295 @@ class Window(tkinter.Frame):
     #     self.update_displayed_modified_image(".test2222.png")
     #     logger.debug('Completed show_blur_filter()')
 
+    def apply_registered_filter(self, filter_name):
+        """
+        Applies the filter with the given name from the registry, loading its backend on first use
+        """
+        start = time.perf_counter()
+        filter_class = registry.load(filter_name)
+        logger.debug('Loaded {} in {:.0f} ms'.format(filter_name, (time.perf_counter() - start) * 1000))
+        self.apply_and_show_filter(filter_name, filter_class)
+
     def apply_and_show_filter(self, filter_name, filter_class, *args):
         """
-        Gets the filter to be applied as input and applies the corresponding filter on the image
+        Gets the filter to be applied as input and applies the corresponding filter on the image.
+        The filter runs on a background thread, and a new click cancels a filter that is still running.
+        In preview mode the filter is applied to the display-sized proxy, and the full-size image is rendered
+        once the editor is idle.
         """
         logger.debug('Starting apply_and_show_filter(filter_name="{}", args={})'.format(filter_name, args))
+        if self.modified_image is None:
+            return
         f = filter_class()
-        additional_args = f.request_additional_parameters()
+        with instrumentation.span('parameter dialog', 'ui', filter=filter_name):
+            additional_args = f.request_additional_parameters()
+        if None in additional_args:
+            logger.debug('Parameter dialog for {} was cancelled'.format(filter_name))
+            return
         if additional_args:
-            self.modified_image = f.apply_filter(self.modified_image, *additional_args)
+            args = additional_args
+        elif self.approximate_mode.get() and filter_class.supports_approximation:
+            args = [APPROXIMATE_MEGAPIXELS]
+        self.render_chain(self.applied_chain + [(filter_class, list(args))], 'Applying {}'.format(filter_name))
+
+    def open_gallery(self):
+        """
+        Opens the gallery of thumbnails of every filter applied to the edited image, or brings it to the front
+        """
+        if self.modified_image is None:
+            return
+        if self.gallery is None or not self.gallery.winfo_exists():
+            self.gallery = gallery.GalleryWindow(self.master, self.filter_names, self.apply_from_gallery)
+        self.gallery.lift()
+        self.refresh_gallery(self.get_modified_image_to_display())
+
+    def refresh_gallery(self, display_image):
+        """
+        Renders the gallery's thumbnails again from the displayed edited image when the edits have changed
+        """
+        if self.gallery is None or not self.gallery.winfo_exists():
+            return
+        approximate_megapixels = APPROXIMATE_MEGAPIXELS if self.approximate_mode.get() else None
+        key = (self.source_key, list(self.applied_chain), approximate_megapixels)
+        self.gallery.show(display_image, self.original_image.width, key, approximate_megapixels)
+
+    def apply_from_gallery(self, filter_class, args):
+        """
+        Applies a filter chosen in the gallery with the arguments of its thumbnail. The thumbnail already served as
+        the preview, so the filter is rendered at full size straight away.
+        """
+        if self.modified_image is None:
+            return
+        self.render_chain(self.applied_chain + [(filter_class, list(args))],
+                          'Applying {}'.format(filter_class.name), preview=False)
+
+    def edit_stage(self, index):
+        """
+        Asks for new parameters of an applied stage and renders the chain again with them. The images after the
+        stages before it are taken from the result cache, so only the stages from the edited one onwards are
+        recomputed.
+        """
+        filter_class, old_args = self.applied_chain[index]
+        with instrumentation.span('parameter dialog', 'ui', filter=filter_class.name, stage=index):
+            args = filter_class().request_additional_parameters()
+        if not args or None in args:
+            logger.debug('No new parameters for stage {} ({})'.format(index + 1, filter_class.name))
+            return
+        if list(args) == list(old_args):
+            return
+        chain = self.applied_chain[:index] + [(filter_class, list(args))] + self.applied_chain[index + 1:]
+        self.change_chain(chain, 'Changing {} {} to {}'.format(filter_class.name, old_args, list(args)))
+
+    def undo(self):
+        if self.modified_image is not None and self.history.can_undo():
+            self.change_chain(self.history.undo(), 'Undo')
+
+    def redo(self):
+        if self.modified_image is not None and self.history.can_redo():
+            self.change_chain(self.history.redo(), 'Redo')
+
+    def change_chain(self, chain, description):
+        """
+        Renders chain in place of the applied chain. The rendered images are kept as far as both chains agree,
+        the steps after that come from the result cache, the undo checkpoints or are recomputed.
+        """
+        self.cancel_filter()
+        shared_steps = undo.common_prefix_length(self.applied_chain, chain)
+        if self.preview_steps > shared_steps:
+            self.preview_image, self.preview_steps = self.original_proxy, 0
+        if self.rendered_steps > shared_steps:
+            self.modified_image, self.rendered_steps = self.original_image, 0
+        self.render_chain(chain, description)
+
+    def render_chain(self, chain, description, preview=None):
+        """
+        Renders chain, which differs from the applied chain in its last or changed stages, on a background thread
+        and makes it the applied chain when done. In preview mode, or with preview set, it is rendered on the
+        display-sized proxy first.
+        """
+        self.cancel_full_render()
+
+        if preview is None:
+            preview = self.preview_mode.get()
+        if preview:
+            # The preview may lag behind steps applied with preview mode off, run_chain catches up from start
+            source, source_key, scale = self.original_proxy, self.proxy_key, self.preview_scale
+            start = (self.preview_steps, self.preview_image)
         else:
-            self.modified_image = f.apply_filter(self.modified_image, *args)
-        self.update_displayed_modified_image()
-        logger.debug('Completed apply_and_show_filter(filter_name="{}", args={})'.format(filter_name, args))
+            source, source_key, scale = self.original_image, self.source_key, 1.0
+            start = (self.rendered_steps, self.modified_image)
+
+        def on_done(result):
+            self.applied_chain = chain
+            self.history.push(chain)
+            if preview:
+                self.preview_image = result
+                self.preview_steps = len(chain)
+                self.schedule_full_render()
+            else:
+                self.modified_image = result
+                self.rendered_steps = len(chain)
+                self.history.record_render(chain, result)
+            self.update_displayed_modified_image()
+            self.update_stage_list()
+            self.show_status(None)
+            logger.debug('Completed {}'.format(description))
+            if not preview:
+                self.run_full_render_waiters()
+
+        def on_error(error):
+            self.show_filter_error(description, error)
+            # The applied chain is unchanged, so a save waiting for the full-size image can go on
+            self.run_full_render_waiters()
+
+        def on_progress(fraction):
+            self.show_status('{} ({:.0%})'.format(description, fraction))
+
+        self.show_status(description)
+        if preview:
+            render = functools.partial(self.result_cache.run_chain, source, source_key, chain, scale, start=start,
+                                       intermediates=True)
+        else:
+            render = functools.partial(self.render_full_size, chain, start)
+        self.job_runner.submit(render, on_done, on_error=on_error, on_progress=on_progress, description=description)
+
+    def schedule_full_render(self):
+        """
+        Renders the full-size image once the editor has been idle for a while, or straight away when an action
+        such as a save is waiting for it
+        """
+        self.cancel_full_render()
+        delay = 0 if self.full_render_waiters else FULL_RENDER_DELAY_MS
+        self.full_render_after_id = self.after(delay, self.render_full_resolution)
+
+    def cancel_full_render(self):
+        if self.full_render_after_id is not None:
+            self.after_cancel(self.full_render_after_id)
+            self.full_render_after_id = None
+
+    def render_full_resolution(self, then=None, description=None):
+        """
+        Applies the steps of the chain that so far were only previewed to the full-size image, then calls then.
+        then waits for whichever full-size render completes next, also when the chain changes in the meantime,
+        until drop_full_render_waiters forgets it.
+        """
+        self.full_render_after_id = None
+        if then:
+            self.full_render_waiters.append((description, then))
+        if self.job_runner.is_busy():
+            # Still working on a filter, which may change the applied chain, try again when it is done
+            if self.full_render_waiters:
+                self.full_render_after_id = self.after(self.job_runner.poll_interval, self.render_full_resolution)
+            else:
+                self.schedule_full_render()
+            return
+        if self.rendered_steps == len(self.applied_chain):
+            self.run_full_render_waiters()
+            return
+        chain = self.applied_chain
+
+        def on_done(result):
+            self.modified_image = result
+            self.rendered_steps = len(chain)
+            self.history.record_render(chain, result)
+            self.update_displayed_modified_image()
+            self.show_status(None)
+            self.run_full_render_waiters()
+
+        def on_error(error):
+            self.show_filter_error('Full size render', error)
+            self.drop_full_render_waiters('the full size render failed')
+
+        def on_progress(fraction):
+            self.show_status('Rendering full size ({:.0%})'.format(fraction))
+
+        self.show_status('Rendering full size')
+        self.job_runner.submit(functools.partial(self.render_full_size, chain,
+                                                 (self.rendered_steps, self.modified_image)),
+                               on_done, on_error=on_error, on_progress=on_progress, description='full size render')
+
+    def run_full_render_waiters(self):
+        """
+        Calls the actions waiting for the full-size image once it has caught up with the applied chain, and
+        otherwise renders the steps applied in the meantime first
+        """
+        if not self.full_render_waiters:
+            return
+        if self.rendered_steps != len(self.applied_chain):
+            self.schedule_full_render()
+            return
+        waiters, self.full_render_waiters = self.full_render_waiters, []
+        for _, then in waiters:
+            then()
+
+    def drop_full_render_waiters(self, reason):
+        """
+        Forgets the actions waiting for the full-size image and tells the user they did not happen
+        """
+        if not self.full_render_waiters:
+            return
+        message = '{} cancelled: {}'.format(', '.join(description or 'Waiting action'
+                                                     for description, _ in self.full_render_waiters), reason)
+        self.full_render_waiters = []
+        logger.warning(message)
+        self.show_status(message)
+
+    def render_full_size(self, chain, start):
+        """
+        Renders chain on the full-size image, from start or a later undo checkpoint. Runs on the job thread.
+        """
+        self.history.restore_checkpoint(self.result_cache, self.source_key, chain)
+        return self.result_cache.run_chain(self.original_image, self.source_key, chain, start=start,
+                                           intermediates=True, workers=parallel.default_workers())
+
+    def preview_mode_changed(self):
+        if not self.preview_mode.get():
+            self.cancel_full_render()
+            self.render_full_resolution()
+
+    def reset_chain(self):
+        self.cancel_full_render()
+        self.applied_chain = []
+        self.preview_image = self.original_proxy
+        self.preview_steps = 0
+        self.rendered_steps = 0
+        self.update_stage_list()
+
+    def update_stage_list(self):
+        self.stage_list.delete(0, tkinter.END)
+        for index, (filter_class, args) in enumerate(self.applied_chain):
+            self.stage_list.insert(tkinter.END, '{}. {}{}'.format(index + 1, filter_class.name,
+                                                                  ' {}'.format(args) if args else ''))
+
+    def stage_list_double_clicked(self, event):
+        selection = self.stage_list.curselection()
+        if selection:
+            self.edit_stage(selection[0])
+
+    def cancel_filter(self):
+        """
+        Cancels the filter that is currently running, leaving the modified image as it was
+        """
+        if self.job_runner.is_busy():
+            self.job_runner.cancel()
+            self.show_status(None)
+
+    def cancel_button_pressed(self):
+        """
+        Cancels the running filter and the actions, such as a save, that wait for the full-size image
+        """
+        self.cancel_filter()
+        self.drop_full_render_waiters('Cancel was pressed')
+
+    def show_filter_error(self, filter_name, error):
+        logger.error('Filter {} failed: {}'.format(filter_name, error))
+        self.show_status('{} failed: {}'.format(filter_name, error))
+
+    def show_status(self, message):
+        """
+        Shows what the editor is busy with in the title bar, or just the editor name when message is None
+        """
+        self.master.title("Image Editor - {}".format(message) if message else "Image Editor")
 
     # def show_fourier(self):
     #     """
@@ -238,16 +685,73 @@ class Window(tkinter.Frame):
 
     def save_file(self):
         """
-        Saves the edited image in a path
+        Saves the edited image at full size in a path, once it has been rendered, encoding it on a background thread
         """
+        if self.modified_image is None:
+            return
         save_path = filedialog.asksaveasfilename()
-        if save_path:
-            print("Image will be saved at: ", save_path)
-            utils.save_img_at_path(self.modified_resized_image, save_path)
+        if not save_path:
+            return
+        try:
+            options = self.ask_save_options(save_path)
+        except ValueError as e:
+            self.show_filter_error('Save', e)
+            return
+        if options is None:
+            return
+        logger.info('Image will be saved at: {}'.format(save_path))
+        # A chain applied in preview mode, or a filter still running, may not have been rendered at full size yet.
+        # The save waits for the next full-size render, and is only dropped with a message in the title bar.
+        name = os.path.basename(save_path)
+        self.cancel_full_render()
+        self.show_status('Waiting for the full size image to save {}'.format(name))
+        self.render_full_resolution(then=functools.partial(self.save_in_background, save_path, options),
+                                    description='Save of {}'.format(name))
+
+    def ask_save_options(self, path):
+        """
+        Asks for the encoder settings the format of path has, returns None when a dialog is cancelled
+        """
+        options = {'optimize': SAVE_OPTIMIZE, 'progressive': SAVE_PROGRESSIVE}
+        supported = image_io.encoder_options(path)
+        if 'quality' in supported:
+            options['quality'] = simpledialog.askinteger("Quality", "Quality (1-100, higher is larger)",
+                                                         minvalue=1, maxvalue=100, initialvalue=SAVE_QUALITY)
+        if 'compress_level' in supported:
+            options['compress_level'] = simpledialog.askinteger(
+                "Compression", "Compression level (0-9, higher is smaller but slower)", minvalue=0, maxvalue=9,
+                initialvalue=SAVE_COMPRESS_LEVEL)
+        if None in options.values():
+            return None
+        return options
+
+    def save_in_background(self, path, options):
+        """
+        Encodes the full-size modified image into path on the save thread, reporting the time and file size
+        """
+        name = os.path.basename(path)
+
+        def on_done(saved):
+            logger.info('Saved {}: {} bytes in {:.2f} s'.format(path, saved.size_bytes, saved.seconds))
+            self.show_status('Saved {} ({:.1f} MB in {:.2f} s)'.format(name, saved.size_bytes / 1e6, saved.seconds))
+
+        self.show_status('Saving {}'.format(name))
+        self.save_runner.submit(functools.partial(image_io.save_image, self.modified_image, path, **options), on_done,
+                                on_error=functools.partial(self.show_filter_error, 'Saving {}'.format(name)),
+                                description='save')
 
     def reset_modified_image(self):
-        self.modified_image = self.original_image.copy()
+        """
+        Goes back to the original image, which can be undone
+        """
+        if self.modified_image is None:
+            return
+        self.cancel_filter()
+        self.modified_image = self.original_image
+        self.reset_chain()
+        self.history.push([])
         self.update_displayed_modified_image()
+        self.run_full_render_waiters()
 
     def client_exit(self):
         exit()
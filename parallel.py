@@ -0,0 +1,230 @@
+import argparse
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from multiprocessing import shared_memory
+
+import PIL.Image
+import numpy as np
+
+import utils
+import image_io
+import instrumentation
+import jobs
+import pipeline
+
+logger = logging.getLogger(__name__)
+
+# Smaller images are filtered in this process, as handing them to the workers costs more than it saves
+MIN_PARALLEL_PIXELS = 1024 * 1024
+# Bands are made no thinner than this, or than the halo, so the rows filtered twice stay a small fraction
+MIN_BAND_ROWS = 64
+# Edge length of the crop filtered up front to find the shape and type of the result
+PROBE_SIZE = 32
+
+_executor = None
+_executor_workers = 0
+_executor_lock = threading.Lock()
+
+
+def default_workers():
+    return os.cpu_count() or 1
+
+
+def get_executor(workers):
+    """
+    Returns the process pool, started on first use and kept so later images do not pay for starting processes.
+    Workers are started from a clean process rather than forked from this one, which may be running Tk and
+    other threads.
+    """
+    global _executor, _executor_workers
+    with _executor_lock:
+        if _executor is None or _executor_workers != workers:
+            if _executor is not None:
+                _executor.shutdown(wait=False)
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+            _executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=context)
+            _executor_workers = workers
+        return _executor
+
+
+def shutdown():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown()
+            _executor = None
+
+
+def iter_bands(height, band_count, halo, alignment=1):
+    """
+    Yields (top, bottom, padded top, padded bottom) rows of up to band_count horizontal bands covering the image, the
+    padded rows growing each band by the halo, clipped to the image. The padded bands start at multiples of
+    alignment, see Filter.alignment.
+    """
+    halo += -halo % alignment
+    tops = sorted({height * index // band_count // alignment * alignment for index in range(band_count)})
+    for top, bottom in zip(tops, tops[1:] + [height]):
+        yield top, bottom, max(top - halo, 0), min(bottom + halo, height)
+
+
+def band_count_for(height, workers, halo):
+    return max(1, min(workers, height // max(MIN_BAND_ROWS, halo)))
+
+
+def _create_shared(shape, dtype):
+    dtype = np.dtype(dtype)
+    memory = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * dtype.itemsize))
+    return memory, np.ndarray(shape, dtype, buffer=memory.buf), (memory.name, shape, dtype.str)
+
+
+def _attach_shared(spec):
+    name, shape, dtype = spec
+    memory = shared_memory.SharedMemory(name=name)
+    return memory, np.ndarray(shape, np.dtype(dtype), buffer=memory.buf)
+
+
+def _limit_library_threads():
+    # The bands already keep every core busy, OpenCV's own threads would only compete with them
+    cv2 = sys.modules.get('cv2')
+    if cv2 is not None:
+        cv2.setNumThreads(1)
+
+
+def _filter_band(filter_pipeline, source_spec, target_spec, band):
+    """
+    Runs in a worker process: filters the halo-padded rows of one band of the shared source image and writes the
+    band's own rows into the shared target image. Only the names of the shared memory blocks are pickled.
+    """
+    _limit_library_threads()
+    top, bottom, pad_top, pad_bottom = band
+    source_memory, source = _attach_shared(source_spec)
+    target_memory, target = _attach_shared(target_spec)
+    try:
+        # Filters may work on their input in place, and the neighbouring bands still need these rows
+        result = pipeline.to_array(filter_pipeline.run(np.array(source[pad_top:pad_bottom]), report_progress=False,
+                                                       pixel_count=source.shape[0] * source.shape[1]))
+        target[top:bottom] = result[top - pad_top:bottom - pad_top]
+    finally:
+        # The arrays export the shared buffers, which can only be closed once they are gone
+        del source, target
+        source_memory.close()
+        target_memory.close()
+    return bottom - top
+
+
+def run(filter_pipeline, image, workers=None, context=None, report_progress=True):
+    """
+    Runs a pipeline.Pipeline over image like filter_pipeline.run, but on several cores: the image is copied into
+    shared memory once and split into horizontal bands, padded by the pipeline's footprint, that worker processes
+    filter into a shared result image. Images that are small, or that a stage needs in one piece, are filtered in
+    this process. Returns the same type as image.
+    """
+    workers = workers or default_workers()
+    pixels = pipeline.to_array(image)
+    height, width = pixels.shape[:2]
+    halo = filter_pipeline.footprint()
+    band_count = band_count_for(height, workers, halo or 0)
+    if workers < 2 or band_count < 2 or halo is None or height * width < MIN_PARALLEL_PIXELS:
+        if halo is None:
+            logger.debug('A stage needs the whole image, filtering it in one piece')
+        return filter_pipeline.run(image, context=context, report_progress=report_progress)
+
+    probe_size = min(2 * halo + PROBE_SIZE, height, width)
+    probe = pipeline.to_array(filter_pipeline.run(np.array(pixels[:probe_size, :probe_size]), report_progress=False,
+                                                  pixel_count=height * width))
+
+    source_memory, source, source_spec = _create_shared(pixels.shape, pixels.dtype)
+    target_memory, target, target_spec = _create_shared((height, width) + probe.shape[2:], probe.dtype)
+    futures = []
+    try:
+        source[...] = pixels
+        executor = get_executor(workers)
+        bands = list(iter_bands(height, band_count, halo, filter_pipeline.alignment()))
+        logger.debug('Filtering {} x {} image in {} bands with a halo of {} on {} workers'.format(
+            width, height, len(bands), halo, workers))
+        with instrumentation.span('bands', 'parallel', bands=len(bands), workers=workers, halo=halo):
+            futures = [executor.submit(_filter_band, filter_pipeline, source_spec, target_spec, band)
+                       for band in bands]
+            rows = 0
+            for future in concurrent.futures.as_completed(futures):
+                rows += future.result()
+                if report_progress:
+                    jobs.report_progress(rows / float(height))
+        result = np.array(target)
+    finally:
+        for future in futures:
+            future.cancel()
+        # Bands still running write into the shared memory, which must outlive them
+        concurrent.futures.wait(futures)
+        del source, target
+        for memory in (source_memory, target_memory):
+            memory.close()
+            memory.unlink()
+
+    if isinstance(image, PIL.Image.Image):
+        return pipeline.to_image(result)
+    return result
+
+
+def benchmark(filter_pipeline, image, worker_counts, repeat):
+    """
+    Times the pipeline on image in this process and with each number of workers, and checks that the bands give the
+    same result
+    """
+    def best_time(function):
+        best = None
+        result = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = function()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best, result
+
+    serial, expected = best_time(lambda: filter_pipeline.run(image, report_progress=False))
+    logger.info('{:>8} {:9.0f} ms'.format('serial', serial * 1000))
+    for workers in worker_counts:
+        # The first run starts the worker processes and is not timed
+        run(filter_pipeline, image, workers, report_progress=False)
+        seconds, result = best_time(lambda: run(filter_pipeline, image, workers, report_progress=False))
+        difference = np.abs(np.asarray(result, dtype=np.int16) - np.asarray(expected, dtype=np.int16)).max()
+        logger.info('{:>8} {:9.0f} ms  speedup {:5.2f}  efficiency {:4.0%}  max difference {}'.format(
+            workers, seconds * 1000, serial / seconds, serial / seconds / workers, difference))
+
+
+if __name__ == '__main__':
+    import batch
+    import registry
+
+    parser = argparse.ArgumentParser(description='Filters one large image on several cores')
+    parser.add_argument('input', help='image to filter')
+    parser.add_argument('output', nargs='?', help='where to write the result')
+    parser.add_argument('-f', '--filter', dest='filters', action='append', required=True,
+                        help='filter to apply, as NAME or NAME:ARG[,ARG...], e.g. "gaussian:3". Repeat to chain.')
+    parser.add_argument('-j', '--workers', type=int, default=default_workers(), help='number of worker processes')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='time the chain with 1, 2, 4... up to --workers processes instead of writing the result')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs in a benchmark')
+    arguments = parser.parse_args()
+
+    utils.setup_logger_to_console_file()
+    chain = [(registry.load(name), args) for name, args in batch.build_chain(arguments.filters)]
+    filter_pipeline = pipeline.Pipeline.from_chain(chain)
+    source_image = image_io.read_array(arguments.input)
+    if arguments.benchmark:
+        counts = sorted({min(2 ** power, arguments.workers) for power in range(1, arguments.workers.bit_length() + 1)})
+        benchmark(filter_pipeline, source_image, counts, arguments.repeat)
+    elif arguments.output:
+        start_time = time.perf_counter()
+        filtered = run(filter_pipeline, source_image, arguments.workers, report_progress=False)
+        logger.info('Filtered in {:.2f} s on {} workers'.format(time.perf_counter() - start_time, arguments.workers))
+        PIL.Image.fromarray(filtered).save(arguments.output)
+    else:
+        parser.error('give an output path or --benchmark')
+    shutdown()
@@ -0,0 +1,252 @@
+import logging
+import math
+
+import PIL.Image
+import numpy as np
+
+import convolution
+import instrumentation
+import jobs
+import lut
+import tuning
+
+logger = logging.getLogger(__name__)
+
+PIL_INPUT = 'pil'
+ARRAY_INPUT = 'array'
+
+
+class PipelineContext:
+    """
+    Intermediates derived from the buffer currently flowing through a pipeline, such as its grayscale plane,
+    so that consecutive stages working on the same buffer compute them only once. Only the intermediates of the
+    latest buffer are kept.
+    """
+
+    def __init__(self):
+        self.buffer = None
+        self.intermediates = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _select(self, buffer):
+        if buffer is not self.buffer:
+            self.buffer = buffer
+            self.intermediates = {}
+
+    def derive(self, buffer, key, compute):
+        """
+        Returns the intermediate called key for buffer, computing it with compute() the first time
+        """
+        self._select(buffer)
+        if key in self.intermediates:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.intermediates[key] = compute()
+        return self.intermediates[key]
+
+    def publish(self, buffer, key, value):
+        """
+        Records an intermediate of buffer that a stage got for free while producing it
+        """
+        self._select(buffer)
+        self.intermediates[key] = value
+
+
+def to_array(image):
+    """
+    Returns image as a writable array, converting a PIL image once. Arrays are passed through without copying.
+    """
+    if isinstance(image, PIL.Image.Image):
+        if image.mode not in ('L', 'RGB', 'RGBA'):
+            image = image.convert('RGB')
+        return np.array(image)
+    return image
+
+
+def to_image(image):
+    """
+    Returns image as a PIL image, converting an array once
+    """
+    if isinstance(image, PIL.Image.Image):
+        return image
+    return PIL.Image.fromarray(image)
+
+
+class FusedKernelStage:
+    """
+    Consecutive linear filters combined into one kernel, so they cost a single pass. Rounding and clamping to uint8
+    only happen once at the end, and borders are reflected rather than copied as PIL does, so the result can differ
+    slightly from applying the filters one by one.
+    """
+    input_type = ARRAY_INPUT
+
+    def __init__(self, steps):
+        self.name = ' + '.join(f.name for f, _ in steps)
+        self.weights, self.offset = steps[0][0].linear_kernel(*steps[0][1])
+        for f, args in steps[1:]:
+            weights, offset = f.linear_kernel(*args)
+            self.weights, self.offset = convolution.compose(self.weights, self.offset, weights, offset)
+
+    def footprint(self, *args):
+        return max(self.weights.shape) // 2
+
+    def alignment(self, *args):
+        return 1
+
+    def apply_array(self, img, context, *args):
+        if img.ndim == 3 and img.shape[2] == 4:
+            filtered = convolution.correlate_uint8(img[..., :3], self.weights, offset=self.offset)
+            return np.dstack([filtered, img[..., 3]])
+        return convolution.correlate_uint8(img, self.weights, offset=self.offset)
+
+    def apply_batch(self, images, *args):
+        if images.ndim == 4 and images.shape[3] == 4:
+            filtered = convolution.correlate_uint8_batch(images[..., :3], self.weights, offset=self.offset)
+            return np.concatenate([filtered, images[..., 3:]], axis=3)
+        return convolution.correlate_uint8_batch(images, self.weights, offset=self.offset)
+
+
+class LookupTableStage:
+    """
+    Consecutive per-pixel point operations combined into one lookup table
+    """
+    input_type = ARRAY_INPUT
+
+    def __init__(self, steps):
+        self.name = ' + '.join(f.name for f, _ in steps)
+        self.table = steps[0][0].lookup_table(*steps[0][1])
+        for f, args in steps[1:]:
+            self.table = lut.compose(self.table, f.lookup_table(*args))
+
+    def footprint(self, *args):
+        return 0
+
+    def alignment(self, *args):
+        return 1
+
+    def apply_array(self, img, context, *args):
+        return lut.apply_table(img, self.table)
+
+    def apply_batch(self, images, *args):
+        return lut.apply_table_batch(images, self.table)
+
+
+def _step_kind(f, args):
+    if getattr(f, 'lookup_table', None) and f.lookup_table(*args) is not None:
+        return LookupTableStage
+    if getattr(f, 'linear_kernel', None) and f.linear_kernel(*args) is not None:
+        return FusedKernelStage
+    return None
+
+
+def fuse_steps(steps):
+    """
+    Replaces every run of two or more linear filters by a FusedKernelStage and every run of two or more point
+    operations by a LookupTableStage. Single filters keep their own, usually faster, implementation.
+    """
+    stages = []
+    run = []
+    run_kind = None
+    for f, args in list(steps) + [(None, None)]:
+        kind = _step_kind(f, args) if f is not None else None
+        if run and kind is not run_kind:
+            if len(run) > 1:
+                logger.debug('Fusing {} steps into a {}'.format(len(run), run_kind.__name__))
+                stages.append((run_kind(run), []))
+            else:
+                stages.extend(run)
+            run = []
+        if kind is None:
+            if f is not None:
+                stages.append((f, args))
+        else:
+            run.append((f, args))
+        run_kind = kind
+    return stages
+
+
+class Pipeline:
+    """
+    Runs a list of (filter instance, arguments) steps in order. Filters with input_type 'array' get the previous
+    stage's array as is and share a PipelineContext, so the image is converted between PIL and numpy only where
+    the input type of consecutive stages changes. With fuse set, runs of linear filters and of point operations
+    are each combined into a single pass, see fuse_steps.
+    """
+
+    def __init__(self, steps, fuse=False):
+        self.steps = fuse_steps(steps) if fuse else list(steps)
+
+    @classmethod
+    def from_filters(cls, *filters, **kwargs):
+        """
+        Builds a pipeline from Filter subclasses, or (Filter subclass, arguments) tuples for filters with parameters,
+        e.g. Pipeline.from_filters(BlurFilter, (GaussianFilter, [3]), SharpenFilter, fuse=True)
+        """
+        chain = [f if isinstance(f, tuple) else (f, []) for f in filters]
+        return cls.from_chain(chain, **kwargs)
+
+    @classmethod
+    def from_chain(cls, chain, scale=1.0, fuse=False):
+        """
+        Builds a pipeline from (filter class, arguments) steps, see Filter.apply_chain
+        """
+        steps = []
+        for filter_class, args in chain:
+            f = filter_class()
+            f.footprint_scale = scale
+            steps.append((f, list(args)))
+        return cls(steps, fuse=fuse)
+
+    def footprint(self):
+        """
+        Returns the combined halo of all stages, or None when a stage depends on the whole image
+        """
+        halos = [f.footprint(*args) for f, args in self.steps]
+        return None if None in halos else sum(halos)
+
+    def alignment(self):
+        """
+        Returns the number of pixels the origins of bands or tiles of the image must be a multiple of, see
+        Filter.alignment
+        """
+        alignment = 1
+        for f, args in self.steps:
+            alignment = math.lcm(alignment, f.alignment(*args))
+        return alignment
+
+    def run(self, image, context=None, report_progress=True, pixel_count=None):
+        """
+        Applies every step to image and returns the result as the same type as image, a PIL image or an array. When
+        image is a band or tile, pixel_count gives the size of the whole image to pick the filter backends for.
+        """
+        if context is None:
+            context = PipelineContext()
+        current = image
+        for index, (f, args) in enumerate(self.steps):
+            with instrumentation.span(f.name, 'filter', step=index, args=args):
+                if f.input_type == ARRAY_INPUT:
+                    current = f.apply_array(to_array(current), context, *args)
+                else:
+                    # Runs the implementation the tuner found fastest for this image, if the filter has several
+                    current = tuning.apply_filter(f, to_image(current), args, pixel_count)
+            if report_progress:
+                jobs.report_progress((index + 1) / float(len(self.steps)))
+        logger.debug('Pipeline of {} steps reused {} intermediates and computed {}'.format(
+            len(self.steps), context.hits, context.misses))
+        if isinstance(image, PIL.Image.Image):
+            return to_image(current)
+        return to_array(current)
+
+    def run_batch(self, images):
+        """
+        Applies every step to an (N, H, W) or (N, H, W, C) uint8 stack of same-sized images and returns the filtered
+        stack, see Filter.apply_batch. Linear filters and point operations process the whole stack in one pass,
+        which saves most of the per-image overhead when filtering many small images such as thumbnails.
+        """
+        current = np.asarray(images)
+        for index, (f, args) in enumerate(self.steps):
+            with instrumentation.span(f.name, 'filter', step=index, args=args, images=len(current)):
+                current = f.apply_batch(current, *args)
+        return current
@@ -0,0 +1,93 @@
+import collections
+import importlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+PIL_BACKEND = 'PIL'
+NUMPY_BACKEND = 'numpy'
+OPENCV_BACKEND = 'opencv'
+
+FilterInfo = collections.namedtuple('FilterInfo', ['name', 'module', 'class_name', 'backend', 'has_parameters'])
+
+# Every filter the editor and batch.py offer, in button order. Listing them here lets the editor show its buttons
+# without importing the filter modules and their backends; verify() checks the list against the classes.
+FILTERS = [
+    FilterInfo('gotham', 'Filter', 'GothamFilter', NUMPY_BACKEND, False),
+    FilterInfo('riverdale', 'Filter', 'RiverdaleFilter', NUMPY_BACKEND, False),
+    FilterInfo('blur', 'Filter', 'BlurFilter', PIL_BACKEND, False),
+    FilterInfo('gaussian', 'Filter', 'GaussianFilter', PIL_BACKEND, True),
+    FilterInfo('sharpen', 'Filter', 'SharpenFilter', PIL_BACKEND, False),
+    FilterInfo('smooth', 'Filter', 'SmoothFilter', PIL_BACKEND, False),
+    FilterInfo('smooth more', 'Filter', 'SmoothMoreFilter', PIL_BACKEND, False),
+    FilterInfo('contour', 'Filter', 'ContourFilter', PIL_BACKEND, False),
+    FilterInfo('detail', 'Filter', 'DetailFilter', PIL_BACKEND, False),
+    FilterInfo('edge enhance', 'Filter', 'EdgeEnhanceFilter', PIL_BACKEND, False),
+    FilterInfo('edge enhance more', 'Filter', 'EdgeEnhanceMoreFilter', PIL_BACKEND, False),
+    FilterInfo('emboss', 'Filter', 'EmbossFilter', PIL_BACKEND, False),
+    FilterInfo('find edges', 'Filter', 'FindEdgesFilter', PIL_BACKEND, False),
+    FilterInfo('invert', 'Filter', 'InvertFilter', NUMPY_BACKEND, False),
+    FilterInfo('Detail Enhance', 'CV2Filters', 'DetailEnhanceFilter', OPENCV_BACKEND, False),
+    FilterInfo('Pencil Sketch', 'CV2Filters', 'PencilSketchFilter', OPENCV_BACKEND, False),
+    FilterInfo('Bilateral', 'CV2Filters', 'BilateralFilter', OPENCV_BACKEND, False),
+    FilterInfo('Pencil Edges', 'CV2Filters', 'PencilEdgesFilter', OPENCV_BACKEND, False),
+    FilterInfo('Cartoon', 'CV2Filters', 'CartoonFilter', OPENCV_BACKEND, False),
+]
+
+_by_name = {info.name: info for info in FILTERS}
+
+
+def filter_names():
+    return [info.name for info in FILTERS]
+
+
+def get_info(name):
+    """
+    Returns the FilterInfo of the filter with the given name, ignoring case
+    """
+    info = _by_name.get(name)
+    if info is None:
+        for info in FILTERS:
+            if info.name.lower() == name.lower():
+                return info
+        raise ValueError('Unknown filter "{}", expected one of: {}'.format(name, ', '.join(sorted(_by_name))))
+    return info
+
+
+def load(name):
+    """
+    Returns the class of the filter with the given name, importing its module and backend the first time
+    """
+    info = get_info(name)
+    module = importlib.import_module(info.module)
+    return getattr(module, info.class_name)
+
+
+def load_all():
+    """
+    Returns an ordered map of every filter name to its class, importing all backends
+    """
+    return collections.OrderedDict((info.name, load(info.name)) for info in FILTERS)
+
+
+def verify():
+    """
+    Imports every filter module and returns a list of the differences between FILTERS and the filter classes
+    """
+    import Filter
+    problems = []
+    loaded = load_all()
+    for name, filter_class in loaded.items():
+        if filter_class.name != name:
+            problems.append('{} is registered as "{}" but named "{}"'.format(filter_class.__name__, name,
+                                                                            filter_class.name))
+        has_parameters = filter_class.request_additional_parameters is not Filter.Filter.request_additional_parameters
+        if has_parameters != get_info(name).has_parameters:
+            problems.append('{} has_parameters should be {}'.format(name, has_parameters))
+    for name, filter_class in Filter.get_filter_map().items():
+        if name not in loaded:
+            problems.append('{} ("{}") is missing from the registry'.format(filter_class.__name__, name))
+        elif loaded[name] is not filter_class:
+            problems.append('"{}" is registered as {} but is {}'.format(name, loaded[name].__name__,
+                                                                        filter_class.__name__))
+    return problems
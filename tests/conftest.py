@@ -0,0 +1,24 @@
+import os
+
+import PIL.Image
+import numpy as np
+import pytest
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def skyline():
+    """
+    A photo with sky, edges and fine detail, small enough for the slow filters
+    """
+    with PIL.Image.open(os.path.join(REPOSITORY, 'skyline.jpg')) as image:
+        return image.convert('RGB')
+
+
+@pytest.fixture
+def noise():
+    """
+    Random RGB pixels, the worst case for rounding and clipping differences
+    """
+    return PIL.Image.fromarray(np.random.RandomState(3).randint(0, 256, (90, 120, 3), dtype=np.uint8))
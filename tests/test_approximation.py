@@ -0,0 +1,47 @@
+import os
+
+import numpy as np
+import PIL.Image
+import pytest
+
+import benchmark_filters
+import registry
+from tests.conftest import REPOSITORY
+
+CV2Filters = pytest.importorskip('CV2Filters')
+
+# The bounds of the README table: (mean levels, 99th percentile levels, fraction of pixels that differ)
+BOUNDS = {
+    'Detail Enhance': (0.8, 9, None),
+    'Pencil Edges': (None, None, 0.007),
+    'Cartoon': (1.7, None, 0.007),
+}
+
+
+@pytest.fixture(scope='module', params=['synthetic', 'photo'])
+def large_image(request):
+    if request.param == 'synthetic':
+        return benchmark_filters.synthetic_image(1000, 'RGB')
+    # The skyline photo enlarged, so that the working resolution shrinks it
+    with PIL.Image.open(os.path.join(REPOSITORY, 'skyline.jpg')) as image:
+        return image.convert('RGB').resize((1500, 843), PIL.Image.LANCZOS)
+
+
+@pytest.mark.parametrize('scale', [0.3, 0.6])
+@pytest.mark.parametrize('name', sorted(BOUNDS))
+def test_approximate_mode_stays_within_the_documented_error(large_image, name, scale):
+    megapixels = large_image.width * large_image.height * scale ** 2 / 1e6
+    assert CV2Filters.working_scale(np.asarray(large_image), megapixels) < 1
+    image_filter = registry.load(name)()
+    assert image_filter.footprint(megapixels) is None
+
+    exact = np.asarray(image_filter.apply_filter(large_image), dtype=np.int16)
+    approximate = np.asarray(image_filter.apply_filter(large_image, megapixels), dtype=np.int16)
+    difference = np.abs(approximate - exact)
+    mean, p99, differing = BOUNDS[name]
+    if mean is not None:
+        assert difference.mean() <= mean
+    if p99 is not None:
+        assert np.percentile(difference, 99) <= p99
+    if differing is not None:
+        assert difference.any(axis=-1).mean() <= differing
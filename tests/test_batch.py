@@ -0,0 +1,62 @@
+import logging
+import os
+
+import numpy as np
+import pytest
+import PIL.Image
+
+import batch
+
+
+def test_whole_image_filters():
+    assert batch.whole_image_filters([('blur', []), ('Detail Enhance', []), ('gaussian', [2])]) == ['Detail Enhance']
+
+
+def test_memory_budget_matches_one_piece(skyline, tmp_path):
+    path = str(tmp_path / 'skyline.png')
+    skyline.save(path)
+    chain = [('blur', []), ('Pencil Sketch', [])]
+    for directory in ('whole', 'tiled'):
+        (tmp_path / directory).mkdir()
+    one_piece = batch.process_file(path, chain, str(tmp_path / 'whole'), fuse=False)
+    tiled = batch.process_file(path, chain, str(tmp_path / 'tiled'), memory_budget=1024 * 1024, fuse=False)
+    with PIL.Image.open(one_piece[0]) as expected, PIL.Image.open(tiled[0]) as result:
+        np.testing.assert_array_equal(np.asarray(result), np.asarray(expected))
+
+
+def test_memory_budget_warns_for_whole_image_filters(skyline, tmp_path, caplog):
+    path = str(tmp_path / 'skyline.png')
+    skyline.save(path)
+    output_dir = tmp_path / 'out'
+    output_dir.mkdir()
+    with caplog.at_level(logging.WARNING, logger='batch'):
+        batch.run_batch([path], [('Detail Enhance', [])], str(output_dir), workers=1, memory_budget=64 * 1024)
+    assert 'Detail Enhance' in caplog.text
+    assert os.path.exists(str(output_dir / 'skyline.png'))
+
+
+def test_outputs_keep_the_paths_below_the_glob_root(noise, tmp_path):
+    for directory in ('a', 'b'):
+        (tmp_path / 'in' / directory).mkdir(parents=True)
+        noise.save(str(tmp_path / 'in' / directory / 'x.png'))
+    pattern = str(tmp_path / 'in' / '**' / '*.png')
+    paths = batch.expand_inputs([pattern])
+    output_dir = str(tmp_path / 'out')
+    root = batch.input_root([pattern])
+    assert root == str(tmp_path / 'in')
+    _, failures = batch.run_batch(paths, [('invert', [])], output_dir, workers=1, root=root)
+    assert not failures
+    for directory in ('a', 'b'):
+        assert os.path.exists(os.path.join(output_dir, directory, 'x.png'))
+
+
+def test_colliding_outputs_are_refused(noise, tmp_path):
+    for name in ('x.jpg', 'x.png'):
+        noise.save(str(tmp_path / name))
+    paths = batch.expand_inputs([str(tmp_path / 'x.*')])
+    output_dir = str(tmp_path / 'out')
+    assert batch.output_collisions(paths, output_dir, 'png', str(tmp_path)) == {
+        os.path.join(output_dir, 'x.png'): paths}
+    with pytest.raises(ValueError):
+        batch.run_batch(paths, [('invert', [])], output_dir, workers=1, output_format='png', root=str(tmp_path))
+    assert not os.path.exists(output_dir)
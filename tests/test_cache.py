@@ -0,0 +1,73 @@
+import os
+import threading
+
+import numpy as np
+
+import cache
+
+
+def directory_size(directory):
+    return sum(entry.stat().st_size for entry in os.scandir(directory) if entry.name.endswith('.npy'))
+
+
+def test_disk_cache_stays_under_its_size(tmp_path):
+    array = np.zeros((100, 100, 3), np.uint8)
+    disk = cache.DiskCache(str(tmp_path), max_bytes=5 * array.nbytes)
+    for key in range(20):
+        disk.put(str(key), array)
+        assert directory_size(str(tmp_path)) <= disk.max_bytes
+    assert disk.total_bytes == directory_size(str(tmp_path))
+
+
+def test_disk_cache_lists_its_directory_only_when_full(tmp_path, monkeypatch):
+    array = np.zeros((10, 10), np.uint8)
+    disk = cache.DiskCache(str(tmp_path), max_bytes=1024 * 1024)
+    scans = []
+    scandir = os.scandir
+    monkeypatch.setattr(os, 'scandir', lambda path: scans.append(path) or scandir(path))
+    for key in range(10):
+        disk.put(str(key), array)
+    assert len(scans) == 1
+    disk.put('0', array)
+    assert disk.total_bytes == directory_size(str(tmp_path))
+
+
+def test_disk_hits_are_not_copied(tmp_path, monkeypatch):
+    results = cache.ResultCache(disk_directory=str(tmp_path))
+    results.disk.put('key', np.arange(12, dtype=np.uint8))
+    loaded = []
+    get = results.disk.get
+    monkeypatch.setattr(results.disk, 'get', lambda key: loaded.append(get(key)) or loaded[-1])
+    array = results.get('key')
+    assert array is loaded[0] and not array.flags.writeable
+    assert results.get('key') is array
+    assert (results.hits, results.misses) == (2, 0)
+
+
+def test_hits_and_misses_are_counted_from_several_threads(tmp_path):
+    results = cache.ResultCache(disk_directory=str(tmp_path))
+    results.put('memory', np.zeros(4, np.uint8))
+
+    def look_up():
+        for _ in range(200):
+            results.get('memory')
+            results.get('missing')
+
+    threads = [threading.Thread(target=look_up) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert (results.hits, results.misses) == (800, 800)
+
+
+def test_threads_writing_the_same_key_do_not_share_a_temporary_file(tmp_path):
+    disk = cache.DiskCache(str(tmp_path))
+    arrays = [np.full((64, 64), value, np.uint8) for value in range(8)]
+    threads = [threading.Thread(target=disk.put, args=('key', array)) for array in arrays]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert os.listdir(str(tmp_path)) == ['key.npy']
+    assert any(np.array_equal(disk.get('key'), array) for array in arrays)
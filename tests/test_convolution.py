@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+import Filter
+import benchmark_convolution
+import convolution
+
+
+@pytest.mark.parametrize('kernel_name', sorted(benchmark_convolution.KERNELS))
+def test_apply_kernel_matches_per_pixel_loop(kernel_name):
+    kernel = benchmark_convolution.KERNELS[kernel_name]
+    image = benchmark_convolution.synthetic_image(40, 32)
+    kernel_filter = Filter.Filter()
+    kernel_filter.kernel = kernel.tolist()
+
+    expected = np.asarray(benchmark_convolution.apply_kernel_loop(kernel_filter.kernel, image)).astype(int)
+    result = np.asarray(kernel_filter.apply_kernel(image)).astype(int)
+
+    # The loop leaves the border black and truncates where the engine reflects and rounds
+    halo = len(kernel) // 2
+    assert np.abs(result - expected)[halo:-halo, halo:-halo].max() <= 1
+
+
+@pytest.mark.parametrize('kernel_name', sorted(benchmark_convolution.KERNELS))
+def test_methods_agree(kernel_name):
+    weights = np.transpose(benchmark_convolution.KERNELS[kernel_name])
+    pixels = np.asarray(benchmark_convolution.synthetic_image(37, 29))
+    expected = convolution.correlate_uint8(pixels, weights, method='direct')
+    methods = ['fft'] + (['separable'] if convolution.separate(weights) is not None else [])
+    if convolution.has_opencv():
+        methods.append('opencv')
+    for method in methods:
+        # Sums that land on .5 may round either way after the FFT
+        result = convolution.correlate_uint8(pixels, weights, method=method)
+        assert np.abs(result.astype(int) - expected).max() <= 1, method
+
+
+def test_batch_matches_single_images():
+    weights = np.transpose(benchmark_convolution.KERNELS['gaussian 5x5'])
+    stack = np.random.RandomState(2).randint(0, 256, (3, 20, 24, 3), dtype=np.uint8)
+    batch = convolution.correlate_uint8_batch(stack, weights)
+    for image, filtered in zip(stack, batch):
+        np.testing.assert_array_equal(filtered, convolution.correlate_uint8(image, weights))
+
+
+@pytest.mark.parametrize('size', [(120, 160), (281, 500)])
+@pytest.mark.parametrize('sigma_of_short_side', [None, 1 / 3.0, 1.0])
+def test_pyramid_blur_stays_within_the_documented_error(skyline, size, sigma_of_short_side):
+    cv2 = pytest.importorskip('cv2')
+    height, width = size
+    pixels = cv2.resize(np.asarray(skyline), (width, height), interpolation=cv2.INTER_AREA)
+    sigmas = [8, 25, 40] if sigma_of_short_side is None else [height * sigma_of_short_side]
+    for sigma in sigmas:
+        assert height // convolution.pyramid_factor(sigma, height, width) >= convolution.PYRAMID_MIN_REDUCED_SIZE
+        exact = cv2.GaussianBlur(pixels, (0, 0), sigma, borderType=cv2.BORDER_REFLECT_101)
+        error = np.abs(convolution.pyramid_gaussian_blur(pixels, sigma).astype(np.int16) - exact)
+        assert error.mean() < (1.7 if sigma_of_short_side == 1.0 else 1.0), sigma
+        assert np.percentile(error, 99.9) <= 4, sigma
+        assert error.max() <= 8, sigma
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+import registry
+
+
+@pytest.mark.parametrize('mode', ['L', 'RGB', 'RGBA'])
+@pytest.mark.parametrize('name', registry.filter_names())
+def test_every_filter_handles_every_mode(skyline, name, mode):
+    image = skyline.convert(mode)
+    image_filter = registry.load(name)()
+    args = image_filter.default_parameters()
+    result = image_filter.apply_filter(image, *args)
+    assert result.size == image.size
+
+    stack = np.stack([np.asarray(image)] * 2)
+    batch = image_filter.apply_batch(stack, *args)
+    assert batch.shape[:3] == stack.shape[:3]
+
+
+@pytest.mark.parametrize('mode', ['L', 'RGB', 'RGBA'])
+@pytest.mark.parametrize('name', ['gotham', 'riverdale'])
+def test_curve_filters_stack_matches_single_images(skyline, name, mode):
+    image = skyline.convert(mode)
+    image_filter = registry.load(name)()
+    result = np.asarray(image_filter.apply_filter(image))
+    assert result.shape == (image.height, image.width, 3)
+    batch = image_filter.apply_batch(np.stack([np.asarray(image)] * 2))
+    np.testing.assert_array_equal(batch[1], result)
+
+
+@pytest.mark.parametrize('mode', ['L', 'RGB', 'RGBA'])
+@pytest.mark.parametrize('name, args', [(name, None) for name in registry.filter_names()] + [('gaussian', [9])])
+def test_stack_matches_single_images(skyline, name, args, mode):
+    image = skyline.convert(mode)
+    image_filter = registry.load(name)()
+    if args is None:
+        args = image_filter.default_parameters()
+    result = np.asarray(image_filter.apply_filter(image, *args), dtype=np.int16)
+    batch = image_filter.apply_batch(np.stack([np.asarray(image)] * 2), *args)
+    assert np.abs(batch[1].astype(np.int16) - result).max() <= 1
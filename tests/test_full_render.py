@@ -0,0 +1,164 @@
+import threading
+import time
+
+import PIL.Image
+import numpy as np
+
+import cache
+import jobs
+import main_ui
+import registry
+import undo
+
+
+class FakeScheduler:
+    """
+    Stands in for Tk's after() and after_cancel(), running the callbacks in order of their due time
+    """
+
+    def __init__(self):
+        self.now = 0
+        self.pending = {}
+        self.next_id = 0
+
+    def after(self, delay, callback, *args):
+        self.next_id += 1
+        self.pending[self.next_id] = (self.now + delay, self.next_id, callback, args)
+        return self.next_id
+
+    def after_cancel(self, after_id):
+        self.pending.pop(after_id, None)
+
+    def run_until(self, condition, timeout=20.0):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            if not self.pending:
+                time.sleep(0.01)
+                continue
+            due, after_id, callback, args = min(self.pending.values(), key=lambda entry: entry[:2])
+            del self.pending[after_id]
+            self.now = max(self.now, due)
+            time.sleep(0.001)
+            callback(*args)
+        return condition()
+
+
+class Switch:
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
+def make_window(image):
+    """
+    A main_ui.Window without widgets, driven by a FakeScheduler
+    """
+    window = main_ui.Window.__new__(main_ui.Window)
+    scheduler = FakeScheduler()
+    window.after = scheduler.after
+    window.after_cancel = scheduler.after_cancel
+    window.preview_mode = Switch(True)
+    window.approximate_mode = Switch(False)
+    window.job_runner = jobs.JobRunner(window)
+    window.result_cache = cache.ResultCache()
+    window.history = undo.UndoHistory()
+    window.original_image = window.modified_image = image
+    window.original_proxy = window.preview_image = image.resize((image.width // 2, image.height // 2))
+    window.preview_scale = 0.5
+    window.source_key = cache.image_digest(image)
+    window.proxy_key = cache.derive_key(window.source_key, 'proxy', window.original_proxy.size)
+    window.applied_chain = []
+    window.preview_steps = window.rendered_steps = 0
+    window.full_render_after_id = None
+    window.full_render_waiters = []
+    window.statuses = []
+    window.show_status = window.statuses.append
+    window.update_displayed_modified_image = lambda: None
+    window.update_stage_list = lambda: None
+    return window, scheduler
+
+
+def image():
+    return PIL.Image.fromarray(np.random.RandomState(4).randint(0, 256, (64, 80, 3), dtype=np.uint8))
+
+
+def test_save_waiting_for_a_preview_is_not_dropped():
+    window, scheduler = make_window(image())
+    saved = []
+    window.apply_and_show_filter('invert', registry.load('invert'))
+    # Save is pressed while the preview is still running
+    window.render_full_resolution(then=lambda: saved.append(window.modified_image), description='Save')
+    assert scheduler.run_until(lambda: saved)
+    assert window.rendered_steps == 1
+    expected = np.asarray(registry.load('invert')().apply_filter(window.original_image))
+    np.testing.assert_array_equal(np.asarray(saved[0]), expected)
+
+
+def test_save_waits_for_filters_applied_during_its_render():
+    window, scheduler = make_window(image())
+    saved = []
+    window.apply_and_show_filter('invert', registry.load('invert'))
+    window.render_full_resolution(then=lambda: saved.append(len(window.applied_chain)), description='Save')
+    # Another filter is clicked while the full render the save waits for may be running
+    scheduler.run_until(lambda: window.preview_steps == 1)
+    window.apply_and_show_filter('blur', registry.load('blur'))
+    assert scheduler.run_until(lambda: saved)
+    assert saved == [2] and window.rendered_steps == 2
+
+
+def test_cancel_tells_the_user_the_save_did_not_happen():
+    window, scheduler = make_window(image())
+    saved = []
+    window.apply_and_show_filter('invert', registry.load('invert'))
+    window.render_full_resolution(then=lambda: saved.append(True), description='Save')
+    window.cancel_button_pressed()
+    scheduler.run_until(lambda: False, timeout=0.5)
+    assert not saved
+    assert 'Save cancelled' in window.statuses[-1]
+
+
+def test_save_pressed_during_a_preview_writes_the_filtered_image(tmp_path, monkeypatch):
+    window, scheduler = make_window(image())
+    window.save_runner = jobs.JobRunner(window, supersede=False)
+    path = str(tmp_path / 'saved.png')
+    monkeypatch.setattr(main_ui.filedialog, 'asksaveasfilename', lambda: path)
+    monkeypatch.setattr(main_ui.simpledialog, 'askinteger', lambda *args, **kwargs: kwargs['initialvalue'])
+    window.apply_and_show_filter('invert', registry.load('invert'))
+    window.save_file()
+    assert scheduler.run_until(lambda: any(status.startswith('Saved') for status in window.statuses if status))
+    expected = np.asarray(registry.load('invert')().apply_filter(window.original_image))
+    with PIL.Image.open(path) as saved:
+        np.testing.assert_array_equal(np.asarray(saved), expected)
+
+
+def test_a_second_save_waits_for_the_first(tmp_path, monkeypatch):
+    window, scheduler = make_window(image())
+    window.save_runner = jobs.JobRunner(window, supersede=False)
+    paths = [str(tmp_path / 'first.png'), str(tmp_path / 'second.png')]
+    monkeypatch.setattr(main_ui.filedialog, 'asksaveasfilename', lambda: paths.pop(0))
+    monkeypatch.setattr(main_ui.simpledialog, 'askinteger', lambda *args, **kwargs: kwargs['initialvalue'])
+    # The first save is still encoding when the second one is submitted
+    second_submitted = threading.Event()
+    save_image = main_ui.image_io.save_image
+
+    def slow_save(img, path, **options):
+        if path.endswith('first.png'):
+            second_submitted.wait(5)
+        return save_image(img, path, **options)
+
+    monkeypatch.setattr(main_ui.image_io, 'save_image', slow_save)
+
+    window.apply_and_show_filter('invert', registry.load('invert'))
+    window.save_file()
+    assert scheduler.run_until(lambda: 'Saving first.png' in window.statuses)
+    window.save_file()
+    assert scheduler.run_until(lambda: 'Saving second.png' in window.statuses)
+    second_submitted.set()
+    assert scheduler.run_until(lambda: len([status for status in window.statuses
+                                            if status and status.startswith('Saved')]) == 2)
+    expected = np.asarray(registry.load('invert')().apply_filter(window.original_image))
+    for name in ('first.png', 'second.png'):
+        with PIL.Image.open(str(tmp_path / name)) as saved:
+            np.testing.assert_array_equal(np.asarray(saved), expected)
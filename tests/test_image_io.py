@@ -0,0 +1,32 @@
+import numpy as np
+import PIL.Image
+
+import image_io
+
+
+def large_jpeg(tmp_path):
+    path = str(tmp_path / 'large.jpg')
+    gradient = np.linspace(0, 255, 2048, dtype=np.uint8)
+    PIL.Image.fromarray(np.dstack([np.tile(gradient, (1536, 1))] * 3)).save(path, quality=90)
+    return path
+
+
+def test_jpeg_is_decoded_at_a_reduced_size_covering_the_requested_one(tmp_path):
+    path = large_jpeg(tmp_path)
+    assert image_io.read_image(path).size == (2048, 1536)
+    preview = image_io.read_image(path, size=(300, 200))
+    assert preview.size == (512, 384)
+    assert preview.mode == 'RGB'
+
+
+def test_prefetcher_previews_until_the_full_image_is_decoded(tmp_path):
+    path = large_jpeg(tmp_path)
+    reader = image_io.Prefetcher()
+    try:
+        assert reader.read_preview(path, (300, 200)).size == (512, 384)
+        reader.prefetch(path)
+        reader.prefetched[path][1].result()
+        assert reader.read_preview(path, (300, 200)).size == (2048, 1536)
+        assert reader.read(path).size == (2048, 1536)
+    finally:
+        reader.shutdown()
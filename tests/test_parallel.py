@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+import parallel
+import pipeline
+import registry
+
+
+@pytest.mark.parametrize('chain', [
+    [('sharpen', [])],
+    [('gaussian', [9])],
+    [('gaussian', [40])],
+    [('blur', []), ('gaussian', [20]), ('Pencil Sketch', [])],
+])
+@pytest.mark.parametrize('band_count', [3, 7])
+def test_bands_match_whole_image(skyline, chain, band_count):
+    # Runs the bands in this process the way parallel._filter_band does in the workers
+    filter_pipeline = pipeline.Pipeline.from_chain([(registry.load(name), args) for name, args in chain])
+    pixels = np.asarray(skyline)
+    expected = filter_pipeline.run(pixels, report_progress=False)
+    result = np.empty_like(expected)
+    bands = list(parallel.iter_bands(pixels.shape[0], band_count, filter_pipeline.footprint(),
+                                     filter_pipeline.alignment()))
+    assert bands[0][0] == 0 and bands[-1][1] == pixels.shape[0]
+    for top, bottom, pad_top, pad_bottom in bands:
+        assert pad_top % filter_pipeline.alignment() == 0
+        band = filter_pipeline.run(np.array(pixels[pad_top:pad_bottom]), report_progress=False)
+        result[top:bottom] = band[top - pad_top:bottom - pad_top]
+    np.testing.assert_array_equal(result, expected)
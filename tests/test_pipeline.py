@@ -0,0 +1,29 @@
+import numpy as np
+import PIL.Image
+
+import batch
+import pipeline
+import registry
+
+
+def apply_one_by_one(image, names):
+    for name in names:
+        image = registry.load(name)().apply_filter(image)
+    return image
+
+
+def test_batch_applies_filters_one_by_one_by_default(skyline, tmp_path):
+    path = str(tmp_path / 'skyline.png')
+    skyline.save(path)
+    (tmp_path / 'out').mkdir()
+    names = ['sharpen', 'edge enhance more']
+    output_path = batch.process_file(path, [(name, []) for name in names], str(tmp_path / 'out'))[0]
+    with PIL.Image.open(output_path) as result:
+        np.testing.assert_array_equal(np.asarray(result), np.asarray(apply_one_by_one(skyline, names)))
+
+
+def test_fused_lookup_tables_are_exact(skyline):
+    chain = [(registry.load('invert'), []), (registry.load('invert'), []), (registry.load('invert'), [])]
+    fused = pipeline.Pipeline.from_chain(chain, fuse=True)
+    assert len(fused.steps) == 1
+    np.testing.assert_array_equal(np.asarray(fused.run(skyline)), np.asarray(apply_one_by_one(skyline, ['invert'])))
@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+import registry
+import tiling
+
+# Filters with a finite halo, with the arguments to apply them with
+TILED_FILTERS = [('blur', []), ('sharpen', []), ('gaussian', [3]), ('gaussian', [9]), ('gaussian', [40]),
+                 ('Pencil Sketch', []), ('Bilateral', []), ('invert', [])]
+
+
+@pytest.mark.parametrize('name, args', TILED_FILTERS)
+def test_tiles_match_whole_image(skyline, name, args):
+    image_filter = registry.load(name)()
+    expected = np.asarray(image_filter.apply_filter(skyline, *args))
+    result = tiling.apply_tiled(image_filter, skyline, *args, tile_size=64)
+    np.testing.assert_array_equal(np.asarray(result), expected)
+
+
+@pytest.mark.parametrize('tile_size', [50, 100])
+def test_tiles_of_large_blurs_line_up_with_the_reduced_image(skyline, tile_size):
+    blur = registry.load('gaussian')()
+    assert blur.alignment(40) > 1
+    expected = np.asarray(blur.apply_filter(skyline, 40))
+    result = tiling.apply_tiled(blur, skyline, 40, tile_size=tile_size)
+    np.testing.assert_array_equal(np.asarray(result), expected)
+
+
+def test_whole_image_filters_are_refused(skyline):
+    with pytest.raises(ValueError):
+        tiling.apply_tiled(registry.load('Detail Enhance')(), skyline, tile_size=64)
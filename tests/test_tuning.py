@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+
+import pipeline
+import registry
+import tiling
+import tuning
+
+
+@pytest.fixture
+def size_dependent_table(skyline):
+    # The reference below the skyline's size, numpy convolution from its size up, so that tiles would pick the
+    # reference if their own size counted
+    full_size = skyline.width * skyline.height
+    tuning.set_table({'version': tuning.TABLE_VERSION,
+                      'backends': {'SharpenFilter': {'RGB': {'any': {'20000': registry.PIL_BACKEND,
+                                                                     str(full_size): registry.NUMPY_BACKEND}}}}})
+    yield
+    tuning.set_table(None)
+
+
+def test_tiles_use_the_backend_of_the_whole_image(skyline, size_dependent_table, monkeypatch):
+    sharpen = registry.load('sharpen')()
+    expected = np.asarray(tuning.apply_filter(sharpen, skyline, []))
+    chosen = []
+    choose_backend = tuning.choose_backend
+    monkeypatch.setattr(tuning, 'choose_backend',
+                        lambda *args: chosen.append(args[2]) or choose_backend(*args))
+
+    tiled = tiling.apply_tiled(sharpen, skyline, tile_size=64)
+    assert set(chosen) == {skyline.width * skyline.height}
+    assert np.array_equal(np.asarray(tiled), expected)
+
+
+def test_pipeline_pieces_use_the_backend_of_the_whole_image(skyline, size_dependent_table):
+    filter_pipeline = pipeline.Pipeline.from_chain([(registry.load('sharpen'), [])])
+    pixels = np.asarray(skyline)
+    expected = filter_pipeline.run(pixels, report_progress=False)[100:150]
+    band = filter_pipeline.run(np.array(pixels[99:151]), report_progress=False,
+                               pixel_count=skyline.width * skyline.height)
+    assert np.array_equal(band[1:-1], expected)
+
+
+def test_backends_differing_too_much_in_some_pixels_are_rejected(monkeypatch):
+    def measure(f, image, args, repeat):
+        return [{'backend': registry.PIL_BACKEND, 'seconds': 2.0, 'mean_error': 0.0, 'max_error': 0.0},
+                {'backend': registry.NUMPY_BACKEND, 'seconds': 1.0, 'mean_error': 0.2, 'max_error': 200.0}]
+
+    monkeypatch.setattr(tuning, 'measure', measure)
+    table = tuning.tune(['sharpen'], sizes=(16,), modes=('L',))
+    assert table['backends']['SharpenFilter']['L']['any'] == {'256': registry.PIL_BACKEND}
+    table = tuning.tune(['sharpen'], sizes=(16,), modes=('L',), max_error=255)
+    assert table['backends']['SharpenFilter']['L']['any'] == {'256': registry.NUMPY_BACKEND}
+
+
+def test_kernel_backends_leave_the_borders_like_pil():
+    table = tuning.tune(['sharpen', 'contour'], sizes=(64,), modes=('RGB',), repeat=1)
+    assert max(result['max_error'] for result in table['measurements']) <= 1
+
+
+def test_gaussian_blurs_are_tuned_per_radius_range():
+    table = tuning.tune(['gaussian'], sizes=(32,), modes=('L',), repeat=1)
+    assert set(table['backends']['GaussianFilter']['L']) == {'radius>=0', 'radius>=2', 'radius>=4', 'radius>=8'}
+
+    gaussian = registry.load('gaussian')()
+    assert [gaussian.dispatch_bucket(radius) for radius in (1, 3, 5, 40)] == \
+        ['radius>=0', 'radius>=2', 'radius>=4', 'radius>=8']
+    tuning.set_table({'version': tuning.TABLE_VERSION,
+                      'backends': {'GaussianFilter': {'L': {'radius>=8': {'1024': registry.OPENCV_BACKEND}}}}})
+    try:
+        assert tuning.choose_backend('GaussianFilter', 'L', 1024, gaussian.dispatch_bucket(20)) == \
+            registry.OPENCV_BACKEND
+        assert tuning.choose_backend('GaussianFilter', 'L', 1024, gaussian.dispatch_bucket(2)) is None
+    finally:
+        tuning.set_table(None)
+
+
+def test_tables_of_an_older_layout_are_ignored(tmp_path):
+    path = tmp_path / 'dispatch.json'
+    path.write_text('{"backends": {"SharpenFilter": {"RGB": {"65536": "numpy"}}}}')
+    tuning.set_table(None)
+    try:
+        assert tuning.load_table(str(path)) == {}
+    finally:
+        tuning.set_table(None)
@@ -0,0 +1,46 @@
+import threading
+
+import numpy as np
+
+import cache
+import registry
+import undo
+
+
+def test_checkpoints_and_result_cache_share_the_memory_budget(noise):
+    result_cache = cache.ResultCache()
+    history = undo.UndoHistory(checkpoint_interval=1, max_bytes=10 * noise.width * noise.height * 3,
+                               result_cache=result_cache)
+    assert result_cache.max_bytes == history.max_bytes
+    for index in range(8):
+        result_cache.put(str(index), np.asarray(noise))
+    assert result_cache.size <= history.max_bytes
+
+    history.record_render([(registry.load('invert'), [])], noise)
+    history.executor.submit(lambda: None).result()
+    assert history.memory_used() > 0
+    assert result_cache.max_bytes == history.max_bytes - history.memory_used()
+    assert result_cache.size + history.memory_used() <= history.max_bytes
+
+    history.reset()
+    assert result_cache.max_bytes == history.max_bytes
+    history.shutdown()
+
+
+def test_checkpoints_count_their_uncompressed_image_until_compressed(noise):
+    result_cache = cache.ResultCache()
+    history = undo.UndoHistory(checkpoint_interval=1, max_bytes=100 * noise.width * noise.height * 3,
+                               result_cache=result_cache)
+    release = threading.Event()
+    history.executor.submit(release.wait, 5)
+
+    history.record_render([(registry.load('invert'), [])], noise)
+    assert history.memory_used() == noise.width * noise.height * 3
+    assert result_cache.max_bytes == history.max_bytes - history.memory_used()
+
+    release.set()
+    history.executor.submit(lambda: None).result()
+    compressed = len(undo.compress_image(noise))
+    assert history.memory_used() == compressed
+    assert result_cache.max_bytes == history.max_bytes - compressed
+    history.shutdown()
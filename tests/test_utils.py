@@ -0,0 +1,60 @@
+import collections
+
+import numpy as np
+import pytest
+
+import utils
+
+trapezoid = getattr(np, 'trapezoid', None) or np.trapz
+
+
+def complex_fft_gaussian_filter(img, blur_intensity):
+    # gaussian_filter as it was before it used real FFTs padded to fast sizes and spatial passes
+    t = np.linspace(-10, 10, 30)
+    bump = np.exp(-blur_intensity*t**2)
+    bump /= trapezoid(bump)
+    kernel = bump[:, np.newaxis] * bump[np.newaxis, :]
+    kernel_ft = np.fft.fftn(kernel, s=img.shape[:2], axes=(0, 1))
+    img_ft = np.fft.fftn(img, axes=(0, 1))
+    if img.ndim > 2:
+        kernel_ft = kernel_ft[:, :, np.newaxis]
+    return np.fft.ifft2(kernel_ft * img_ft, axes=(0, 1)).real
+
+
+@pytest.fixture
+def spectra(monkeypatch):
+    monkeypatch.setattr(utils, '_kernel_spectra', collections.OrderedDict())
+    return utils._kernel_spectra
+
+
+# 1 and 5 keep at most utils.SPATIAL_MAX_TAPS significant taps, 0.05 and 0.5 go through the FFT. The sizes are odd
+# and have large prime factors, so the transforms are padded.
+@pytest.mark.parametrize('blur_intensity', [0.05, 0.5, 1, 5])
+@pytest.mark.parametrize('shape', [(97, 131, 3), (37, 53)])
+def test_gaussian_filter_matches_the_complex_fft(noise, blur_intensity, shape):
+    img = np.resize(np.asarray(noise, dtype=np.float64), shape)
+    expected = complex_fft_gaussian_filter(img, blur_intensity)
+    result = utils.gaussian_filter(img, blur_intensity)
+    assert result.dtype == np.float32
+    assert np.allclose(result, expected, atol=1e-2)
+
+
+def test_kernel_spectra_are_reused_for_the_same_shape_and_intensity(noise, spectra):
+    img = np.asarray(noise, dtype=np.float32)
+    utils.gaussian_filter(img, 0.05)
+    cached = list(spectra.values())
+    # One row less pads to the same fast transform size
+    for reused in (img, img[:-1]):
+        utils.gaussian_filter(reused, 0.05)
+        assert len(spectra) == 1 and next(iter(spectra.values())) is cached[0]
+    utils.gaussian_filter(img[:40], 0.05)
+    utils.gaussian_filter(img, 0.1)
+    assert len(spectra) == 3
+
+
+def test_kernel_spectra_evict_the_least_recently_used(noise, spectra, monkeypatch):
+    monkeypatch.setattr(utils, 'KERNEL_SPECTRA_CACHE_SIZE', 2)
+    img = np.asarray(noise, dtype=np.float32)
+    for blur_intensity in (0.05, 0.1, 0.05, 0.2):
+        utils.gaussian_filter(img, blur_intensity)
+    assert [blur_intensity for _, blur_intensity in spectra] == [0.05, 0.2]
@@ -0,0 +1,64 @@
+import os
+
+import PIL.Image
+import numpy as np
+import pytest
+
+import pipeline
+import registry
+
+video = pytest.importorskip('video')
+
+
+@pytest.mark.parametrize('name', ['Bilateral', 'Cartoon', 'Pencil Sketch'])
+def test_streamed_frames_match_still_images(skyline, tmp_path, name):
+    source = tmp_path / 'frames'
+    source.mkdir()
+    frames = [skyline.crop((left, 0, left + 200, 150)) for left in (0, 150, 300)]
+    for index, frame in enumerate(frames):
+        frame.save(str(source / 'frame_{}.png'.format(index)))
+    output = tmp_path / 'filtered'
+
+    chain = [(registry.load(name), [])]
+    stats = video.run_stream(str(source), str(output), chain, queue_depth=1)
+    assert stats.written == len(frames)
+
+    for index, frame in enumerate(frames):
+        expected = pipeline.Pipeline.from_chain(chain).run(np.array(frame), report_progress=False)
+        if expected.ndim == 2:
+            expected = np.dstack([expected] * 3)
+        written = np.asarray(PIL.Image.open(os.path.join(str(output), 'frame_{:06d}.png'.format(index))))
+        assert np.array_equal(written, expected[..., :3]), 'frame {}'.format(index)
+
+
+def test_directories_are_read_without_their_other_files(skyline, tmp_path):
+    source = tmp_path / 'frames'
+    source.mkdir()
+    for index in range(2):
+        skyline.save(str(source / 'frame_{}.jpg'.format(index)))
+    (source / 'Thumbs.db').write_bytes(b'not an image')
+    (source / 'notes.txt').write_text('shot at dusk')
+
+    stats = video.run_stream(str(source), str(tmp_path / 'filtered'), [(registry.load('invert'), [])])
+    assert stats.written == 2
+
+
+def test_webm_files_are_written_with_vp8(skyline, tmp_path):
+    output = str(tmp_path / 'out.webm')
+    sink = video.open_sink(output, 25.0, (160, 96))
+    frame = np.ascontiguousarray(np.asarray(skyline.resize((160, 96)))[..., ::-1])
+    try:
+        for index in range(3):
+            sink.write(index, frame)
+    finally:
+        sink.close()
+
+    source = video.CaptureSource(output)
+    try:
+        buffer = np.empty_like(frame)
+        decoded = 0
+        while source.read(buffer) is not None:
+            decoded += 1
+        assert decoded == 3
+    finally:
+        source.close()
@@ -0,0 +1,149 @@
+import logging
+import math
+import os
+
+import PIL.Image
+import numpy as np
+
+import image_io
+import pipeline
+import tuning
+
+logger = logging.getLogger(__name__)
+
+# Default peak working memory for one tile, in bytes.
+DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+
+# Bytes of working memory per sample of a tile: the input crop, its PIL copy, the filter's own float intermediates
+# and the output tile. Deliberately generous, so the budget holds for the float64 filters as well.
+BYTES_PER_SAMPLE = 48
+
+MIN_TILE_SIZE = 16
+
+
+def tile_size_for_budget(halo, channels, memory_budget=DEFAULT_MEMORY_BUDGET):
+    """
+    Returns the largest square tile edge whose halo-padded working set fits in the memory budget
+    """
+    padded_edge = int(math.sqrt(memory_budget / float(channels * BYTES_PER_SAMPLE)))
+    tile_size = padded_edge - 2 * halo
+    if tile_size < MIN_TILE_SIZE:
+        raise ValueError('A memory budget of {} bytes is too small for a halo of {} pixels'.format(memory_budget,
+                                                                                                  halo))
+    return tile_size
+
+
+def iter_tiles(height, width, tile_size, halo):
+    """
+    Yields (core, padded) regions covering the image, each as (top, left, bottom, right). The padded region grows the
+    core by the halo on every side, clipped to the image.
+    """
+    for top in range(0, height, tile_size):
+        bottom = min(top + tile_size, height)
+        for left in range(0, width, tile_size):
+            right = min(left + tile_size, width)
+            padded = (max(top - halo, 0), max(left - halo, 0), min(bottom + halo, height), min(right + halo, width))
+            yield (top, left, bottom, right), padded
+
+
+def process_tiles(array, function, halo, memory_budget=DEFAULT_MEMORY_BUDGET, tile_size=None, output=None,
+                  progress=None, alignment=1):
+    """
+    Runs function over overlapping tiles of an (H, W) or (H, W, C) array and writes each tile's core into output as
+    soon as it is done. function gets the halo-padded tile as an array and must return an array of the same height
+    and width. array may be a numpy.memmap, and output may be one (see open_output), in which case only a tile's
+    worth of pixels is ever held in memory. The padded tiles start at multiples of alignment, see Filter.alignment.
+    Returns output.
+    """
+    if halo is None:
+        raise ValueError('The filter depends on the whole image, so it can not be applied in tiles')
+    halo += -halo % alignment
+    height, width = array.shape[:2]
+    channels = array.shape[2] if array.ndim > 2 else 1
+    if tile_size is None:
+        tile_size = tile_size_for_budget(halo, channels, memory_budget)
+    tile_size = max(tile_size - tile_size % alignment, alignment)
+
+    tiles = list(iter_tiles(height, width, tile_size, halo))
+    logger.debug('Processing {} x {} image in {} tiles of {} pixels with a halo of {}'.format(
+        width, height, len(tiles), tile_size, halo))
+    for index, ((top, left, bottom, right), (pad_top, pad_left, pad_bottom, pad_right)) in enumerate(tiles):
+        tile = np.ascontiguousarray(array[pad_top:pad_bottom, pad_left:pad_right])
+        result = np.asarray(function(tile))
+        if result.shape[:2] != tile.shape[:2]:
+            raise ValueError('Tile function changed the tile size from {} to {}'.format(tile.shape[:2],
+                                                                                         result.shape[:2]))
+        if output is None:
+            output = np.empty((height, width) + result.shape[2:], dtype=result.dtype)
+        output[top:bottom, left:right] = result[top - pad_top:bottom - pad_top, left - pad_left:right - pad_left]
+        if progress:
+            progress((index + 1) / float(len(tiles)))
+    if isinstance(output, np.memmap):
+        output.flush()
+    return output
+
+
+def apply_tiled(image_filter, image, *args, memory_budget=DEFAULT_MEMORY_BUDGET, tile_size=None, output=None,
+                progress=None):
+    """
+    Applies a Filter instance tile by tile, with the halo taken from the filter's footprint so the result matches
+    applying it to the whole image. image may be a PIL image or an array, and the result has the same type, unless
+    output is given, in which case output is filled in and returned. Every tile runs the backend the dispatch table
+    picks for the whole image.
+    """
+    halo = image_filter.footprint(*args)
+    if halo is None:
+        raise ValueError('Filter "{}" depends on the whole image, so it can not be applied in tiles'.format(
+            image_filter.name))
+
+    pixels = pipeline.to_array(image)
+
+    def filter_tile(tile):
+        return np.asarray(tuning.apply_filter(image_filter, PIL.Image.fromarray(tile), args,
+                                              pixel_count=pixels.shape[0] * pixels.shape[1]))
+
+    result = process_tiles(pixels, filter_tile, halo, memory_budget=memory_budget, tile_size=tile_size, output=output,
+                           progress=progress, alignment=image_filter.alignment(*args))
+    if output is None and isinstance(image, PIL.Image.Image):
+        return PIL.Image.fromarray(result)
+    return result
+
+
+def open_input(path):
+    """
+    Opens an image for tiled processing. .npy files and uncompressed images are memory-mapped, anything else is
+    decoded by PIL, see image_io.read_array.
+    """
+    return image_io.read_array(path)
+
+
+def open_output(path, shape, dtype=np.uint8):
+    """
+    Creates a memory-mapped .npy file that process_tiles can write into tile by tile
+    """
+    return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+
+
+def apply_tiled_to_file(image_filter, input_path, output_path, *args, memory_budget=DEFAULT_MEMORY_BUDGET,
+                        tile_size=None, progress=None):
+    """
+    Applies a filter to the image at input_path and writes the result to output_path. With .npy on both ends the
+    image is streamed through memory maps, so it can be larger than RAM. Other output formats are assembled in a
+    memory-mapped scratch file next to the output first, because the encoders need the whole image.
+    """
+    source = open_input(input_path)
+    if output_path.lower().endswith('.npy'):
+        target = open_output(output_path, source.shape, source.dtype)
+        apply_tiled(image_filter, source, *args, memory_budget=memory_budget, tile_size=tile_size,
+                    output=target, progress=progress)
+        return
+
+    scratch_path = output_path + '.tiles.npy'
+    target = open_output(scratch_path, source.shape, source.dtype)
+    try:
+        apply_tiled(image_filter, source, *args, memory_budget=memory_budget, tile_size=tile_size,
+                    output=target, progress=progress)
+        PIL.Image.fromarray(target).save(output_path)
+    finally:
+        del target
+        os.remove(scratch_path)
@@ -0,0 +1,218 @@
+import argparse
+import json
+import logging
+import math
+import os
+import platform
+import threading
+import time
+
+import numpy as np
+
+import utils
+
+logger = logging.getLogger(__name__)
+
+# The dispatch table is read from this file, or from the path in the environment variable below
+DEFAULT_TABLE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'filter_images', 'dispatch.json')
+TABLE_PATH_VARIABLE = 'FILTER_IMAGES_DISPATCH_TABLE'
+# An alternative implementation is only used when its result differs from the reference implementation by at most
+# this many 8-bit levels on average
+DEFAULT_TOLERANCE = 1.0
+# and by at most this many levels anywhere, so that differences confined to a few pixels, such as borders the
+# reference leaves unfiltered, are not averaged away
+DEFAULT_MAX_ERROR = 16.0
+DEFAULT_SIZES = (256, 512, 1024, 2048)
+DEFAULT_MODES = ('RGB', 'RGBA', 'L')
+# Version of the table layout, backends[filter class][mode][dispatch bucket][pixel count]. Tables of another version
+# are ignored.
+TABLE_VERSION = 2
+
+_table = None
+_table_lock = threading.Lock()
+
+
+def table_path():
+    return os.environ.get(TABLE_PATH_VARIABLE) or DEFAULT_TABLE_PATH
+
+
+def load_table(path=None):
+    """
+    Returns the dispatch table, reading it the first time. A missing or unreadable table is an empty one, so every
+    filter uses its reference implementation.
+    """
+    global _table
+    with _table_lock:
+        if _table is None:
+            path = path or table_path()
+            try:
+                with open(path) as f:
+                    _table = json.load(f)
+                logger.debug('Loaded the dispatch table from {}'.format(path))
+                if not isinstance(_table, dict) or _table.get('version') != TABLE_VERSION:
+                    logger.warning('Ignoring the dispatch table {} written by an older version, run tuning.py '
+                                   'again'.format(path))
+                    _table = {}
+            except FileNotFoundError:
+                _table = {}
+            except (OSError, ValueError) as e:
+                logger.warning('Ignoring the dispatch table {}: {}'.format(path, e))
+                _table = {}
+        return _table
+
+
+def set_table(table):
+    """
+    Replaces the dispatch table used by this process, None to read it from disk again on next use
+    """
+    global _table
+    with _table_lock:
+        _table = table
+
+
+def choose_backend(filter_class_name, mode, pixel_count, bucket='any'):
+    """
+    Returns the backend the dispatch table picks for a filter class on images of the given mode and pixel count,
+    with parameters in the given dispatch bucket, taking the tuned size closest on a log scale, or None when the
+    filter was not tuned for the mode and bucket
+    """
+    sizes = load_table().get('backends', {}).get(filter_class_name, {}).get(mode, {}).get(bucket)
+    if not sizes:
+        return None
+    nearest = min(sizes, key=lambda tuned: abs(math.log(int(tuned)) - math.log(max(pixel_count, 1))))
+    return sizes[nearest]
+
+
+def apply_filter(f, img, args, pixel_count=None):
+    """
+    Applies filter f to the PIL image img with the backend the dispatch table picks for its class, the image mode
+    and size and the range of args, falling back to f.apply_filter. When img is a band or tile of a larger image,
+    pixel_count gives the size of that image, so that every piece runs the backend filtering the image in one piece
+    would.
+    """
+    backend = choose_backend(type(f).__name__, img.mode, pixel_count or img.width * img.height,
+                             f.dispatch_bucket(*args))
+    if backend is not None:
+        implementation = f.implementations().get(backend)
+        if implementation is not None:
+            return implementation(img, *args)
+    return f.apply_filter(img, *args)
+
+
+def best_time(function, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def measure(f, image, args, repeat):
+    """
+    Times every implementation of f on image and compares its result with the reference implementation's.
+    Returns a list of dicts with the backend, best time and the mean and maximum absolute difference in levels.
+    """
+    measurements = []
+    reference = None
+    for backend, implementation in f.implementations().items():
+        seconds, result = best_time(lambda: implementation(image, *args), repeat)
+        pixels = np.asarray(result, dtype=np.float32)
+        if reference is None:
+            reference = pixels
+        if pixels.shape != reference.shape:
+            error = float('inf')
+            max_error = float('inf')
+        else:
+            difference = np.abs(pixels - reference)
+            error = float(difference.mean())
+            max_error = float(difference.max())
+        measurements.append({'backend': backend, 'seconds': seconds, 'mean_error': error, 'max_error': max_error})
+    return measurements
+
+
+def is_eligible(result, tolerance, max_error):
+    return result['mean_error'] <= tolerance and result['max_error'] <= max_error
+
+
+def tune(filter_names=None, sizes=DEFAULT_SIZES, modes=DEFAULT_MODES, tolerance=DEFAULT_TOLERANCE, repeat=3,
+         max_error=DEFAULT_MAX_ERROR):
+    """
+    Benchmarks every implementation of the registered filters that have several, or of the named ones, and returns
+    a dispatch table picking the fastest implementation within tolerance of the reference on average and within
+    max_error everywhere, for each mode, size and range of parameters the filter tells apart
+    """
+    import benchmark_filters
+    import registry
+
+    backends = {}
+    measurements = []
+    for name in filter_names or registry.filter_names():
+        filter_class = registry.load(name)
+        f = filter_class()
+        if len(f.implementations()) < 2:
+            continue
+        for args in f.dispatch_arguments():
+            bucket = f.dispatch_bucket(*args)
+            for mode in modes:
+                for size in sizes:
+                    image = benchmark_filters.synthetic_image(size, mode)
+                    results = measure(f, image, args, repeat)
+                    # The reference always is, as it does not differ from itself
+                    eligible = [result for result in results if is_eligible(result, tolerance, max_error)]
+                    fastest = min(eligible, key=lambda result: result['seconds'])
+                    backends.setdefault(filter_class.__name__, {}).setdefault(mode, {}).setdefault(bucket, {})[
+                        str(size * size)] = fastest['backend']
+                    logger.info('{:<22} {:<10} {:>4} {:>5}  {}  -> {}'.format(
+                        filter_class.__name__, bucket, mode, size, '  '.join(
+                            '{} {:.1f} ms (err {:.2f}, max {:.0f})'.format(
+                                result['backend'], result['seconds'] * 1000, result['mean_error'],
+                                result['max_error']) for result in results),
+                        fastest['backend']))
+                    for result in results:
+                        result.update({'filter': filter_class.__name__, 'bucket': bucket, 'mode': mode,
+                                       'size': size})
+                    measurements.extend(results)
+
+    return {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'machine': {'platform': platform.platform(), 'processor': platform.processor(), 'cpus': os.cpu_count()},
+        'version': TABLE_VERSION,
+        'tolerance': tolerance,
+        'max_error': max_error,
+        'backends': backends,
+        'measurements': measurements,
+    }
+
+
+def save_table(table, path=None):
+    path = path or table_path()
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(table, f, indent=2)
+    logger.info('Wrote the dispatch table to {}'.format(path))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the alternative implementations of filters on this '
+                                                 'machine and saves the fastest ones as the dispatch table')
+    parser.add_argument('--filter', dest='filters', action='append',
+                        help='filter to tune, e.g. gaussian. Repeat for several, defaults to all with alternatives')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES),
+                        help='edge lengths of the square test images')
+    parser.add_argument('--modes', nargs='+', default=list(DEFAULT_MODES), help='image modes to tune for')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='largest mean absolute difference from the reference, in 8-bit levels')
+    parser.add_argument('--max-error', type=float, default=DEFAULT_MAX_ERROR,
+                        help='largest absolute difference from the reference in any pixel, in 8-bit levels')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs, the best one counts')
+    parser.add_argument('-o', '--output', help='where to write the table, defaults to {} or ${}'.format(
+        DEFAULT_TABLE_PATH, TABLE_PATH_VARIABLE))
+    arguments = parser.parse_args()
+
+    utils.setup_logger_to_console_file()
+    save_table(tune(arguments.filters, arguments.sizes, arguments.modes, arguments.tolerance, arguments.repeat,
+                    arguments.max_error), arguments.output)
@@ -0,0 +1,206 @@
+import collections
+import concurrent.futures
+import io
+import logging
+import threading
+
+import PIL.Image
+import numpy as np
+
+import cache
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHECKPOINT_INTERVAL = 5
+DEFAULT_MEMORY_BYTES = 256 * 1024 * 1024
+# PNG's row filters compress photos about twice as well as plain zlib, level 1 keeps it fast
+CHECKPOINT_COMPRESS_LEVEL = 1
+
+
+def compress_image(image):
+    """
+    Returns image losslessly compressed as PNG bytes
+    """
+    buffer = io.BytesIO()
+    image.save(buffer, 'PNG', compress_level=CHECKPOINT_COMPRESS_LEVEL)
+    return buffer.getvalue()
+
+
+def decompress_image(data):
+    image = PIL.Image.open(io.BytesIO(data))
+    image.load()
+    return image
+
+
+def common_prefix_length(first, second):
+    length = 0
+    for first_step, second_step in zip(first, second):
+        if first_step != second_step:
+            break
+        length += 1
+    return length
+
+
+class Checkpoint:
+    """
+    The full-size image of one state, compressed on a background thread. Until it is, the uncompressed image of
+    image_bytes counts as its size.
+    """
+
+    def __init__(self, chain, future, image_bytes):
+        self.chain = chain
+        self.future = future
+        self.image_bytes = image_bytes
+
+    def size(self):
+        if not self.future.done():
+            return self.image_bytes
+        return 0 if self.future.exception() else len(self.future.result())
+
+    def image(self):
+        return decompress_image(self.future.result())
+
+
+class UndoHistory:
+    """
+    Undo and redo over the states of the edited image, each state being the chain of (filter class, arguments)
+    steps applied to the original image. Only the chains are kept for every state. The full-size image is kept as a
+    compressed checkpoint at most every checkpoint_interval steps, and the states in between are recomputed on demand
+    from the nearest checkpoint. Checkpoints are dropped oldest first once they take more than max_bytes, keeping at
+    least the newest one. Given the result_cache the editor renders through, its results count against max_bytes
+    too: the cache is resized to whatever the checkpoints leave over.
+    """
+
+    def __init__(self, checkpoint_interval=DEFAULT_CHECKPOINT_INTERVAL, max_bytes=DEFAULT_MEMORY_BYTES,
+                 result_cache=None):
+        self.checkpoint_interval = checkpoint_interval
+        self.max_bytes = max_bytes
+        self.result_cache = result_cache
+        self.states = [[]]
+        self.position = 0
+        self.checkpoints = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.resize_result_cache(0)
+
+    def resize_result_cache(self, checkpoint_bytes):
+        if self.result_cache is not None:
+            self.result_cache.resize(max(self.max_bytes - checkpoint_bytes, 0))
+
+    def reset(self):
+        """
+        Forgets every state, starting again from the unfiltered original image
+        """
+        with self.lock:
+            self.states = [[]]
+            self.position = 0
+            self.checkpoints.clear()
+        self.resize_result_cache(0)
+
+    def current(self):
+        return self.states[self.position]
+
+    def push(self, chain):
+        """
+        Records chain as the new current state, discarding the states that could be redone
+        """
+        if list(chain) == self.current():
+            return
+        del self.states[self.position + 1:]
+        self.states.append(list(chain))
+        self.position += 1
+
+    def can_undo(self):
+        return self.position > 0
+
+    def can_redo(self):
+        return self.position < len(self.states) - 1
+
+    def undo(self):
+        """
+        Steps back to the previous state and returns its chain
+        """
+        if self.can_undo():
+            self.position -= 1
+        return self.current()
+
+    def redo(self):
+        """
+        Steps forward to the state that was undone last and returns its chain
+        """
+        if self.can_redo():
+            self.position += 1
+        return self.current()
+
+    def nearest_checkpoint(self, chain):
+        """
+        Returns the checkpoint whose chain is the longest prefix of chain, or None
+        """
+        best = None
+        with self.lock:
+            checkpoints = list(self.checkpoints.values())
+        for checkpoint in checkpoints:
+            length = len(checkpoint.chain)
+            if length <= len(chain) and chain[:length] == checkpoint.chain and (
+                    best is None or length > len(best.chain)):
+                best = checkpoint
+        return best
+
+    def record_render(self, chain, image):
+        """
+        Called with every full-size image rendered for a state. Compresses it into a checkpoint in the background
+        when checkpoint_interval steps or more would otherwise have to be recomputed to get back to it.
+        """
+        chain = list(chain)
+        nearest = self.nearest_checkpoint(chain)
+        replayed_steps = len(chain) - (len(nearest.chain) if nearest else 0)
+        if replayed_steps < self.checkpoint_interval:
+            return
+        key = tuple((filter_class, repr(args)) for filter_class, args in chain)
+        # PIL images are not modified in place by the filters, but copy anyway as compressing takes a while
+        image = image.copy()
+        future = self.executor.submit(compress_image, image)
+        with self.lock:
+            self.checkpoints[key] = Checkpoint(chain, future, image.width * image.height * len(image.getbands()))
+        self.enforce_budget()
+        future.add_done_callback(self._checkpoint_compressed)
+        logger.debug('Checkpointing the state after {} steps'.format(len(chain)))
+
+    def _checkpoint_compressed(self, future):
+        self.enforce_budget()
+
+    def enforce_budget(self):
+        """
+        Drops the oldest checkpoints beyond max_bytes and gives what the others leave over to the result cache
+        """
+        with self.lock:
+            total = sum(checkpoint.size() for checkpoint in self.checkpoints.values())
+            while total > self.max_bytes and len(self.checkpoints) > 1:
+                _, dropped = self.checkpoints.popitem(last=False)
+                total -= dropped.size()
+                logger.debug('Dropped the checkpoint after {} steps to stay within {} MB'.format(
+                    len(dropped.chain), self.max_bytes // (1024 * 1024)))
+        self.resize_result_cache(total)
+
+    def memory_used(self):
+        with self.lock:
+            return sum(checkpoint.size() for checkpoint in self.checkpoints.values())
+
+    def restore_checkpoint(self, result_cache, source_key, chain):
+        """
+        Makes the nearest checkpoint of chain available in result_cache, unless the cache already has a result at
+        least as far along, so that rendering chain from the cache only recomputes the steps after it
+        """
+        checkpoint = self.nearest_checkpoint(chain)
+        if checkpoint is None or not checkpoint.chain:
+            return
+        keys = cache.chain_keys(source_key, chain)
+        with result_cache.lock:
+            if any(key in result_cache.entries for key in keys[len(checkpoint.chain) - 1:]):
+                return
+        image = checkpoint.image()
+        if image.mode in cache.CACHEABLE_MODES:
+            result_cache.put(keys[len(checkpoint.chain) - 1], np.asarray(image), copy=False)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
@@ -1,13 +1,29 @@
+import collections
 import logging
+import threading
 
 import numpy as np
-import matplotlib.pyplot as plt
-from skimage import img_as_float, io
+
+import convolution
+
+# matplotlib and scikit-image take most of a second to import, so the functions that need them import them on first
+# use instead of every program that imports utils paying for them at startup
+
+# Kernel transforms of recent gaussian_filter calls, keyed by (transform shape, blur intensity), oldest first
+_kernel_spectra = collections.OrderedDict()
+_kernel_spectra_lock = threading.Lock()
+KERNEL_SPECTRA_CACHE_SIZE = 8
+
+# gaussian_filter applies kernels with at most this many significant taps per axis directly instead of with FFTs
+SPATIAL_MAX_TAPS = 12
+# Taps below this fraction of the peak are too small to change a float32 result
+SIGNIFICANT_TAP = 1e-7
 
 
 def rgb2gray(rgb):
     """
-    Changes the given Colour Image into GreyScale
+    Changes the given Colour Image into GreyScale.
+    Works the same on an (N, H, W, C) stack of images, converting all of them in one pass.
     """
     return np.dot(rgb[..., :3], [0.2989, 0.5870, 0.1140])
 
@@ -26,6 +42,8 @@ def plot_fourier(fourier):
     """
     Plots the Fourier Transform Represented by the given Matrix
     """
+    import matplotlib.pyplot as plt
+
     psd_2d = np.log(np.abs(fourier)**2+1)
     (height, width) = psd_2d.shape
     plt.figure(figsize=(10, 10*height/width), facecolor='white')
@@ -36,48 +54,122 @@ def plot_fourier(fourier):
     plt.show()
 
 
-def read_image_from_path(path):
+def read_image_from_path(path, as_float=False):
     """
-    Reads Image from the given path
+    Reads Image from the given path as a read-only uint8 array, memory-mapped where possible, see
+    image_io.read_array. With as_float set, the values are scaled to floats in [0, 1] instead.
     """
-    if path.split('.')[0] == 'png':
-        original_image = plt.imread(path).astype(float)
-    else:
-        original_image = img_as_float(io.imread(path))
+    import image_io
+
+    original_image = image_io.read_array(path)
+    if as_float:
+        return original_image / 255.0
     return original_image
 
 
-def save_img_at_path(img, path):
+def save_img_at_path(img, path, **options):
     """
-        Saves the Image at the given path
+    Saves the Image, a PIL image or a uint8 array, at the given path, see image_io.save_image for the options
     """
-    plt.imsave(path, img)
+    import image_io
 
+    return image_io.save_image(img, path, **options)
 
-def gaussian_filter(img, blur_intensity):
+
+def gaussian_bump(blur_intensity):
     """
-    Given the intensity the Blur Effect is Applied using Gaussian filter
+    Returns the 1-D Gaussian that gaussian_filter blurs with along each axis
     """
-    # Prepare an Gaussian convolution kernel
-    # First a 1-D  Gaussian
     t = np.linspace(-10, 10, 30)
     bump = np.exp(-blur_intensity*t**2)
-    bump /= np.trapz(bump)  # normalize the integral to 1
+    bump /= bump.sum() - (bump[0] + bump[-1]) / 2  # normalize the integral to 1, the same as np.trapz(bump)
+    return bump
+
+
+def _kernel_spectrum(shape, blur_intensity, bump):
+    key = (shape, blur_intensity)
+    with _kernel_spectra_lock:
+        if key in _kernel_spectra:
+            _kernel_spectra.move_to_end(key)
+            return _kernel_spectra[key]
+
+    # The 2-D kernel is the outer product of the bump with itself, so its transform is the outer product of the
+    # 1-D transforms
+    kernel_ft = np.outer(np.fft.fft(bump, shape[0]), np.fft.rfft(bump, shape[1])).astype(np.complex64)
+
+    with _kernel_spectra_lock:
+        _kernel_spectra[key] = kernel_ft
+        while len(_kernel_spectra) > KERNEL_SPECTRA_CACHE_SIZE:
+            _kernel_spectra.popitem(last=False)
+    return kernel_ft
+
+
+def _gaussian_filter_fft(img, blur_intensity, bump):
+    height, width = img.shape[:2]
+    reach = len(bump) - 1
+    # Wrapping the last rows and columns around to the front gives the same circular convolution as a transform
+    # of exactly the image size, while letting the transform be padded to a size that is fast to compute
+    padded = np.pad(img, [(reach, 0), (reach, 0)] + [(0, 0)] * (img.ndim - 2), mode='wrap')
+    shape = (convolution.next_fast_length(padded.shape[0]), convolution.next_fast_length(padded.shape[1]))
+
+    kernel_ft = _kernel_spectrum(shape, blur_intensity, bump)
+    if img.ndim > 2:
+        # the 'newaxis' is to match to color direction
+        kernel_ft = kernel_ft.reshape(kernel_ft.shape + (1,) * (img.ndim - 2))
+    img_ft = np.fft.rfft2(padded, s=shape, axes=(0, 1))
+    img_ft *= kernel_ft
+
+    img2 = np.fft.irfft2(img_ft, s=shape, axes=(0, 1))
+    return img2[reach:reach + height, reach:reach + width].astype(np.float32)
+
+
+def _convolve_wrapped(img, taps, first_tap, axis):
+    # Circular convolution along axis with the taps of the bump from index first_tap onwards
+    size = img.shape[axis]
+    reach = first_tap + len(taps) - 1
+    pad_width = [(0, 0)] * img.ndim
+    pad_width[axis] = (reach, 0)
+    padded = np.pad(img, pad_width, mode='wrap')
+    result = np.zeros_like(img)
+    term = np.empty_like(img)
+    for index, tap in enumerate(taps):
+        start = reach - first_tap - index
+        window = [slice(None)] * img.ndim
+        window[axis] = slice(start, start + size)
+        np.multiply(padded[tuple(window)], np.float32(tap), out=term)
+        result += term
+    return result
+
+
+def _gaussian_filter_spatial(img, taps, first_tap):
+    return _convolve_wrapped(_convolve_wrapped(img, taps, first_tap, 0), taps, first_tap, 1)
 
-    # make a 2-D kernel out of it
-    kernel = bump[:, np.newaxis] * bump[np.newaxis, :]
 
-    # Implement convolution via FFT
-    # Padded fourier transform, with the same shape as the image
-    kernel_ft = np.fft.fftn(kernel, s=img.shape[:2], axes=(0, 1))
-    img_ft = np.fft.fftn(img, axes=(0, 1))
+def gaussian_filter(img, blur_intensity):
+    """
+    Given the intensity the Blur Effect is Applied using Gaussian filter.
+    The blur wraps around the image edges like the FFT it is defined by. Large kernels are applied with real FFTs
+    padded to fast sizes, reusing the kernel transform for images of the same size, and kernels with only a few
+    significant taps with two 1-D passes. Returns float32 values on the same scale as img.
+    """
+    bump = gaussian_bump(blur_intensity)
+    img = np.asarray(img, dtype=np.float32)
 
-    # the 'newaxis' is to match to color direction
-    img2_ft = kernel_ft[:, :, np.newaxis] * img_ft
+    significant = np.nonzero(bump >= bump.max() * SIGNIFICANT_TAP)[0]
+    if len(significant) <= SPATIAL_MAX_TAPS:
+        first_tap = significant[0]
+        return _gaussian_filter_spatial(img, bump[first_tap:significant[-1] + 1], first_tap)
+    return _gaussian_filter_fft(img, blur_intensity, bump)
 
-    img2 = np.fft.ifft2(img2_ft, axes=(0, 1)).real
 
-    return img2
+def gaussian_filter_batch(images, blur_intensity):
+    """
+    Same as gaussian_filter for an (N, H, W) or (N, H, W, C) stack of same-sized images. The images are blurred as
+    extra channels of one array, so the stack shares a single set of passes or transforms and one kernel transform.
+    """
+    # Copying the stack with the image index last keeps every pass over it contiguous
+    channels_last = np.moveaxis(np.asarray(images), 0, -1).astype(np.float32, order='C')
+    return np.moveaxis(gaussian_filter(channels_last, blur_intensity), -1, 0)
 
 
 def setup_logger_to_console_file(log_file_path=None, log_level=None):
@@ -0,0 +1,419 @@
+import argparse
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+
+import PIL.Image
+import cv2
+import numpy as np
+
+import utils
+import batch
+import image_io
+import instrumentation
+import pipeline
+import registry
+
+logger = logging.getLogger(__name__)
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv', '.m4v', '.webm')
+# Codec used to write each container, anything else is written as mp4v
+FOURCCS = {'.avi': 'MJPG', '.mkv': 'XVID', '.webm': 'VP80'}
+# Files of a source directory that are read as frames, the image types of image_io but numpy arrays, which
+# cv2.imread does not decode
+FRAME_EXTENSIONS = tuple(extension for extension in image_io.IMAGE_EXTENSIONS if extension != '.npy')
+DEFAULT_FPS = 25.0
+DEFAULT_QUEUE_DEPTH = 4
+LOG_INTERVAL = 2.0
+# How often a stage waiting on a queue checks whether another stage failed
+POLL_INTERVAL = 0.1
+
+_END = object()
+
+
+class CaptureSource:
+    """
+    Frames of a video file or camera, decoded by cv2.VideoCapture into the caller's buffers
+    """
+
+    def __init__(self, source):
+        self.name = source
+        self.capture = cv2.VideoCapture(int(source) if str(source).isdigit() else source)
+        if not self.capture.isOpened():
+            raise ValueError('Could not open video {}'.format(source))
+        self.size = (int(self.capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(self.capture.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        self.fps = self.capture.get(cv2.CAP_PROP_FPS) or DEFAULT_FPS
+        self.frame_count = int(self.capture.get(cv2.CAP_PROP_FRAME_COUNT)) or None
+        self.live = str(source).isdigit()
+
+    def read(self, buffer):
+        """
+        Decodes the next BGR frame into buffer and returns it, or returns None at the end of the video
+        """
+        ok, frame = self.capture.read(buffer)
+        if not ok:
+            return None
+        if frame is not buffer:
+            # VideoCapture only decodes in place into a buffer of the right size and type
+            np.copyto(buffer, frame)
+        return buffer
+
+    def close(self):
+        self.capture.release()
+
+
+class ImageSequenceSource:
+    """
+    Frames read from a sorted list of image files of the same size
+    """
+
+    def __init__(self, paths, fps=DEFAULT_FPS):
+        if not paths:
+            raise ValueError('The image sequence is empty')
+        self.name = os.path.dirname(paths[0]) or '.'
+        self.paths = paths
+        self.position = 0
+        with PIL.Image.open(paths[0]) as image:
+            self.size = image.size
+        self.fps = fps
+        self.frame_count = len(paths)
+        self.live = False
+
+    def read(self, buffer):
+        if self.position >= len(self.paths):
+            return None
+        path = self.paths[self.position]
+        self.position += 1
+        frame = cv2.imread(path, cv2.IMREAD_COLOR)
+        if frame is None:
+            raise ValueError('Could not read frame {}'.format(path))
+        if frame.shape != buffer.shape:
+            raise ValueError('Frame {} is {} x {}, expected {} x {}'.format(path, frame.shape[1], frame.shape[0],
+                                                                            buffer.shape[1], buffer.shape[0]))
+        np.copyto(buffer, frame)
+        return buffer
+
+    def close(self):
+        pass
+
+
+class VideoSink:
+    """
+    Encodes BGR frames into a video file with cv2.VideoWriter
+    """
+
+    def __init__(self, path, fps, size):
+        extension = os.path.splitext(path)[1].lower()
+        self.writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*FOURCCS.get(extension, 'mp4v')), fps, size)
+        if not self.writer.isOpened():
+            raise ValueError('Could not open {} for writing'.format(path))
+
+    def write(self, index, frame):
+        self.writer.write(frame)
+
+    def close(self):
+        self.writer.release()
+
+
+class ImageSequenceSink:
+    """
+    Writes BGR frames as numbered image files into a directory
+    """
+
+    def __init__(self, directory, extension='.png'):
+        os.makedirs(directory, exist_ok=True)
+        self.pattern = os.path.join(directory, 'frame_{:06d}' + extension)
+
+    def write(self, index, frame):
+        cv2.imwrite(self.pattern.format(index), frame)
+
+    def close(self):
+        pass
+
+
+def open_source(source, fps=None):
+    """
+    Opens a video file, a camera number, a directory of images or a glob pattern of images. Files of a directory
+    that are not images, such as a Thumbs.db or notes, are skipped.
+    """
+    if os.path.isdir(source):
+        paths = [path for path in batch.expand_inputs([os.path.join(source, '*')])
+                 if path.lower().endswith(FRAME_EXTENSIONS)]
+        return ImageSequenceSource(paths, fps or DEFAULT_FPS)
+    if not str(source).isdigit() and os.path.splitext(source)[1].lower() not in VIDEO_EXTENSIONS:
+        return ImageSequenceSource(batch.expand_inputs([source]), fps or DEFAULT_FPS)
+    return CaptureSource(source)
+
+
+def open_sink(output, fps, size):
+    """
+    Opens a video file for writing, or a directory of numbered PNG frames when output has no video extension
+    """
+    if os.path.splitext(output)[1].lower() in VIDEO_EXTENSIONS:
+        return VideoSink(output, fps, size)
+    return ImageSequenceSink(output)
+
+
+class StreamStats:
+    """
+    Frame counts and the time each stage spent working, as opposed to waiting on its queues
+    """
+
+    def __init__(self):
+        self.decoded = 0
+        self.filtered = 0
+        self.written = 0
+        self.dropped = 0
+        self.backlogged = 0
+        self.max_backlog = 0
+        self.busy = {'decode': 0.0, 'filter': 0.0, 'encode': 0.0}
+        self.start = time.perf_counter()
+        self.end = None
+
+    def elapsed(self):
+        return (self.end or time.perf_counter()) - self.start
+
+    def fps(self):
+        elapsed = self.elapsed()
+        return self.written / elapsed if elapsed else 0.0
+
+    def report(self):
+        logger.info('Wrote {} of {} frames in {:.2f} s: {:.1f} fps, {} dropped, {} backlogged (queue up to {})'.format(
+            self.written, self.decoded, self.elapsed(), self.fps(), self.dropped, self.backlogged, self.max_backlog))
+        for stage, seconds in self.busy.items():
+            frames = {'decode': self.decoded, 'filter': self.filtered, 'encode': self.written}[stage]
+            logger.info('  {:<6} {:7.2f} s busy  {:8.1f} fps on its own'.format(
+                stage, seconds, frames / seconds if seconds else 0.0))
+
+
+def _put(target, item, stop):
+    while not stop.is_set():
+        try:
+            target.put(item, timeout=POLL_INTERVAL)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _get(source, stop):
+    while not stop.is_set():
+        try:
+            return source.get(timeout=POLL_INTERVAL)
+        except queue.Empty:
+            pass
+    return _END
+
+
+def to_bgr(result, out):
+    """
+    Converts a filter result, RGB, RGBA or grayscale, to BGR in the preallocated frame out
+    """
+    if result.shape[:2] != out.shape[:2]:
+        raise ValueError('The filters changed the frame size from {} to {}'.format(out.shape[:2], result.shape[:2]))
+    if result.ndim == 2:
+        return cv2.cvtColor(result, cv2.COLOR_GRAY2BGR, dst=out)
+    if result.shape[2] == 4:
+        return cv2.cvtColor(result, cv2.COLOR_RGBA2BGR, dst=out)
+    return cv2.cvtColor(result, cv2.COLOR_RGB2BGR, dst=out)
+
+
+class FrameStream:
+    """
+    Runs a filter pipeline over every frame of a source, with decoding, filtering and encoding on three threads
+    connected by queues of at most queue_depth frames. Frames are decoded and converted into a fixed set of
+    preallocated buffers that are handed back once the next stage is done with them. When the filters can not keep
+    up, the decoder waits, which is counted as a backlogged frame, or, with drop_frames set, as for a camera, the
+    frame is dropped instead.
+    """
+
+    def __init__(self, source, sink, filter_pipeline, queue_depth=DEFAULT_QUEUE_DEPTH, drop_frames=False,
+                 max_frames=None):
+        self.source = source
+        self.sink = sink
+        self.filter_pipeline = filter_pipeline
+        self.drop_frames = drop_frames
+        self.max_frames = max_frames
+        self.stats = StreamStats()
+        self.stop = threading.Event()
+        self.errors = []
+
+        width, height = source.size
+        self.filter_queue = queue.Queue(maxsize=queue_depth)
+        self.encode_queue = queue.Queue(maxsize=queue_depth)
+        # Enough buffers for full queues plus the frame each stage on either side is working on
+        self.free_frames = queue.Queue()
+        self.free_outputs = queue.Queue()
+        for _ in range(queue_depth + 2):
+            self.free_frames.put(np.empty((height, width, 3), np.uint8))
+            self.free_outputs.put(np.empty((height, width, 3), np.uint8))
+        self.rgb = np.empty((height, width, 3), np.uint8)
+
+    def _stage(self, name, function):
+        def run():
+            try:
+                function()
+            except Exception as e:
+                logger.exception('The {} stage failed'.format(name))
+                self.errors.append(e)
+                self.stop.set()
+        return threading.Thread(target=run, name='video {}'.format(name), daemon=True)
+
+    def decode(self):
+        index = 0
+        try:
+            while not self.stop.is_set() and (self.max_frames is None or self.stats.decoded < self.max_frames):
+                buffer = _get(self.free_frames, self.stop)
+                if buffer is _END:
+                    break
+                start = time.perf_counter()
+                with instrumentation.span('decode', 'video', frame=self.stats.decoded):
+                    frame = self.source.read(buffer)
+                self.stats.busy['decode'] += time.perf_counter() - start
+                if frame is None:
+                    break
+                self.stats.decoded += 1
+                backlog = self.filter_queue.qsize()
+                self.stats.max_backlog = max(self.stats.max_backlog, backlog)
+                try:
+                    self.filter_queue.put_nowait((index, frame))
+                except queue.Full:
+                    if self.drop_frames:
+                        self.stats.dropped += 1
+                        self.free_frames.put(frame)
+                        continue
+                    self.stats.backlogged += 1
+                    if not _put(self.filter_queue, (index, frame), self.stop):
+                        break
+                index += 1
+        finally:
+            _put(self.filter_queue, _END, self.stop)
+
+    def filter(self):
+        try:
+            while True:
+                item = _get(self.filter_queue, self.stop)
+                if item is _END:
+                    break
+                index, frame = item
+                start = time.perf_counter()
+                # The filters work on RGB, like on stills, and may modify their input, so they get their own buffer
+                cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=self.rgb)
+                self.free_frames.put(frame)
+                # Every frame lands in the same buffer, so the intermediates are only valid for one frame
+                result = self.filter_pipeline.run(self.rgb, context=pipeline.PipelineContext(), report_progress=False)
+                self.stats.busy['filter'] += time.perf_counter() - start
+                out = _get(self.free_outputs, self.stop)
+                if out is _END:
+                    break
+                start = time.perf_counter()
+                to_bgr(pipeline.to_array(result), out)
+                self.stats.busy['filter'] += time.perf_counter() - start
+                self.stats.filtered += 1
+                if not _put(self.encode_queue, (index, out), self.stop):
+                    break
+        finally:
+            _put(self.encode_queue, _END, self.stop)
+
+    def encode(self):
+        while True:
+            item = _get(self.encode_queue, self.stop)
+            if item is _END:
+                break
+            index, out = item
+            start = time.perf_counter()
+            with instrumentation.span('encode', 'video', frame=index):
+                self.sink.write(index, out)
+            self.stats.busy['encode'] += time.perf_counter() - start
+            self.free_outputs.put(out)
+            self.stats.written += 1
+
+    def run(self):
+        """
+        Processes the whole source and returns the StreamStats. Raises the first error of any stage.
+        """
+        threads = [self._stage('decode', self.decode), self._stage('filter', self.filter),
+                   self._stage('encode', self.encode)]
+        self.stats.start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        last_log = time.perf_counter()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(POLL_INTERVAL)
+                    if time.perf_counter() - last_log > LOG_INTERVAL:
+                        last_log = time.perf_counter()
+                        logger.info('Frame {}{}, {:.1f} fps, {} dropped, {} backlogged'.format(
+                            self.stats.written, ' of {}'.format(self.source.frame_count)
+                            if self.source.frame_count else '', self.stats.fps(), self.stats.dropped,
+                            self.stats.backlogged))
+        except KeyboardInterrupt:
+            logger.info('Stopping')
+            self.stop.set()
+            for thread in threads:
+                thread.join()
+        self.stats.end = time.perf_counter()
+        if self.errors:
+            raise self.errors[0]
+        return self.stats
+
+
+def run_stream(source, output, chain, queue_depth=DEFAULT_QUEUE_DEPTH, drop_frames=None, max_frames=None,
+               fps=None, fuse=False):
+    """
+    Applies a chain of (filter class, arguments) steps to every frame of source, a video file, camera number,
+    directory or glob pattern of images, and writes the frames to output, a video file or a directory. Frames are
+    dropped when the filters fall behind a camera, unless drop_frames says otherwise. Returns the StreamStats.
+    """
+    frames = open_source(source, fps)
+    try:
+        sink = open_sink(output, fps or frames.fps, frames.size)
+        try:
+            stream = FrameStream(frames, sink, pipeline.Pipeline.from_chain(chain, fuse=fuse), queue_depth,
+                                 frames.live if drop_frames is None else drop_frames, max_frames)
+            logger.info('Filtering {} x {} frames from {} into {}'.format(frames.size[0], frames.size[1],
+                                                                          frames.name, output))
+            stats = stream.run()
+        finally:
+            sink.close()
+    finally:
+        frames.close()
+    stats.report()
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Applies a chain of filters to every frame of a video, camera or '
+                                                 'image sequence')
+    parser.add_argument('source', help='video file, camera number, directory of images or glob pattern of images')
+    parser.add_argument('output', help='video file to write, or directory for numbered PNG frames')
+    parser.add_argument('-f', '--filter', dest='filters', action='append', required=True,
+                        help='filter to apply, as NAME or NAME:ARG[,ARG...], e.g. "Cartoon". Repeat to chain.')
+    parser.add_argument('--queue-depth', type=int, default=DEFAULT_QUEUE_DEPTH,
+                        help='frames buffered between the decode, filter and encode stages')
+    parser.add_argument('--drop-frames', action='store_true', default=None,
+                        help='drop frames the filters can not keep up with rather than wait, the default for cameras')
+    parser.add_argument('--no-drop-frames', dest='drop_frames', action='store_false',
+                        help='never drop frames, even from a camera')
+    parser.add_argument('--max-frames', type=int, help='stop after this many frames')
+    parser.add_argument('--fps', type=float, help='frame rate of image sequences and of the output')
+    parser.add_argument('--fuse', action='store_true',
+                        help='fuse runs of linear filters and of point operations into single passes. Faster, but '
+                             'it skips the rounding and clamping between linear filters, so chains with sharpening '
+                             'kernels can differ from the editor by over 100 levels')
+    parser.add_argument('-v', '--verbose', action='store_true', help='log debug messages')
+    arguments = parser.parse_args(argv)
+
+    utils.setup_logger_to_console_file(log_level=logging.DEBUG if arguments.verbose else logging.INFO)
+    chain = [(registry.load(name), args) for name, args in batch.build_chain(arguments.filters)]
+    run_stream(arguments.source, arguments.output, chain, arguments.queue_depth, arguments.drop_frames,
+               arguments.max_frames, arguments.fps, fuse=arguments.fuse)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())